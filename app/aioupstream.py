@@ -0,0 +1,186 @@
+import json
+import atexit
+import asyncio
+import logging
+import threading
+import aiohttp
+from flask import current_app as app
+
+from upstream import ratelimit_path
+from ratelimit import ShopifyRateLimit, EbayRateLimit
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.aioupstream')
+logger.setLevel(logging.DEBUG)
+
+class AsyncResponse(object):
+	"""
+	A finished aiohttp response, body already read, that looks enough like a `requests.Response` for the rate
+	limiters in ratelimit.py (and for code written against `requests`): status_code, headers, text, json() and
+	request.url.
+	"""
+
+	class _Request(object):
+		def __init__(self, method, url):
+			self.method = method
+			self.url = url
+
+	def __init__(self, method, url, status, headers, body):
+		self.status_code = status
+		self.headers = headers
+		self.content = body
+		self.text = body.decode('utf-8', errors='replace')
+		self.request = self._Request(method, url)
+
+	def json(self):
+		return json.loads(self.text)
+
+class AsyncUpstreamClient(object):
+	"""
+	The asyncio counterpart of upstream.UpstreamClient, on aiohttp.
+
+	An aiohttp session belongs to the event loop it was made on, so every client lives on this process's upstream
+	loop (see `upstream_loop()`), and like the sync clients there's one per upstream per process: its keep-alive
+	connections are reused by every view and job in the process. Only call it from coroutines running on that
+	loop - hand them to `call()` or `run()`. At most `pool_size` requests are in flight at once; the rest wait
+	for a free connection.
+
+	The rate limiters are the same SQLite-backed ones the sync clients use, so async and sync calls from every
+	worker share one budget. Waiting for room in a bucket happens on a thread, so it doesn't block the loop.
+	"""
+
+	def __init__(self, name, pool_size=10, headers=None, auth=None, limiter=None, max_retries=3):
+		self.name = name
+		self.pool_size = pool_size
+		self.headers = headers or {}
+		# Like requests, only authenticate if we have both halves (unset Shopify credentials mean unauthenticated
+		# 	calls that Shopify turns down, not a crash)
+		self.auth = aiohttp.BasicAuth(*auth) if auth is not None and None not in auth else None
+		self.limiter = limiter
+		self.max_retries = max_retries
+		self.session = None
+
+	def _session(self):
+		"""The client's session, made on first use (it has to be made on the loop it's going to be used on)."""
+		if self.session is None:
+			self.session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector( limit=self.pool_size ),
+				headers=self.headers,
+				auth=self.auth )
+		return self.session
+
+	async def request(self, method, url, auth_token=None, cost=None, **kwargs):
+		"""
+		Send a request and return an `AsyncResponse`. Takes aiohttp's request arguments (`json=`, `data=`,
+		`params=`...); `auth_token` and `cost` work like `UpstreamClient.request()`.
+		"""
+		if auth_token is not None:
+			headers = dict(kwargs.pop('headers', None) or {})
+			headers['Authorization'] = 'Bearer {}'.format(auth_token)
+			kwargs['headers'] = headers
+
+		loop = asyncio.get_running_loop()
+		attempt = 0
+		while True:
+			if self.limiter is not None:
+				await loop.run_in_executor( None, lambda: self.limiter.before(method, url, cost=cost) )
+			async with self._session().request(method, url, **kwargs) as r:
+				response = AsyncResponse( method, str(r.url), r.status, r.headers, await r.read() )
+			if self.limiter is None or not await loop.run_in_executor( None, self.limiter.after, response ):
+				return response
+
+			attempt += 1
+			if attempt > self.max_retries:
+				logger.warning('{} still throttling {} {} after {} retries, giving up'.format(self.name, method, url, self.max_retries))
+				return response
+			logger.info('{} throttled {} {}, retrying ({}/{})'.format(self.name, method, url, attempt, self.max_retries))
+
+	async def get(self, url, **kwargs):
+		return await self.request('GET', url, **kwargs)
+
+	async def put(self, url, **kwargs):
+		return await self.request('PUT', url, **kwargs)
+
+	async def post(self, url, **kwargs):
+		return await self.request('POST', url, **kwargs)
+
+	async def delete(self, url, **kwargs):
+		return await self.request('DELETE', url, **kwargs)
+
+"""The upstream loop and its clients, one per process, created on first use so each gunicorn worker gets its own"""
+_loop = None
+_clients = {}
+_lock = threading.Lock()
+
+def upstream_loop():
+	"""
+	This process's upstream event loop, running forever on its own thread. Every async upstream call in the process
+	runs on it, so they all share the async clients' connections instead of each view or job opening a session
+	(and a TCP+TLS handshake per host) on a loop of its own.
+	"""
+	global _loop
+	with _lock:
+		if _loop is None:
+			_loop = asyncio.new_event_loop()
+			threading.Thread(target=_loop.run_forever, name='upstream-loop', daemon=True).start()
+			atexit.register(_close_sessions)
+			logger.debug('Started the upstream event loop')
+		return _loop
+
+def _close_sessions():
+	"""Close the clients' sessions (and their connections) when the process exits."""
+	async def close():
+		for client in list(_clients.values()):
+			if client.session is not None:
+				await client.session.close()
+	try:
+		submit( close() ).result(timeout=5)
+	except Exception:
+		logger.exception('Could not close the async upstream sessions')
+
+def submit(coro):
+	"""
+	Start the coroutine `coro` on the upstream loop, and return a `concurrent.futures.Future` for its result.
+
+	The coroutine runs in a copy of the caller's context, so it sees the caller's Flask app and request context
+	(and `ebay_tokens.acting_as()`). The caller should wait for it before leaving those.
+	"""
+	return asyncio.run_coroutine_threadsafe( coro, upstream_loop() )
+
+def run(coro):
+	"""Run `coro` on the upstream loop and wait for its result, from sync code (a job, say)."""
+	return submit(coro).result()
+
+async def call(coro):
+	"""Run `coro` on the upstream loop and await its result, from a coroutine on some other loop (an async view)."""
+	return await asyncio.wrap_future( submit(coro) )
+
+def _get_client(name, factory):
+	with _lock:
+		if name not in _clients:
+			_clients[name] = factory()
+			logger.debug('Created {} async upstream client with pool size {}'.format(name, _clients[name].pool_size))
+		return _clients[name]
+
+def shopify_async_client():
+	"""The async client for the Shopify Admin API, configured like `upstream.shopify_client()`."""
+	return _get_client('shopify', lambda: AsyncUpstreamClient(
+		'shopify',
+		pool_size=app.config.get('UPSTREAM_POOL_SIZE', 10),
+		headers={'Accept': 'application/json'},
+		auth=(app.config['SHOPIFY_API_KEY'], app.config['SHOPIFY_API_PW']),
+		limiter=ShopifyRateLimit( ratelimit_path(), headroom=app.config.get('SHOPIFY_RATE_LIMIT_HEADROOM', 2) )
+		))
+
+def ebay_async_client():
+	"""The async client for the eBay APIs, configured like `upstream.ebay_client()`."""
+	return _get_client('ebay', lambda: AsyncUpstreamClient(
+		'ebay',
+		pool_size=app.config.get('UPSTREAM_POOL_SIZE', 10),
+		headers={'Accept': 'application/json', 'Content-Language': 'en-US'},
+		limiter=EbayRateLimit(
+			ratelimit_path(),
+			per_second=app.config.get('EBAY_RATE_LIMIT_PER_SEC', 5),
+			burst=app.config.get('EBAY_RATE_LIMIT_BURST', 10)	)
+		))
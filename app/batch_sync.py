@@ -0,0 +1,254 @@
+import os
+import time
+import uuid
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from flask import current_app as app
+
+import localdb
+import sku_index
+import fingerprints
+import mapping
+import glitchlab_shopify
+from fanout import in_context
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.batch-sync')
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+	id				TEXT PRIMARY KEY,
+	started_at		REAL,
+	finished_at		REAL		-- NULL until every product is done or has used up its attempts
+);
+CREATE TABLE IF NOT EXISTS run_products (
+	run_id			TEXT,
+	product_id		INTEGER,
+	sku				TEXT,
+	status			TEXT,		-- see the STATUS_* constants
+	error			TEXT,
+	attempts		INTEGER DEFAULT 0,	-- how many times it has failed
+	updated_at		REAL,
+	PRIMARY KEY (run_id, product_id)
+);
+CREATE INDEX IF NOT EXISTS run_products_status ON run_products (run_id, status);
+'''
+
+"""What happened to each product in a run"""
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'			# written to eBay (or nothing needed writing)
+STATUS_MISSING = 'missing'		# eBay has no item or group with the product's ebay_sku
+STATUS_UNCHANGED = 'unchanged'	# incremental run: same fingerprint as what we pushed last time, so eBay wasn't asked
+STATUS_FAILED = 'failed'		# tried it and got an error; a resumed run tries it again, up to MAX_ATTEMPTS times
+
+"""A product that has failed this many times is left failed, so one broken product can't keep a run open forever"""
+MAX_ATTEMPTS = 3
+
+"""The Shopify product metafield holding the product's eBay SKU (the UI's "link" button writes it)"""
+EBAY_SKU_METAFIELD = 'ebay_sku'
+
+class Checkpoint(object):
+	"""
+	Progress of catalog-wide sync runs, in SQLite, so a run that dies part-way can pick up where it left off.
+
+	A run starts by recording every (product, eBay SKU) pair it's going to sync as pending. Each product's outcome
+	is recorded as soon as it's known, so resuming only costs the products that were in flight at the time.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def start(self, pairs):
+		"""Start a run over `pairs`, a list of (product_id, sku). Returns the run ID."""
+		run_id = uuid.uuid4().hex
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			conn.execute('INSERT INTO runs (id, started_at) VALUES (?, ?)', (run_id, now))
+			conn.executemany(
+				'INSERT OR REPLACE INTO run_products (run_id, product_id, sku, status, updated_at) VALUES (?, ?, ?, ?, ?)',
+				[(run_id, int(pid), sku, STATUS_PENDING, now) for pid, sku in pairs] )
+		return run_id
+
+	def unfinished(self):
+		"""The ID of the most recent run that didn't finish (was interrupted, or has failures left to retry), or None."""
+		row = self.conn.execute('SELECT id FROM runs WHERE finished_at IS NULL ORDER BY started_at DESC LIMIT 1').fetchone()
+		return row['id'] if row is not None else None
+
+	def todo(self, run_id):
+		"""The (product_id, sku) pairs in `run_id` that still need doing: pending, or failed fewer than MAX_ATTEMPTS times."""
+		rows = self.conn.execute(
+			'SELECT product_id, sku FROM run_products WHERE run_id = ? AND (status = ? OR (status = ? AND attempts < ?)) ORDER BY product_id',
+			(run_id, STATUS_PENDING, STATUS_FAILED, MAX_ATTEMPTS) ).fetchall()
+		return [(row['product_id'], row['sku']) for row in rows]
+
+	def record(self, run_id, product_id, status, error=None):
+		self.conn.execute(
+			'UPDATE run_products SET status = ?, error = ?, attempts = attempts + ?, updated_at = ? WHERE run_id = ? AND product_id = ?',
+			(status, error, 1 if status == STATUS_FAILED else 0, time.time(), run_id, int(product_id)) )
+
+	def finish(self, run_id):
+		"""Mark `run_id` finished if nothing in it is left to do. Returns whether it is."""
+		if len(self.todo(run_id)) > 0:
+			return False
+		self.conn.execute('UPDATE runs SET finished_at = ? WHERE id = ?', (time.time(), run_id))
+		return True
+
+	def summary(self, run_id):
+		"""{'run_id', 'started_at', 'finished_at', status: count..., 'errors': [{product_id, sku, error}] (first 20)}"""
+		conn = self.conn
+		run = conn.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+		s = {'run_id': run_id, 'started_at': run['started_at'], 'finished_at': run['finished_at']}
+		for row in conn.execute('SELECT status, COUNT(*) AS n FROM run_products WHERE run_id = ? GROUP BY status', (run_id,)):
+			s[row['status']] = row['n']
+		s['errors'] = [dict(row) for row in conn.execute(
+			'SELECT product_id, sku, error FROM run_products WHERE run_id = ? AND status = ? ORDER BY product_id LIMIT 20',
+			(run_id, STATUS_FAILED) )]
+		return s
+
+def checkpoint_path():
+	return os.path.join(app.config['DATA_DIR'], 'batch-sync.sqlite3')
+
+def linked_products():
+	"""Every Shopify product linked to an eBay SKU, as a list of (product_id, sku), in product ID order."""
+	pairs = []
+	for pid, sku in glitchlab_shopify.iter_shopify_product_metafield( EBAY_SKU_METAFIELD ):
+		sku = (sku or '').strip()
+		if sku != '':
+			pairs.append( (pid, sku) )
+	return sorted(pairs)
+
+def sync_product(product_id, sku, incremental=False):
+	"""
+	Push one Shopify product to its eBay SKU, which can be an inventory item or an inventory item group, mapped by
+	`mapping.get_mapping()`. Writes only if something changed. Returns STATUS_DONE or STATUS_MISSING; anything else raises.
+
+	If `incremental`, first compare the fingerprint of what we'd push with the one from the last push (see
+	fingerprints.py), and return STATUS_UNCHANGED without touching eBay if they match.
+	"""
+	p = glitchlab_shopify.get_shopify_product( str(product_id) )
+	if not isinstance(p, dict):
+		raise RuntimeError('Could not load Shopify product {}: {}'.format(product_id, p))
+	payloads = mapping.get_mapping().transform( [p['product']], kinds=('item', 'group') )[0]
+	item, group = payloads['item'], payloads['group']
+	item_fp = fingerprints.fingerprint( item )
+	group_fp = fingerprints.fingerprint( group )
+
+	pushed = fingerprints.get_store()
+	if incremental and (	pushed.get(glitchlab_shopify.EBAY_ITEM, sku) == item_fp
+						or	pushed.get(glitchlab_shopify.EBAY_GROUP, sku) == group_fp ):
+		return STATUS_UNCHANGED
+
+	# Try what the SKU index says it is first, so known groups don't cost a getInventoryItem 404 each
+	index = sku_index.get_sku_index()
+	writers = [
+		(sku_index.INVENTORY_ITEM, glitchlab_shopify.EBAY_ITEM, item_fp,
+			lambda: glitchlab_shopify.set_ebay_attributes( sku, item )),
+		(sku_index.INVENTORY_ITEM_GROUP, glitchlab_shopify.EBAY_GROUP, group_fp,
+			lambda: glitchlab_shopify.set_ebay_inventoryitemgroup( sku, group ))
+		]
+	known_type = index.lookup(sku)
+	if known_type == sku_index.UNKNOWN:
+		return STATUS_MISSING
+	if known_type == sku_index.INVENTORY_ITEM_GROUP:
+		writers.reverse()
+	for sku_type, kind, fp, write in writers:
+		try:
+			write()
+		except glitchlab_shopify.ItemNotFoundError:
+			continue
+		index.learn( sku, sku_type )
+		pushed.put( kind, sku, fp )
+		return STATUS_DONE
+	index.learn( sku, sku_index.UNKNOWN )
+	return STATUS_MISSING
+
+def _process_init(config):
+	"""Set up a pool process: the same app config as the parent, and an app context for its whole life."""
+	import synctool
+	synctool.app.config.update(config)
+	synctool.app.app_context().push()
+
+def _sync_product_in_process(pair, incremental):
+	return sync_product(*pair, incremental=incremental)
+
+def run(workers=8, processes=False, restart=False, incremental=False, checkpoint_file=None, progress=None):
+	"""
+	Sync every linked Shopify product to eBay, `workers` products at a time, on threads or (`processes`) in
+	separate processes. Progress is kept in `checkpoint_file` (default DATA_DIR/batch-sync.sqlite3), and the last
+	unfinished run in it is resumed unless `restart` is True. `progress(done, total)` is called as products finish.
+	Returns the run's summary. Runs as the background account (EBAY_BACKGROUND_ACCOUNT), and raises
+	glitchlab_shopify.AuthenticationError if there isn't one.
+
+	With `incremental`, products whose eBay payload hasn't changed since we last pushed it are skipped without
+	asking eBay (see `sync_product()`). Shopify products mostly come out of the local catalog store, so a nightly
+	incremental run only talks to eBay about the handful of products that actually changed.
+
+	Every worker shares the rate limiters and token store in DATA_DIR, so adding workers can't push eBay or Shopify
+	past their limits - past a point it just adds waiting.
+	"""
+	glitchlab_shopify.ebay_auth_token()		# no point walking the catalog if every write is going to fail
+
+	checkpoint = Checkpoint( checkpoint_file or checkpoint_path() )
+	run_id = None if restart else checkpoint.unfinished()
+	if run_id is None:
+		pairs = linked_products()
+		run_id = checkpoint.start(pairs)
+		logger.info('Starting batch sync {} over {} linked products'.format(run_id, len(pairs)))
+	else:
+		logger.info('Resuming batch sync {}'.format(run_id))
+	todo = checkpoint.todo(run_id)
+
+	if processes:
+		config = {k: v for k, v in app.config.items() if k.isupper()}
+		pool = ProcessPoolExecutor(
+			max_workers=workers,
+			mp_context=multiprocessing.get_context('spawn'),
+			initializer=_process_init,
+			initargs=(config,) )
+		submit = lambda pair: pool.submit( _sync_product_in_process, pair, incremental )
+	else:
+		pool = ThreadPoolExecutor(max_workers=workers)
+		submit = lambda pair: pool.submit( in_context(sync_product), *pair, incremental=incremental )
+
+	with pool:
+		futures = {submit(pair): pair for pair in todo}
+		recorded = set()
+		try:
+			for n, f in enumerate(as_completed(futures)):
+				product_id, sku = futures[f]
+				e = f.exception()
+				if e is None:
+					checkpoint.record( run_id, product_id, f.result() )
+				else:
+					message = getattr(e, 'message', None) or str(e)
+					logger.warning('Batch sync of product {} to eBay SKU {} failed: {}'.format(product_id, sku, message))
+					checkpoint.record( run_id, product_id, STATUS_FAILED, message )
+				recorded.add(f)
+				if progress is not None:
+					progress(n + 1, len(todo))
+		except KeyboardInterrupt:
+			# Don't start anything that's still queued (shutdown(cancel_futures=True) is 3.9+), let the products in
+			# flight finish, and check off the ones that made it so the next run doesn't redo them. Failures are left
+			# pending - they were probably interrupted too, and shouldn't use up an attempt.
+			logger.warning('Batch sync {} interrupted; waiting for the products in flight'.format(run_id))
+			for f in futures:
+				f.cancel()
+			pool.shutdown(wait=True)
+			for f in futures:
+				if f not in recorded and f.done() and not f.cancelled() and f.exception() is None:
+					checkpoint.record( run_id, futures[f][0], f.result() )
+			raise
+
+	if not checkpoint.finish(run_id):
+		logger.warning('Batch sync {} left products unsynced; run it again to retry them'.format(run_id))
+	summary = checkpoint.summary(run_id)
+	if summary['finished_at'] is not None and summary.get(STATUS_FAILED):
+		logger.warning('Batch sync {} gave up on {} products after {} attempts each'.format(run_id, summary[STATUS_FAILED], MAX_ATTEMPTS))
+	return summary
@@ -0,0 +1,128 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.cache')
+logger.setLevel(logging.DEBUG)
+
+class TTLCache(object):
+	"""
+	A thread-safe in-process cache with a time-to-live and least-recently-used eviction.
+
+	Entries older than `ttl` seconds are treated as missing. Once there are more than `maxsize` entries, the
+	least recently used one is dropped.
+
+	Every key also has a generation number that goes up each time the key is invalidated. A reader that
+	fetches a value from upstream should note `generation(key)` before the fetch and pass it to `put()`. If a
+	write invalidated the key in the meantime, the (now stale) value is quietly dropped instead of cached.
+
+	Keeps hit/miss/eviction counters; see `stats()`.
+	"""
+
+	def __init__(self, name, maxsize=256, ttl=300):
+		self.name = name
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self._entries = OrderedDict()		# key => (stored_at, value)
+		self._generations = {}
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		self.invalidations = 0
+		self.stale_puts = 0
+		_register(self)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key, max_age=None):
+		"""
+		Return the cached value for `key`, or None if it's missing or older than the TTL. Pass `max_age` (seconds)
+		to be stricter than the TTL for this one lookup.
+		"""
+		limit = self.ttl if max_age is None else min(max_age, self.ttl)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			stored_at, value = entry
+			if time.time() - stored_at > limit:
+				if time.time() - stored_at > self.ttl:
+					del self._entries[key]
+					self.expirations += 1
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return value
+
+	def generation(self, key):
+		"""The current generation of `key`. See the class docstring."""
+		with self._lock:
+			return self._generations.get(key, 0)
+
+	def put(self, key, value, generation=None):
+		"""
+		Cache `value` under `key`. If `generation` is given and `key` has been invalidated since it was read,
+		don't cache anything. Returns True if the value was cached.
+		"""
+		with self._lock:
+			if generation is not None and self._generations.get(key, 0) != generation:
+				self.stale_puts += 1
+				return False
+			self._entries[key] = (time.time(), value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+				self.evictions += 1
+			return True
+
+	def invalidate(self, key):
+		"""Drop `key` from the cache, and make sure reads already in flight for it don't put it back."""
+		with self._lock:
+			self._generations[key] = self._generations.get(key, 0) + 1
+			if self._entries.pop(key, None) is not None:
+				self.invalidations += 1
+
+	def clear(self):
+		with self._lock:
+			for key in self._entries:
+				self._generations[key] = self._generations.get(key, 0) + 1
+			self._entries.clear()
+
+	def stats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'name': self.name,
+				'size': len(self._entries),
+				'maxsize': self.maxsize,
+				'ttl': self.ttl,
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_rate': float(self.hits) / lookups if lookups > 0 else None,
+				'evictions': self.evictions,
+				'expirations': self.expirations,
+				'invalidations': self.invalidations,
+				'stale_puts': self.stale_puts
+				}
+
+"""Every cache created in this process, for the stats endpoint"""
+_caches = []
+_caches_lock = threading.Lock()
+
+def _register(c):
+	with _caches_lock:
+		_caches.append(c)
+
+def all_stats():
+	"""Stats for every TTLCache in this process."""
+	with _caches_lock:
+		caches = list(_caches)
+	return {c.name: c.stats() for c in caches}
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import logging
+import datetime
+from flask import current_app as app
+
+import localdb
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.catalog-store')
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS products (
+	id				INTEGER PRIMARY KEY,
+	updated_at		TEXT,			-- Shopify's updated_at for the version we hold
+	complete		INTEGER,		-- 1 if we hold the metafields too (a full get_shopify_product() load)
+	stored_at		REAL,			-- when we last wrote this row (unix time)
+	body			TEXT			-- JSON, same shape as get_shopify_product() returns
+);
+CREATE TABLE IF NOT EXISTS variants (
+	inventory_item_id	INTEGER PRIMARY KEY,
+	product_id			INTEGER,
+	variant_id			INTEGER
+);
+CREATE INDEX IF NOT EXISTS variants_product ON variants (product_id);
+CREATE TABLE IF NOT EXISTS inventory_levels (
+	inventory_item_id	INTEGER,
+	location_id			INTEGER,
+	available			INTEGER,
+	updated_at			TEXT,
+	PRIMARY KEY (inventory_item_id, location_id)
+);
+CREATE TABLE IF NOT EXISTS invalidations (
+	product_id			INTEGER PRIMARY KEY,
+	generation			INTEGER			-- bumped by every invalidate(), see generation()
+);
+'''
+
+def parse_shopify_time(s):
+	"""Parse one of Shopify's ISO 8601 timestamps into an aware datetime, or None."""
+	if not s:
+		return None
+	if s.endswith('Z'):
+		s = s[:-1] + '+00:00'
+	try:
+		return datetime.datetime.fromisoformat(s)
+	except ValueError:
+		return None
+
+def is_older(incoming, stored):
+	"""True if timestamp string `incoming` is strictly older than `stored` (unknown timestamps never count as older)."""
+	a, b = parse_shopify_time(incoming), parse_shopify_time(stored)
+	return a is not None and b is not None and a < b
+
+def _int_keys(p):
+	"""JSON turns the integer variant IDs into strings; turn them back so stored products match fresh loads."""
+	variants = p['product'].get('variants')
+	if isinstance(variants, dict):
+		p['product']['variants'] = {int(k): v for k, v in variants.items()}
+	return p
+
+class ProductStore(object):
+	"""
+	A local mirror of the Shopify catalog in SQLite, shared by every worker process.
+
+	Rows come from two places: full product loads (`put()`, which includes metafields) and Shopify webhooks
+	(`apply_product()`, `delete()`, `apply_inventory_level()`), which keep rows fresh as the catalog changes.
+	Webhook payloads don't include metafields, so a product first seen through a webhook is stored as incomplete
+	and isn't served by `get()` until it has been loaded in full once; after that, webhooks update it in place and
+	keep the metafields we already have.
+
+	Webhooks can arrive late or more than once, so an update older than the row we hold is ignored.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def _row(self, conn, product_id):
+		return conn.execute('SELECT * FROM products WHERE id = ?', (int(product_id),)).fetchone()
+
+	def get(self, product_id, max_age=None):
+		"""
+		Return the stored product (same dict as `get_shopify_product()`), or None if we don't have a complete copy
+		or it was last written more than `max_age` seconds ago.
+		"""
+		row = self._row(self.conn, product_id)
+		if row is None or not row['complete']:
+			return None
+		if max_age is not None and time.time() - row['stored_at'] > max_age:
+			return None
+		return _int_keys( json.loads(row['body']) )
+
+	def put(self, p, generation=None):
+		"""
+		Store a full product load (the dict from `get_shopify_product()`, with metafields). Pass the `generation()`
+		from before the load started: if the product was invalidated since, the load may predate our write, so it
+		isn't stored. Returns True if it was.
+		"""
+		product = p['product']
+		with localdb.transaction(self.conn) as conn:
+			if generation is not None and self._generation(conn, product['id']) != generation:
+				logger.debug('Not storing product {}: it was written while we were loading it'.format(product['id']))
+				return False
+			row = self._row(conn, product['id'])
+			if row is not None and is_older(product.get('updated_at'), row['updated_at']):
+				logger.debug('Not storing product {}: we already hold a newer version'.format(product['id']))
+				return False
+			self._write(conn, p, complete=True)
+		return True
+
+	def _write(self, conn, p, complete):
+		product = p['product']
+		conn.execute(
+			'INSERT OR REPLACE INTO products (id, updated_at, complete, stored_at, body) VALUES (?, ?, ?, ?, ?)',
+			(int(product['id']), product.get('updated_at'), 1 if complete else 0, time.time(), json.dumps(p)) )
+		conn.execute('DELETE FROM variants WHERE product_id = ?', (int(product['id']),))
+		for v in (product.get('variants') or {}).values():
+			if v.get('inventory_item_id') is not None:
+				conn.execute(
+					'INSERT OR REPLACE INTO variants (inventory_item_id, product_id, variant_id) VALUES (?, ?, ?)',
+					(int(v['inventory_item_id']), int(product['id']), int(v['id'])) )
+
+	def apply_product(self, payload):
+		"""
+		Apply a products/create or products/update webhook. `payload` is Shopify's REST product JSON (variants as a
+		list, no metafields). Returns True if the store changed.
+		"""
+		pid = int(payload['id'])
+		with localdb.transaction(self.conn) as conn:
+			row = self._row(conn, pid)
+			old = None
+			if row is not None:
+				if is_older(payload.get('updated_at'), row['updated_at']):
+					logger.debug('Ignoring stale webhook for product {}'.format(pid))
+					return False
+				old = _int_keys( json.loads(row['body']) )['product']
+
+			product = dict(payload)
+			product['variants'] = {}
+			for v in payload.get('variants') or []:
+				v = dict(v)
+				if old is not None and v['id'] in old['variants']:
+					v['metafields'] = old['variants'][v['id']].get('metafields', {})
+				product['variants'][v['id']] = v
+			complete = old is not None and bool(row['complete'])
+			if old is not None:
+				product['metafields'] = old.get('metafields', {})
+
+			self._write(conn, {'product': product}, complete=complete)
+		return True
+
+	def delete(self, product_id):
+		"""Apply a products/delete webhook."""
+		with localdb.transaction(self.conn) as conn:
+			conn.execute('DELETE FROM products WHERE id = ?', (int(product_id),))
+			conn.execute('DELETE FROM variants WHERE product_id = ?', (int(product_id),))
+
+	def invalidate(self, product_id):
+		"""
+		Mark a product as needing a full reload (e.g. we just wrote its metafields). Webhooks keep updating it in
+		the meantime, but `get()` won't serve it, and loads that were already running won't be stored (see `put()`).
+		"""
+		with localdb.transaction(self.conn) as conn:
+			conn.execute('UPDATE products SET complete = 0 WHERE id = ?', (int(product_id),))
+			conn.execute(
+				'INSERT OR REPLACE INTO invalidations (product_id, generation) VALUES (?, ?)',
+				(int(product_id), self._generation(conn, product_id) + 1) )
+
+	def _generation(self, conn, product_id):
+		row = conn.execute('SELECT generation FROM invalidations WHERE product_id = ?', (int(product_id),)).fetchone()
+		return row['generation'] if row is not None else 0
+
+	def generation(self, product_id):
+		"""How many times `product_id` has been invalidated. Note it before loading a product and pass it to `put()`, like `TTLCache`."""
+		return self._generation(self.conn, product_id)
+
+	def product_id_for_inventory_item(self, inventory_item_id):
+		"""The ID of the product a Shopify inventory item (i.e. variant) belongs to, or None if we don't know it."""
+		row = self.conn.execute(
+			'SELECT product_id FROM variants WHERE inventory_item_id = ?', (int(inventory_item_id),) ).fetchone()
+		return row['product_id'] if row is not None else None
+
+	def apply_inventory_level(self, payload):
+		"""
+		Apply an inventory_levels/update webhook ({inventory_item_id, location_id, available, updated_at}).
+
+		The variant's `inventory_quantity` becomes the sum of the levels we've heard about for its inventory item,
+		which is exact for a single-location shop. Returns the ID of the product that changed, or None if we don't
+		know which product the inventory item belongs to.
+		"""
+		item_id = int(payload['inventory_item_id'])
+		with localdb.transaction(self.conn) as conn:
+			level = conn.execute(
+				'SELECT updated_at FROM inventory_levels WHERE inventory_item_id = ? AND location_id = ?',
+				(item_id, int(payload['location_id'])) ).fetchone()
+			if level is not None and is_older(payload.get('updated_at'), level['updated_at']):
+				return None
+			conn.execute(
+				'INSERT OR REPLACE INTO inventory_levels (inventory_item_id, location_id, available, updated_at) VALUES (?, ?, ?, ?)',
+				(item_id, int(payload['location_id']), payload.get('available'), payload.get('updated_at')) )
+
+			v = conn.execute('SELECT product_id, variant_id FROM variants WHERE inventory_item_id = ?', (item_id,)).fetchone()
+			if v is None:
+				return None
+			row = self._row(conn, v['product_id'])
+			if row is None:
+				return None
+			total = conn.execute(
+				'SELECT SUM(available) AS total FROM inventory_levels WHERE inventory_item_id = ?', (item_id,) ).fetchone()['total']
+
+			p = _int_keys( json.loads(row['body']) )
+			variant = p['product']['variants'].get(v['variant_id'])
+			if variant is None:
+				return None
+			variant['inventory_quantity'] = total
+			variant['old_inventory_quantity'] = total
+			conn.execute('UPDATE products SET body = ?, stored_at = ? WHERE id = ?', (json.dumps(p), time.time(), v['product_id']))
+			return v['product_id']
+
+	def stats(self):
+		row = self.conn.execute('SELECT COUNT(*) AS total, SUM(complete) AS complete FROM products').fetchone()
+		return {'products': row['total'], 'complete': row['complete'] or 0}
+
+def get_store():
+	"""The product store for this app, in DATA_DIR."""
+	return ProductStore( os.path.join(app.config['DATA_DIR'], 'catalog.sqlite3') )
@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from flask import current_app as app
+
+import localdb
+import ebay_tokens
+import fanout
+import glitchlab_shopify
+from upstream import ebay_client
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.ebay-mirror')
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+	sku					TEXT PRIMARY KEY,
+	body				TEXT,		-- JSON, as getInventoryItems lists it
+	seen_in				TEXT,		-- ID of the last sync that saw it
+	offers_synced_at	REAL,		-- when we last fetched its offers (NULL: never)
+	stale				REAL		-- when we last wrote to it (or its offers), if that was since it was synced; else 0
+);
+CREATE TABLE IF NOT EXISTS offers (
+	offer_id			TEXT PRIMARY KEY,
+	sku					TEXT,
+	body				TEXT
+);
+CREATE INDEX IF NOT EXISTS offers_sku ON offers (sku);
+CREATE TABLE IF NOT EXISTS groups (
+	key					TEXT PRIMARY KEY,
+	body				TEXT,
+	seen_in				TEXT,
+	stale				REAL
+);
+CREATE TABLE IF NOT EXISTS syncs (
+	id					TEXT PRIMARY KEY,
+	started_at			REAL,
+	finished_at			REAL,		-- NULL while running, or if it died
+	full				INTEGER,
+	items				INTEGER,
+	changed_items		INTEGER,
+	deleted_items		INTEGER,
+	offer_fetches		INTEGER,
+	groups				INTEGER,
+	error				TEXT
+);
+CREATE TABLE IF NOT EXISTS lease (
+	name				TEXT PRIMARY KEY,
+	holder				TEXT,
+	until				REAL
+);
+'''
+
+"""getInventoryItems returns at most this many items per page"""
+EBAY_INVENTORY_PAGE_SIZE = 200
+
+class SyncError(Exception):
+	def __init__(self, message):
+		self.message = message
+
+class EbayMirror(object):
+	"""
+	A local copy of the whole eBay inventory (items, item groups and offers) in SQLite, shared by every worker.
+
+	`sync()` pages through getInventoryItems, 200 items a call, and stores every item. eBay can't list offers or
+	groups account-wide, so those are fetched per SKU and per group - but only for items that are new or changed
+	since the last sync, plus items whose offers are older than `offers_max_age` (a price change on eBay doesn't
+	change the item). Items and groups a sync no longer sees are deleted.
+
+	`/api/ebay/product` serves loads from here while the last sync is younger than `max_age`. Anything we write
+	through glitchlab_shopify is marked stale and served live until the next sync picks it up.
+	"""
+
+	def __init__(self, path, max_age=3600, offers_max_age=86400, lease=600):
+		self.path = path
+		self.max_age = max_age
+		self.offers_max_age = offers_max_age
+		self.lease = lease
+		self.served = 0
+		self._syncer = None
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	## Reading
+
+	def last_sync(self):
+		"""The last sync that finished without an error, as a dict, or None."""
+		row = self.conn.execute(
+			'SELECT * FROM syncs WHERE finished_at IS NOT NULL AND error IS NULL ORDER BY started_at DESC LIMIT 1' ).fetchone()
+		return dict(row) if row is not None else None
+
+	def is_fresh(self):
+		"""True if the last good sync started less than `max_age` seconds ago."""
+		if self.max_age <= 0:
+			return False
+		last = self.last_sync()
+		return last is not None and time.time() - last['started_at'] < self.max_age
+
+	def item(self, sku):
+		"""The stored item for `sku` with its offers, as `/api/ebay/product` returns it, or None."""
+		conn = self.conn
+		row = conn.execute('SELECT * FROM items WHERE sku = ?', (sku,)).fetchone()
+		if row is None or row['stale'] or row['offers_synced_at'] is None:
+			return None
+		item = json.loads(row['body'])
+		item['offers'] = [json.loads(o['body']) for o in conn.execute('SELECT body FROM offers WHERE sku = ? ORDER BY offer_id', (sku,))]
+		item['_gl_ebay_type'] = 'inventoryitem'
+		return item
+
+	def group(self, key):
+		"""The stored item group `key` with its variants, as `/api/ebay/product` returns it, or None."""
+		conn = self.conn
+		row = conn.execute('SELECT * FROM groups WHERE key = ?', (key,)).fetchone()
+		if row is None or row['stale']:
+			return None
+		group = json.loads(row['body'])
+		if 'variantSKUs' in group:
+			group['variants'] = {}
+			for vsku in group['variantSKUs']:
+				v = conn.execute('SELECT body, stale FROM items WHERE sku = ?', (vsku,)).fetchone()
+				if v is None or v['stale']:
+					return None		# don't serve a group with a variant we can't vouch for
+				group['variants'][vsku] = json.loads(v['body'])
+		group['_gl_ebay_type'] = 'inventoryitemgroup'
+		group['sku'] = key
+		return group
+
+	def product(self, sku):
+		"""
+		The `/api/ebay/product` reply for `sku` (an item or an item group) if the mirror is fresh and holds an
+		up-to-date copy, else None.
+		"""
+		if not self.is_fresh():
+			return None
+		p = self.item(sku) or self.group(sku)
+		if p is not None:
+			self.served += 1
+		return p
+
+	def skus(self):
+		"""Every SKU in the mirror, in order."""
+		return [row['sku'] for row in self.conn.execute('SELECT sku FROM items ORDER BY sku')]
+
+	def offer_ids(self, sku):
+		"""
+		The IDs of the offers for `sku` as of the last time we fetched them, or None if we never did. Offer IDs don't
+		change when an offer is written, so these are good even while the item is stale.
+		"""
+		conn = self.conn
+		row = conn.execute('SELECT offers_synced_at FROM items WHERE sku = ?', (sku,)).fetchone()
+		if row is None or row['offers_synced_at'] is None:
+			return None
+		return [o['offer_id'] for o in conn.execute('SELECT offer_id FROM offers WHERE sku = ? ORDER BY offer_id', (sku,))]
+
+	def group_variant_skus(self, key):
+		"""The `variantSKUs` of item group `key`, or None if we don't have an up-to-date copy of it."""
+		row = self.conn.execute('SELECT body, stale FROM groups WHERE key = ?', (key,)).fetchone()
+		if row is None or row['stale']:
+			return None
+		return json.loads(row['body']).get('variantSKUs', [])
+
+	def invalidate(self, kind, key):
+		"""Stop serving an object until the next sync, because we just wrote it. `kind` is one of glitchlab_shopify's EBAY_* kinds."""
+		conn = self.conn
+		now = time.time()
+		if kind == glitchlab_shopify.EBAY_ITEM:
+			conn.execute('UPDATE items SET stale = ? WHERE sku = ?', (now, key))
+		elif kind == glitchlab_shopify.EBAY_GROUP:
+			conn.execute('UPDATE groups SET stale = ? WHERE key = ?', (now, key))
+		elif kind == glitchlab_shopify.EBAY_OFFER:
+			conn.execute('UPDATE items SET stale = ? WHERE sku IN (SELECT sku FROM offers WHERE offer_id = ?)', (now, key))
+
+	## Syncing
+
+	def _take_lease(self, holder):
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			row = conn.execute("SELECT holder, until FROM lease WHERE name = 'sync'").fetchone()
+			if row is not None and row['until'] > now and row['holder'] != holder:
+				return False
+			conn.execute("INSERT OR REPLACE INTO lease (name, holder, until) VALUES ('sync', ?, ?)", (holder, now + self.lease))
+		return True
+
+	def _drop_lease(self, holder):
+		self.conn.execute("DELETE FROM lease WHERE name = 'sync' AND holder = ?", (holder,))
+
+	def sync(self, full=False):
+		"""
+		Bring the mirror up to date with eBay. `full` refetches every item's offers, not just the ones that are due.
+		Returns the sync's stats dict. Raises SyncError if another sync is already running, or if eBay fails us
+		(what was stored so far is kept, but nothing is deleted and the mirror isn't marked fresh).
+		"""
+		sync_id = uuid.uuid4().hex
+		if not self._take_lease(sync_id):
+			raise SyncError('Another eBay mirror sync is already running')
+
+		stats = {'id': sync_id, 'started_at': time.time(), 'finished_at': None, 'full': 1 if full else 0,
+			'items': 0, 'changed_items': 0, 'deleted_items': 0, 'offer_fetches': 0, 'groups': 0, 'error': None}
+		self.conn.execute(
+			'INSERT INTO syncs (id, started_at, full) VALUES (?, ?, ?)', (sync_id, stats['started_at'], stats['full']) )
+		try:
+			auth_token = glitchlab_shopify.ebay_auth_token()
+			due_offers, group_keys = self._sync_items(auth_token, sync_id, full, stats)
+			self._sync_offers(due_offers, sync_id, stats)
+			self._sync_groups(auth_token, group_keys, sync_id, stats)
+			with localdb.transaction(self.conn) as conn:
+				stats['deleted_items'] = conn.execute('DELETE FROM items WHERE seen_in != ?', (sync_id,)).rowcount
+				conn.execute('DELETE FROM offers WHERE sku NOT IN (SELECT sku FROM items)')
+				conn.execute('DELETE FROM groups WHERE seen_in != ?', (sync_id,))
+		except (glitchlab_shopify.Error, RuntimeError, SyncError) as e:
+			stats['error'] = getattr(e, 'message', None) or str(e)
+			logger.error('eBay mirror sync failed: {}'.format(stats['error']))
+		except Exception as e:
+			# Anything else (a dropped connection, a malformed item) still has to keep this sync from counting as good
+			stats['error'] = '{}: {}'.format(type(e).__name__, e)
+			logger.exception('eBay mirror sync blew up')
+			raise
+		finally:
+			stats['finished_at'] = time.time()
+			self.conn.execute(
+				'UPDATE syncs SET finished_at = ?, items = ?, changed_items = ?, deleted_items = ?, offer_fetches = ?, groups = ?, error = ? WHERE id = ?',
+				(stats['finished_at'], stats['items'], stats['changed_items'], stats['deleted_items'], stats['offer_fetches'],
+					stats['groups'], stats['error'], sync_id) )
+			self._drop_lease(sync_id)
+
+		if stats['error'] is not None:
+			raise SyncError(stats['error'])
+		logger.info('eBay mirror synced: {items} items ({changed_items} changed, {deleted_items} deleted), {offer_fetches} offer fetches, {groups} groups'.format(**stats))
+		return stats
+
+	def _sync_items(self, auth_token, sync_id, full, stats):
+		"""Page through every inventory item. Returns (SKUs whose offers are due, group keys referenced)."""
+		url = app.config['EBAY_INVENTORYITEMS_URL']
+		offers_due_before = time.time() - self.offers_max_age
+		due_offers = []
+		group_keys = set()
+		offset = 0
+		while True:
+			fetched_at = time.time()
+			response = ebay_client().get( url, auth_token=auth_token, params={'limit': EBAY_INVENTORY_PAGE_SIZE, 'offset': offset} )
+			try:
+				j = response.json()
+			except ValueError:
+				raise SyncError('Weird reply from eBay getInventoryItems: {}'.format(response.text))
+			glitchlab_shopify.handle_ebay_errors( j )
+			page = j.get('inventoryItems', [])
+
+			with localdb.transaction(self.conn) as conn:
+				for item in page:
+					sku = item['sku']
+					body = json.dumps(item, sort_keys=True)
+					group_keys.update( item.get('groupIds', []) )
+					row = conn.execute('SELECT body, offers_synced_at, stale FROM items WHERE sku = ?', (sku,)).fetchone()
+					if row is not None and row['stale'] and row['stale'] >= fetched_at:
+						# We wrote it after this page was fetched, so the page is out of date. Leave it stale for the next sync.
+						conn.execute('UPDATE items SET seen_in = ? WHERE sku = ?', (sync_id, sku))
+						continue
+					changed = row is None or row['body'] != body or row['stale']
+					if changed:
+						# Not served again until its offers have been fetched too
+						stats['changed_items'] += 1
+						conn.execute(
+							'INSERT OR REPLACE INTO items (sku, body, seen_in, offers_synced_at, stale) VALUES (?, ?, ?, NULL, 0)',
+							(sku, body, sync_id) )
+						due_offers.append(sku)
+					else:
+						conn.execute('UPDATE items SET seen_in = ? WHERE sku = ?', (sync_id, sku))
+						if full or row['offers_synced_at'] is None or row['offers_synced_at'] < offers_due_before:
+							due_offers.append(sku)
+			stats['items'] += len(page)
+			self._take_lease(sync_id)		# still going
+
+			offset += len(page)
+			if len(page) == 0 or offset >= j.get('total', 0):
+				return due_offers, group_keys
+
+	def _sync_offers(self, skus, sync_id, stats):
+		for i in range(0, len(skus), EBAY_INVENTORY_PAGE_SIZE):
+			self._sync_offers_batch(skus[i:i + EBAY_INVENTORY_PAGE_SIZE], stats)
+			self._take_lease(sync_id)
+
+	def _sync_offers_batch(self, skus, stats):
+		def fetch(sku):
+			offers = glitchlab_shopify.get_ebay_offers( sku )
+			if not isinstance(offers, list):
+				raise SyncError('Weird reply from eBay getOffers for SKU {}'.format(sku))
+			return offers
+
+		for sku, offers, e in fanout.bounded_map( fetch, skus, app.config.get('EBAY_FETCH_CONCURRENCY', 8) ):
+			if isinstance(e, glitchlab_shopify.ItemNotFoundError):
+				offers = []
+			elif e is not None:
+				raise e
+			stats['offer_fetches'] += 1
+			with localdb.transaction(self.conn) as conn:
+				conn.execute('DELETE FROM offers WHERE sku = ?', (sku,))
+				conn.executemany(
+					'INSERT OR REPLACE INTO offers (offer_id, sku, body) VALUES (?, ?, ?)',
+					[(o['offerId'], sku, json.dumps(o)) for o in offers] )
+				conn.execute('UPDATE items SET offers_synced_at = ? WHERE sku = ?', (time.time(), sku))
+
+	def _sync_groups(self, auth_token, keys, sync_id, stats):
+		def fetch(key):
+			fetched_at = time.time()
+			return fetched_at, glitchlab_shopify.get_ebay_inventoryitemgroup( auth_token, key )
+
+		for key, result, e in fanout.bounded_map( fetch, sorted(keys), app.config.get('EBAY_FETCH_CONCURRENCY', 8) ):
+			if isinstance(e, glitchlab_shopify.ItemNotFoundError):
+				continue
+			elif e is not None:
+				raise e
+			fetched_at, group = result
+			stats['groups'] += 1
+			with localdb.transaction(self.conn) as conn:
+				row = conn.execute('SELECT stale FROM groups WHERE key = ?', (key,)).fetchone()
+				if row is not None and row['stale'] and row['stale'] >= fetched_at:
+					# Written after we fetched it - keep it stale rather than store what it was before
+					conn.execute('UPDATE groups SET seen_in = ? WHERE key = ?', (sync_id, key))
+					continue
+				conn.execute(
+					'INSERT OR REPLACE INTO groups (key, body, seen_in, stale) VALUES (?, ?, ?, 0)',
+					(key, json.dumps(group, sort_keys=True), sync_id) )
+
+	def start_sync(self, flask_app, full=False, account=None):
+		"""
+		Run `sync()` in a background thread, as eBay `account` (the background account if None). Returns False if
+		this worker is already running one.
+		"""
+		if self._syncer is not None and self._syncer.is_alive():
+			return False
+		def run():
+			with flask_app.app_context(), ebay_tokens.acting_as(account):
+				try:
+					self.sync(full=full)
+				except SyncError:
+					pass		# already logged
+				except Exception:
+					logger.exception('eBay mirror sync failed')
+
+		self._syncer = threading.Thread(target=run, name='ebay-mirror-sync', daemon=True)
+		self._syncer.start()
+		return True
+
+	def start_scheduler(self, flask_app, interval):
+		"""Sync every `interval` seconds in a background thread. The lease keeps workers from syncing at the same time."""
+		def run():
+			while True:
+				time.sleep(interval)
+				with flask_app.app_context():
+					if self.is_fresh() and time.time() - self.last_sync()['started_at'] < interval:
+						continue		# another worker just did it
+					try:
+						self.sync()
+					except SyncError:
+						pass
+					except Exception:
+						logger.exception('eBay mirror sync failed')
+
+		threading.Thread(target=run, name='ebay-mirror-scheduler', daemon=True).start()
+
+	def stats(self):
+		conn = self.conn
+		return {
+			'items': conn.execute('SELECT COUNT(*) AS n FROM items').fetchone()['n'],
+			'stale_items': conn.execute('SELECT COUNT(*) AS n FROM items WHERE stale > 0').fetchone()['n'],
+			'offers': conn.execute('SELECT COUNT(*) AS n FROM offers').fetchone()['n'],
+			'groups': conn.execute('SELECT COUNT(*) AS n FROM groups').fetchone()['n'],
+			'fresh': self.is_fresh(),
+			'served': self.served,
+			'syncing': self._syncer is not None and self._syncer.is_alive(),
+			'last_sync': self.last_sync()
+			}
+
+"""One mirror object per process, so each worker starts at most one scheduler"""
+_mirror = None
+_mirror_lock = threading.Lock()
+
+def get_mirror():
+	"""The eBay mirror for this app, in DATA_DIR. Starts the sync scheduler the first time, if there is one."""
+	global _mirror
+	with _mirror_lock:
+		if _mirror is None:
+			_mirror = EbayMirror(
+				os.path.join(app.config['DATA_DIR'], 'ebay-mirror.sqlite3'),
+				max_age=app.config.get('EBAY_MIRROR_MAX_AGE', 3600),
+				offers_max_age=app.config.get('EBAY_MIRROR_OFFERS_MAX_AGE', 86400) )
+			interval = app.config.get('EBAY_MIRROR_SYNC_INTERVAL', 0)
+			if interval > 0:
+				_mirror.start_scheduler( app._get_current_object(), interval )
+		return _mirror
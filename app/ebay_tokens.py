@@ -0,0 +1,314 @@
+import os
+import time
+import uuid
+import logging
+import datetime
+import threading
+import contextvars
+from flask import current_app as app
+from flask import session, has_request_context
+
+import localdb
+from upstream import ebay_client
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.ebay-tokens')
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tokens (
+	account				TEXT PRIMARY KEY,	-- random ID, kept in the user's session as 'ebay_account'
+	access_token		TEXT,
+	expires_at			REAL,		-- unix time the access token stops working
+	refresh_token		TEXT,
+	refresh_expires_at	REAL,
+	updated_at			REAL,
+	refreshing_until	REAL,		-- some worker is refreshing this token until then
+	error				TEXT		-- why the last refresh failed, if it did
+);
+'''
+
+"""Hand out an access token only if it has at least this many seconds left"""
+MIN_VALIDITY = 60
+
+class TokenError(Exception):
+	"""We don't have a usable eBay token: nobody has signed in, or eBay won't refresh it any more."""
+	def __init__(self, message):
+		self.message = message
+
+class TokenManager(object):
+	"""
+	eBay user tokens, kept server-side in a SQLite file shared by every worker.
+
+	Signing in through eBay's consent page creates an *account* here (a random ID, which goes in the user's
+	session) holding the access token and refresh token. `token()` hands out the account's access token; a
+	background thread (`start_refresher()`) refreshes tokens `refresh_margin` seconds before they expire, so
+	callers normally never wait for a refresh.
+
+	If a token does run out (the server was asleep, say), `token()` refreshes it on the spot. Refreshes are
+	single-flight: one thread in one worker talks to eBay, holding a lease in the database, while everyone
+	else waits for its result.
+
+	Background work that isn't on anyone's behalf (scheduled mirror syncs, webhook-driven stock updates, the CLI)
+	runs as `background_account`, if it's set - never just as whoever happened to sign in last.
+	"""
+
+	def __init__(self, path, refresh_margin=600, lease=30, background_account=None):
+		self.path = path
+		self.refresh_margin = refresh_margin
+		self.lease = lease
+		self.background_account = background_account
+		self.refreshes = 0
+		self.failed_refreshes = 0
+		self._locks = {}
+		self._locks_lock = threading.Lock()
+		self._refresher = None
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def _row(self, conn, account):
+		if account is None:
+			# No particular user (background work): use the account set up for that, if there is one
+			account = self.background_account
+			if account is None:
+				return None
+		return conn.execute('SELECT * FROM tokens WHERE account = ?', (account,)).fetchone()
+
+	def _lock(self, account):
+		with self._locks_lock:
+			if account not in self._locks:
+				self._locks[account] = threading.Lock()
+			return self._locks[account]
+
+	def save(self, auth_dict, account=None):
+		"""
+		Store the tokens from an eBay token reply (`auth_dict`), for `account` or a new account. Returns the
+		account ID.
+		"""
+		now = time.time()
+		if account is None:
+			account = uuid.uuid4().hex
+		self.conn.execute(
+			'INSERT OR REPLACE INTO tokens (account, access_token, expires_at, refresh_token, refresh_expires_at, updated_at, refreshing_until, error) '
+			'VALUES (?, ?, ?, ?, ?, ?, NULL, NULL)',
+			(	account,
+				auth_dict['access_token'],
+				now + auth_dict['expires_in'],
+				auth_dict.get('refresh_token'),
+				now + auth_dict['refresh_token_expires_in'] if 'refresh_token_expires_in' in auth_dict else None,
+				now	) )
+		return account
+
+	def token(self, account=None):
+		"""
+		Return a valid access token for `account` (or `background_account`, if None). Raises TokenError if
+		there isn't one and we can't get one.
+		"""
+		if account is None and self.background_account is None:
+			raise TokenError('No eBay account is set up for background work (see EBAY_BACKGROUND_ACCOUNT)')
+		row = self._row(self.conn, account)
+		if row is None:
+			raise TokenError('Nobody has signed in to eBay yet')
+		if row['expires_at'] - time.time() > MIN_VALIDITY:
+			return row['access_token']
+
+		logger.info('eBay access token for account {} has run out, refreshing it now'.format(row['account']))
+		return self.refresh(row['account'], margin=MIN_VALIDITY)
+
+	def refresh(self, account, margin=None):
+		"""
+		Refresh `account`'s access token unless someone else already has (it has more than `margin` seconds left,
+		default `refresh_margin`). Returns the access token. Raises TokenError if eBay won't refresh it.
+		"""
+		if margin is None:
+			margin = self.refresh_margin
+
+		with self._lock(account):
+			while True:
+				now = time.time()
+				with localdb.transaction(self.conn) as conn:
+					row = self._row(conn, account)
+					if row is None:
+						raise TokenError('Nobody has signed in to eBay yet')
+					if row['expires_at'] - now > margin:
+						return row['access_token']		# someone else refreshed it while we waited
+					if row['refresh_token'] is None:
+						raise TokenError('eBay token has expired and there is no refresh token')
+					leased = (row['refreshing_until'] or 0) > now
+					if not leased:
+						conn.execute('UPDATE tokens SET refreshing_until = ? WHERE account = ?', (now + self.lease, account))
+				if not leased:
+					break
+				time.sleep(0.2)		# another worker is refreshing it; wait for the result
+
+			try:
+				auth_dict = request_token( {
+					'grant_type': 'refresh_token',
+					'refresh_token': row['refresh_token'],
+					'scope': app.config['EBAY_SCOPES'] } )
+			except TokenError as e:
+				self.failed_refreshes += 1
+				self.conn.execute('UPDATE tokens SET refreshing_until = NULL, error = ? WHERE account = ?', (e.message, account))
+				raise
+
+			self.refreshes += 1
+			self.conn.execute(
+				'UPDATE tokens SET access_token = ?, expires_at = ?, updated_at = ?, refreshing_until = NULL, error = NULL WHERE account = ?',
+				(auth_dict['access_token'], time.time() + auth_dict['expires_in'], time.time(), account) )
+			logger.debug('Refreshed eBay access token for account {}'.format(account))
+			return auth_dict['access_token']
+
+	def refresh_due(self):
+		"""Refresh every token that expires within `refresh_margin` seconds and can still be refreshed."""
+		rows = self.conn.execute(
+			'SELECT account FROM tokens WHERE expires_at < ? AND refresh_token IS NOT NULL AND (refresh_expires_at IS NULL OR refresh_expires_at > ?)',
+			(time.time() + self.refresh_margin, time.time()) ).fetchall()
+		for row in rows:
+			try:
+				self.refresh(row['account'])
+			except TokenError as e:
+				logger.warning('Could not refresh eBay token for account {}: {}'.format(row['account'], e.message))
+
+	def start_refresher(self, flask_app, interval):
+		"""Refresh tokens ahead of expiry in a background thread, checking every `interval` seconds."""
+		def run():
+			while True:
+				try:
+					with flask_app.app_context():
+						self.refresh_due()
+				except Exception:
+					logger.exception('eBay token refresher failed')
+				time.sleep(interval)
+
+		self._refresher = threading.Thread(target=run, name='ebay-token-refresher', daemon=True)
+		self._refresher.start()
+
+	def status(self, account=None):
+		"""A dict describing `account`'s tokens (never the tokens themselves), or None."""
+		row = self._row(self.conn, account)
+		if row is None:
+			return None
+		return {
+			'expires_in': int(row['expires_at'] - time.time()),
+			'can_refresh': row['refresh_token'] is not None,
+			'error': row['error']
+			}
+
+	def accounts(self):
+		"""Every account in the store, most recently signed in first, as a list of dicts like `status()`'s plus 'account'."""
+		rows = self.conn.execute('SELECT * FROM tokens ORDER BY updated_at DESC').fetchall()
+		return [dict(self.status(row['account']), account=row['account'], signed_in_at=row['updated_at']) for row in rows]
+
+	def stats(self):
+		return {
+			'accounts': self.conn.execute('SELECT COUNT(*) AS n FROM tokens').fetchone()['n'],
+			'refreshes': self.refreshes,
+			'failed_refreshes': self.failed_refreshes,
+			'refresher_running': self._refresher is not None and self._refresher.is_alive()
+			}
+
+def request_token(body):
+	"""POST `body` to eBay's OAuth token endpoint and return the reply. Raises TokenError if there's no token in it."""
+	response = ebay_client().post(
+		app.config['EBAY_OAUTH_TOKEN_ENDPOINT'],
+		data=body,
+		auth=(app.config['EBAY_OAUTH_CLIENT_ID'], app.config['EBAY_OAUTH_CLIENT_SECRET']) )
+	try:
+		auth_dict = response.json()
+	except ValueError:
+		auth_dict = {}
+	if 'access_token' not in auth_dict:
+		logger.error('No access token in eBay response when we tried to get one. Probably bad creds somewhere. eBay says: {}'.format(response.text))
+		raise TokenError('No access token in response from eBay: {}'.format(auth_dict.get('error_description', response.text)))
+	return auth_dict
+
+"""One manager per process, created on first use so that each gunicorn worker runs its own refresher"""
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_manager():
+	"""The token manager for this app, in DATA_DIR. Starts the background refresher the first time."""
+	global _manager
+	with _manager_lock:
+		if _manager is None:
+			_manager = TokenManager(
+				os.path.join(app.config['DATA_DIR'], 'ebay-tokens.sqlite3'),
+				refresh_margin=app.config.get('EBAY_TOKEN_REFRESH_MARGIN', 600),
+				background_account=app.config.get('EBAY_BACKGROUND_ACCOUNT') )
+			interval = app.config.get('EBAY_TOKEN_REFRESH_INTERVAL', 60)
+			if interval > 0:
+				_manager.start_refresher( app._get_current_object(), interval )
+		return _manager
+
+"""
+The account background work is being done for, if any (see acting_as). A context variable rather than a
+thread-local, so coroutines handed to the upstream loop (aioupstream.py) and `fanout.in_context()` calls see it too.
+"""
+_acting = contextvars.ContextVar('ebay_acting_account', default=None)
+
+class acting_as(object):
+	"""
+	Context manager for background work done on behalf of a particular user (a queued save, say): inside it,
+	`current_account()` is `account` instead of the background account (EBAY_BACKGROUND_ACCOUNT).
+	"""
+
+	def __init__(self, account):
+		self.account = account
+
+	def __enter__(self):
+		self.token = _acting.set(self.account)
+		return self.account
+
+	def __exit__(self, exc_type, exc, tb):
+		_acting.reset(self.token)
+		return False
+
+def current_account():
+	"""
+	The eBay account for this request (from the session), or None outside of a request - unless it's inside
+	`acting_as()`.
+
+	Sessions from before tokens were kept server-side still carry the tokens themselves; those are moved into the
+	token store the first time we see them.
+	"""
+	if _acting.get() is not None:
+		return _acting.get()
+	if not has_request_context():
+		return None
+	if 'ebay_account' not in session and 'access_token' in session:
+		try:
+			session['ebay_account'] = get_manager().save( {
+				'access_token': session.get('access_token'),
+				'expires_in': _seconds_until( session.get('access_token_expiry') ),
+				'refresh_token': session.get('refresh_token') } )
+		except Exception:
+			# Drop the old tokens anyway, so a session we can't move over means signing in again rather than a 500
+			# 	on every request
+			logger.exception('Could not move eBay tokens from an old session into the token store')
+		finally:
+			for k in ('access_token', 'access_token_expiry', 'refresh_token'):
+				session.pop(k, None)
+	return session.get('ebay_account')
+
+def _seconds_until(expiry):
+	"""
+	Seconds from now until `expiry`, a datetime from an old session. Depending on the Flask version it comes back
+	from the cookie naive (UTC) or timezone-aware, so both are treated as UTC.
+	"""
+	if not isinstance(expiry, datetime.datetime):
+		return 0
+	if expiry.tzinfo is None:
+		expiry = expiry.replace(tzinfo=datetime.timezone.utc)
+	return (expiry - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+def access_token():
+	"""
+	A valid eBay access token for whoever is asking: the signed-in user during a request, the account given to
+	`acting_as()`, or else the background account. Raises TokenError if there isn't one.
+	"""
+	if has_request_context() and current_account() is None:
+		raise TokenError('Not signed in to eBay')
+	return get_manager().token( current_account() )
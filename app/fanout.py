@@ -0,0 +1,54 @@
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from flask import has_request_context, has_app_context, copy_current_request_context
+from flask import current_app
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.fanout')
+logger.setLevel(logging.DEBUG)
+
+def in_context(fn):
+	"""
+	Wrap `fn` so that it can be called from a worker thread and still see the caller's Flask context.
+
+	Everything in glitchlab_shopify reads `app.config` (and sometimes `session`) through Flask's context
+	locals, which are empty in a fresh thread. Call this in the *calling* thread, once per submitted call -
+	each call gets its own copy of the request context, since a single copy can't be pushed from two threads
+	at once. The caller's other context variables (like `ebay_tokens.acting_as()`) come along too.
+	"""
+	if has_request_context():
+		wrapped = copy_current_request_context(fn)
+	elif has_app_context():
+		flask_app = current_app._get_current_object()
+		def wrapped(*args, **kwargs):
+			with flask_app.app_context():
+				return fn(*args, **kwargs)
+	else:
+		wrapped = fn
+
+	context = contextvars.copy_context()
+	return lambda *args, **kwargs: context.run(wrapped, *args, **kwargs)
+
+def bounded_map(fn, items, max_workers):
+	"""
+	Call `fn(item)` for every item in `items`, with at most `max_workers` calls in flight at once.
+
+	Returns a list of (item, result, exception) tuples in the same order as `items`. Exceptions are collected
+	rather than raised, so one failed call doesn't throw away the results of the others - the caller decides
+	what a failure means.
+	"""
+	items = list(items)
+	if len(items) == 0:
+		return []
+
+	workers = max(1, min(int(max_workers), len(items)))
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		futures = [pool.submit(in_context(fn), item) for item in items]
+
+	results = []
+	for item, f in zip(items, futures):
+		e = f.exception()
+		results.append( (item, None if e is not None else f.result(), e) )
+	return results
@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from flask import current_app as app
+
+import localdb
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.fingerprints')
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fingerprints (
+	kind			TEXT,		-- 'item', 'group' or 'offer', like the eBay object cache
+	key				TEXT,		-- SKU, inventoryItemGroupKey or offerId
+	fingerprint		TEXT,
+	pushed_at		REAL,		-- unix time
+	PRIMARY KEY (kind, key)
+);
+'''
+
+def fingerprint(payload):
+	"""A hash of `payload` (anything JSON-able) that only changes when its contents do - key order doesn't matter."""
+	canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+	return hashlib.sha256( canonical.encode('utf-8') ).hexdigest()
+
+class FingerprintStore(object):
+	"""
+	Fingerprints (see `fingerprint()`) of what we last pushed from Shopify to each eBay inventory item, item group
+	and offer, in a SQLite file shared by every worker. If the payload we'd push now has the same fingerprint, eBay
+	already has it and there's nothing to do - without asking eBay.
+
+	Anything else that writes an eBay object through this app (the UI, say) drops its fingerprint (see
+	`glitchlab_shopify.invalidate_ebay_object()`), since eBay no longer has exactly what we pushed. Changes made
+	on eBay directly aren't noticed; a sync without --incremental pushes everything again.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def get(self, kind, key):
+		"""The fingerprint of what we last pushed to eBay object `kind`:`key`, or None."""
+		row = self.conn.execute('SELECT fingerprint FROM fingerprints WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+		return row['fingerprint'] if row is not None else None
+
+	def put(self, kind, key, fp):
+		self.conn.execute(
+			'INSERT OR REPLACE INTO fingerprints (kind, key, fingerprint, pushed_at) VALUES (?, ?, ?, ?)',
+			(kind, key, fp, time.time()) )
+
+	def forget(self, kind, key):
+		self.conn.execute('DELETE FROM fingerprints WHERE kind = ? AND key = ?', (kind, key))
+
+	def stats(self):
+		rows = self.conn.execute('SELECT kind, COUNT(*) AS n FROM fingerprints GROUP BY kind').fetchall()
+		return {row['kind']: row['n'] for row in rows}
+
+def get_store():
+	"""The fingerprint store for this app, in DATA_DIR."""
+	return FingerprintStore( os.path.join(app.config['DATA_DIR'], 'ebay-fingerprints.sqlite3') )
@@ -0,0 +1,327 @@
+import json
+import asyncio
+import logging
+from flask import current_app as app
+
+import glitchlab_shopify as gs
+import sku_index
+from fanout import in_context
+from glitchlab_shopify import (ItemNotFoundError, AuthenticationError, EBAY_ITEM, EBAY_GROUP, EBAY_OFFER,
+	EBAY_BULK_GET_LIMIT, EBAY_BULK_WRITE_LIMIT)
+
+
+"""Logging setup"""
+logger = logging.getLogger('glitchlab_shopify.async')
+logger.setLevel(logging.DEBUG)
+
+"""
+Async versions of the upstream calls in glitchlab_shopify.py, for `async def` views.
+
+Each function takes the async client to send its requests through as its first argument, and has to run on the
+upstream loop - see aioupstream.py; views hand their coroutines over with `aioupstream.call()`. Only the network
+I/O lives here: everything else (merging, skipping writes that change nothing, the eBay object cache, the SKU
+index, write counters, error handling) is the same glitchlab_shopify helper the sync version calls, so both
+behave the same and see each other's cached objects.
+
+Sync and async versions can be mixed freely: they go through the same rate limiters.
+"""
+
+async def gather_bounded(coros, limit):
+	"""
+	Run the coroutines in `coros` concurrently, at most `limit` at a time. Returns a list of (result, exception)
+	tuples in the same order - like `fanout.bounded_map()`, one failure doesn't throw away the other results.
+	"""
+	semaphore = asyncio.Semaphore( max(1, int(limit)) )
+	async def run(coro):
+		async with semaphore:
+			try:
+				return await coro, None
+			except Exception as e:
+				return None, e
+	return await asyncio.gather( *[run(c) for c in coros] )
+
+def reply_json(response):
+	"""The JSON body of an eBay reply, or None (logged) if it isn't JSON."""
+	try:
+		return response.json()
+	except json.JSONDecodeError:
+		logger.warning('Got a weird reply from eBay: {}'.format(response.text))
+		return None
+
+## eBay reads
+
+async def get_ebay_product(ebay, auth_token, product_sku):
+	"""Async `glitchlab_shopify.get_ebay_product()`. Raises AuthenticationError or ItemNotFoundError."""
+	url = app.config['EBAY_INVENTORYITEM_URL'].format(product_sku)
+	logger.debug('Trying to fetch eBay SKU {}...'.format(product_sku))
+	generation = gs.ebay_object_generation( EBAY_ITEM, product_sku )
+	response = await ebay.get( url, auth_token=auth_token )
+	return gs.read_ebay_object( EBAY_ITEM, product_sku, response, generation )
+
+async def get_ebay_products(ebay, auth_token, product_skus, max_workers=None):
+	"""
+	Async `glitchlab_shopify.get_ebay_products()`: every bulkGetInventoryItem batch goes out at once, and so do
+	the one-by-one fetches for SKUs a batch couldn't return (at most `max_workers` of those, defaulting to
+	app.config['EBAY_FETCH_CONCURRENCY']).
+	"""
+	if max_workers is None:
+		max_workers = app.config.get('EBAY_FETCH_CONCURRENCY', 8)
+
+	skus = []
+	for sku in product_skus:
+		if sku not in skus:
+			skus.append(sku)
+
+	batches = [skus[i:i + EBAY_BULK_GET_LIMIT] for i in range(0, len(skus), EBAY_BULK_GET_LIMIT)]
+	items = {}
+	retry = []
+	for found, failed in await asyncio.gather( *[bulk_get_ebay_products(ebay, auth_token, b) for b in batches] ):
+		items.update(found)
+		retry.extend(failed)
+
+	if len(retry) > 0:
+		logger.info('Fetching {} eBay SKUs one at a time: {}'.format(len(retry), retry))
+		results = await gather_bounded( [get_ebay_product(ebay, auth_token, sku) for sku in retry], max_workers )
+		for sku, (item, e) in zip(retry, results):
+			if isinstance(e, ItemNotFoundError):
+				continue
+			elif e is not None:
+				raise e
+			items[sku] = item
+
+	sku_index.get_sku_index().learn_many( list(items.keys()), sku_index.INVENTORY_ITEM )
+	return items
+
+async def bulk_get_ebay_products(ebay, auth_token, product_skus):
+	"""Async `glitchlab_shopify.bulk_get_ebay_products()`."""
+	url = app.config['EBAY_BULKGETINVENTORYITEM_URL']
+	logger.debug('Trying to bulk fetch eBay SKUs {}...'.format(product_skus))
+	generations = {sku: gs.ebay_object_generation( EBAY_ITEM, sku ) for sku in product_skus}
+	response = await ebay.post( url, auth_token=auth_token, json={'requests': [{'sku': sku} for sku in product_skus]} )
+	return gs.read_ebay_bulk_get( response, product_skus, generations )
+
+async def get_ebay_offers(ebay, auth_token, product_sku):
+	"""
+	Async `glitchlab_shopify.get_ebay_offers()`. Returns a list of offers (empty if eBay has none). Raises
+	RuntimeError on a reply we can't read, rather than returning a string.
+	"""
+	url = app.config['EBAY_INVENTORYOFFERS_URL'].format( product_sku )
+	logger.debug('Trying to get offers for eBay SKU {}...'.format( product_sku ))
+	response = await ebay.get( url, auth_token=auth_token )
+	logger.debug('Raw reply from eBay: {}'.format(response.text))
+
+	j = reply_json(response)
+	if j is None:
+		raise RuntimeError('eBay weird reply')
+	if response.status_code == 404:
+		return []
+	gs.handle_ebay_errors( j )
+
+	if 'offers' not in j:
+		logger.warning("Didn't find errors OR offers in eBay reply...")
+		raise RuntimeError('eBay weird reply')
+	for offer in j['offers']:
+		gs.remember_ebay_object( EBAY_OFFER, offer['offerId'], offer )
+	return j['offers']
+
+async def get_ebay_offer(ebay, auth_token, offer_id):
+	"""Async `glitchlab_shopify.get_ebay_offer()`. Raises ItemNotFoundError if eBay doesn't have the offer."""
+	url = app.config['EBAY_INVENTORYOFFER_URL'].format( offer_id )
+	logger.debug('Trying to get offer ID {}...'.format( offer_id ))
+	generation = gs.ebay_object_generation( EBAY_OFFER, offer_id )
+	response = await ebay.get( url, auth_token=auth_token )
+
+	j = reply_json(response)
+	if j is None:
+		raise RuntimeError('eBay weird reply')
+	if response.status_code == 404:
+		raise ItemNotFoundError('No eBay offer with ID {}'.format(offer_id))
+	gs.handle_ebay_errors( j )
+
+	gs.remember_ebay_object( EBAY_OFFER, offer_id, j, generation=generation )
+	return j
+
+async def get_ebay_inventoryitemgroup(ebay, auth_token, inventoryitemgroup_key):
+	"""Async `glitchlab_shopify.get_ebay_inventoryitemgroup()`. Raises AuthenticationError or ItemNotFoundError."""
+	url = app.config['EBAY_INVENTORYITEMGROUP_URL'].format(inventoryitemgroup_key)
+	logger.debug('Trying to fetch eBay inventoryItemGroup {}...'.format(inventoryitemgroup_key))
+	generation = gs.ebay_object_generation( EBAY_GROUP, inventoryitemgroup_key )
+	response = await ebay.get( url, auth_token=auth_token )
+	return gs.read_ebay_object( EBAY_GROUP, inventoryitemgroup_key, response, generation )
+
+## eBay writes
+
+async def set_ebay_attributes(ebay, product_sku, attributes, revalidate=False):
+	"""Async `glitchlab_shopify.set_ebay_attributes()`."""
+	auth_token = gs.ebay_auth_token()
+
+	iOld = None if revalidate else gs.cached_ebay_object( EBAY_ITEM, product_sku )
+	if iOld is None:
+		iOld = await get_ebay_product( ebay, auth_token, product_sku )
+
+	iNew = gs.plan_ebay_write( EBAY_ITEM, product_sku, iOld, attributes )
+	if iNew is None:
+		return {}
+
+	url = app.config['EBAY_INVENTORYITEM_URL'].format( product_sku )
+	with gs.ebay_write_attempt( EBAY_ITEM, [product_sku] ):
+		response = await ebay.put( url, auth_token=auth_token, json=iNew )
+	return gs.read_ebay_write_reply( EBAY_ITEM, product_sku, iNew, response )
+
+async def set_ebay_attributes_bulk(ebay, attributes_by_sku, revalidate=False):
+	"""
+	Async `glitchlab_shopify.set_ebay_attributes_bulk()`; the bulkCreateOrReplaceInventoryItem batches all go out
+	at once. Returns the same {sku: result dict}.
+	"""
+	auth_token = gs.ebay_auth_token()
+	results = {}
+
+	old_items, missing = gs.cached_ebay_items( list(attributes_by_sku.keys()), revalidate )
+	if len(missing) > 0:
+		old_items.update( await get_ebay_products( ebay, auth_token, missing ) )
+
+	item_requests, merged_items = gs.plan_ebay_bulk_write( attributes_by_sku, old_items, results )
+
+	url = app.config['EBAY_BULKCREATEORREPLACEINVENTORYITEM_URL']
+	async def write_batch(batch):
+		skus = [item['sku'] for item in batch]
+		logger.debug('Trying to bulk update eBay SKUs {}...'.format(skus))
+		with gs.ebay_write_attempt( EBAY_ITEM, skus ):
+			response = await ebay.post( url, auth_token=auth_token, json={'requests': batch} )
+		gs.record_ebay_bulk_write( response, skus, merged_items, results )
+
+	await asyncio.gather( *[write_batch( item_requests[i:i + EBAY_BULK_WRITE_LIMIT] )
+		for i in range(0, len(item_requests), EBAY_BULK_WRITE_LIMIT)] )
+	return results
+
+async def update_ebay_offer(ebay, offer_id, update_fields, revalidate=False):
+	"""Async `glitchlab_shopify.update_ebay_offer()`. Returns None if eBay doesn't have the offer."""
+	auth_token = gs.ebay_auth_token()
+
+	old = None if revalidate else gs.cached_ebay_object( EBAY_OFFER, offer_id )
+	try:
+		if old is None:
+			old = await get_ebay_offer( ebay, auth_token, offer_id )
+	except ItemNotFoundError:
+		logger.info('update_ebay_offer called for offer ID {}, but eBay says item not found'.format(offer_id))
+		return None
+
+	new = gs.plan_ebay_write( EBAY_OFFER, offer_id, old, update_fields )
+	if new is None:
+		return {}
+
+	url = app.config['EBAY_INVENTORYOFFER_URL'].format( offer_id )
+	with gs.ebay_write_attempt( EBAY_OFFER, [offer_id] ):
+		response = await ebay.put( url, auth_token=auth_token, json=new )
+	return gs.read_ebay_write_reply( EBAY_OFFER, offer_id, new, response )
+
+async def update_ebay_offers(ebay, offers, revalidate=False, max_workers=None):
+	"""
+	Update several eBay offers at once (at most `max_workers`, default EBAY_FETCH_CONCURRENCY). Returns a list
+	with a {'offerId', 'ok', 'error', 'message'} dict per offer, in the same order.
+	"""
+	if max_workers is None:
+		max_workers = app.config.get('EBAY_FETCH_CONCURRENCY', 8)
+
+	replies = await gather_bounded(
+		[update_ebay_offer( ebay, offer['offerId'], offer, revalidate=revalidate ) for offer in offers],
+		max_workers )
+	results = []
+	for offer, (reply, e) in zip(offers, replies):
+		result = {'offerId': offer.get('offerId'), 'ok': e is None, 'error': None, 'message': None}
+		if isinstance(e, AuthenticationError):
+			result['error'], result['message'] = 'ebay_auth_invalid', e.message
+		elif isinstance(e, ItemNotFoundError):
+			result['error'], result['message'] = 'ebay_item_not_found', e.message
+		elif e is not None:
+			logger.warning('Failed to update eBay offer {}: {}'.format(offer.get('offerId'), e))
+			result['error'], result['message'] = 'ebay_error', str(e)
+		results.append(result)
+	return results
+
+async def set_ebay_inventoryitemgroup(ebay, inventoryitemgroup_key, attributes_in, revalidate=False):
+	"""Async `glitchlab_shopify.set_ebay_inventoryitemgroup()`."""
+	auth_token = gs.ebay_auth_token()
+
+	iOld = None if revalidate else gs.cached_ebay_object( EBAY_GROUP, inventoryitemgroup_key )
+	if iOld is None:
+		iOld = await get_ebay_inventoryitemgroup( ebay, auth_token, inventoryitemgroup_key )
+
+	iNew = gs.plan_ebay_write( EBAY_GROUP, inventoryitemgroup_key, iOld, attributes_in )
+	if iNew is None:
+		return {}
+
+	url = app.config['EBAY_INVENTORYITEMGROUP_URL'].format( inventoryitemgroup_key )
+	with gs.ebay_write_attempt( EBAY_GROUP, [inventoryitemgroup_key] ):
+		response = await ebay.put( url, auth_token=auth_token, json=iNew )
+	return gs.read_ebay_write_reply( EBAY_GROUP, inventoryitemgroup_key, iNew, response )
+
+## Shopify
+
+async def get_shopify_product(shopify, product_id):
+	"""
+	Async `glitchlab_shopify.get_shopify_product()`, with the same cache and catalog store in front of it.
+
+	The 'rest' loader sends the product, its metafields and every variant's metafields all at once. The
+	'graphql' loader's pages depend on each other, so it runs the sync loader on a thread instead.
+	"""
+	p, generations = gs.find_shopify_product(product_id)
+	if p is not None:
+		return p
+
+	if app.config.get('SHOPIFY_PRODUCT_LOADER', 'rest') == 'graphql':
+		p, cost = await asyncio.get_running_loop().run_in_executor( None, in_context(gs.get_shopify_product_graphql), product_id )
+	else:
+		p = await get_shopify_product_rest( shopify, product_id )
+
+	gs.remember_shopify_product( p, generations )
+	return p
+
+def shopify_product_url(product_id, suffix=''):
+	return 'https://{}/admin/api/2019-04/products/{}{}.json'.format( app.config['SHOPIFY_STORE_DOMAIN'], product_id, suffix )
+
+async def get_shopify_metafields(shopify, url):
+	"""GET a Shopify metafields URL and return {key: value}."""
+	response = await shopify.get(url)
+	try:
+		return {f['key']: f['value'] for f in response.json()['metafields']}
+	except (json.JSONDecodeError, KeyError):
+		logger.error('Shopify said something that is not metafields: ' + response.text)
+		raise RuntimeError('Bad response from Shopify: {}'.format(response.text))
+
+async def get_shopify_product_rest(shopify, product_id):
+	"""
+	Async `glitchlab_shopify.get_shopify_product_rest()`: the product and its metafields go out together, then
+	every variant's metafields at once (at most SHOPIFY_FETCH_CONCURRENCY in flight).
+	"""
+	product_response, metafields = await asyncio.gather(
+		shopify.get( shopify_product_url(product_id) ),
+		get_shopify_metafields( shopify, shopify_product_url(product_id, '/metafields') ),
+		return_exceptions=True )
+	if isinstance(product_response, Exception):
+		raise product_response
+
+	# A missing product's metafields fail too, so look at the product before the metafields
+	if product_response.status_code == 404:
+		raise ItemNotFoundError('No Shopify product with ID {}'.format(product_id))
+	try:
+		p = product_response.json()
+	except json.JSONDecodeError:
+		logger.error('Shopify said something that is not JSON: ' + product_response.text)
+		return 'Shopify said...' + product_response.text
+	if isinstance(metafields, Exception):
+		raise metafields
+
+	pvs = p['product'].get('variants', [])
+	replies = await gather_bounded(
+		[get_shopify_metafields( shopify, shopify_product_url(product_id, '/variants/{}/metafields'.format(v['id'])) ) for v in pvs],
+		app.config.get('SHOPIFY_FETCH_CONCURRENCY', 8) )
+
+	p['product']['variants'] = {}
+	for v, (variant_metafields, e) in zip(pvs, replies):
+		if e is not None:
+			raise e
+		v['metafields'] = variant_metafields
+		p['product']['variants'][v['id']] = v
+	p['product']['metafields'] = metafields
+	return p
@@ -1,12 +1,22 @@
 import os
 import shopify
 import logging
-import pystache
-import requests
 import json
 import copy
-from flask import session, request
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from flask import request
 from flask import current_app as app
+from fanout import in_context, bounded_map
+from upstream import shopify_client, ebay_client
+from cache import TTLCache
+import catalog_store
+import sku_index
+import ebay_tokens
+import ebay_mirror
+import fingerprints
+from templates import registry as template_registry
 
 
 """Logging setup"""
@@ -21,40 +31,161 @@ ch.setFormatter(formatter)
 # Add the handler to the logger
 logger.addHandler(ch)
 
-def merge(a, b, path=None, update=True):
-	"""
-	Merges b into a, recursing through nested levels to only update changed keys.
-	
-	http://stackoverflow.com/questions/7204805/python-dictionaries-of-dictionaries-merge"""
-  
-	if path is None: path = []
-	for key in b:
-		if key in a:
-			if isinstance(a[key], dict) and isinstance(b[key], dict):
-				merge(a[key], b[key], path + [str(key)])
-			elif a[key] == b[key]:
-				pass # same leaf value
-			elif isinstance(a[key], list) and isinstance(b[key], list):
-				for idx, val in enumerate(b[key]):
-					a[key][idx] = merge(a[key][idx], b[key][idx], path + [str(key), str(idx)], update=update)
-			elif update:
-				a[key] = b[key]
-			else:
-				raise RuntimeError('Dictionary merge conflict at %s' % '.'.join(path + [str(key)]))
+"""Stands in for the old value of a key that didn't exist before a merge"""
+MISSING = object()
+
+def merge(a, b, path=None, update=True, changes=None):
+	"""
+	Merge b into a, only updating the keys b has, and return the result. Neither a nor b is modified.
+	
+	The result shares everything it can with a and b: a dict or list is only copied (shallowly) if something
+	inside it changed, and if nothing changed at all the result *is* a. So merging a small update into a big
+	listing copies a handful of dicts, not the HTML description and image lists - but it also means the result
+	must be treated as read-only, like a and b.
+	
+	Dicts are merged key by key, and lists of dicts element by element: elements past the end of b are kept as
+	they were in a, and elements past the end of a are added. Anything else (leaves, lists of strings) is replaced
+	by b's value. With `update=False`, a leaf that differs raises RuntimeError instead.
+	
+	If `changes` is a list, a (path, old value, new value) tuple is appended to it for every leaf that actually
+	changed. `path` is a tuple of keys (and list indexes); the old value is `MISSING` for keys (and list
+	elements) that are new.
+	"""
+	path = tuple(path) if path is not None else ()
+	if a == b:
+		return a
+	if not _mergeable(a, b):
+		if not update:
+			raise RuntimeError('Dictionary merge conflict at %s' % '.'.join(str(k) for k in path))
+		if changes is not None:
+			changes.append( (path, a, b) )
+		return b
+	
+	stack = [_MergeFrame(a, b, path)]
+	while True:
+		f = stack[-1]
+		
+		# Done with this dict/list: hand the result up to the parent
+		if f.pos == len(f.keys):
+			stack.pop()
+			merged = f.result()
+			if len(stack) == 0:
+				return merged
+			parent = stack[-1]
+			if merged is not parent.a[parent.key]:
+				parent.set( parent.key, merged )
+			continue
+		
+		key = f.keys[f.pos]
+		f.pos += 1
+		new = f.b[key]
+		if not (key in f.a if isinstance(f.a, dict) else key < len(f.a)):
+			if changes is not None:
+				changes.append( (f.path + (key,), MISSING, new) )
+			f.set( key, new )
+			continue
+		
+		old = f.a[key]
+		if old is new or old == new:
+			continue # same leaf value (or same subtree)
+		elif _mergeable(old, new):
+			f.key = key
+			stack.append( _MergeFrame(old, new, f.path + (key,)) )
+		elif update:
+			if changes is not None:
+				changes.append( (f.path + (key,), old, new) )
+			f.set( key, new )
+		else:
+			raise RuntimeError('Dictionary merge conflict at %s' % '.'.join(str(k) for k in f.path + (key,)))
+
+def _mergeable(a, b):
+	"""Dicts are merged key by key, and lists of dicts element by element. Anything else gets replaced."""
+	if isinstance(a, dict) and isinstance(b, dict):
+		return True
+	return isinstance(a, list) and isinstance(b, list) \
+		and all(isinstance(v, dict) for v in a) and all(isinstance(v, dict) for v in b)
+
+class _MergeFrame(object):
+	"""One dict (or list of dicts) that `merge()` is partway through."""
+	__slots__ = ('a', 'b', 'path', 'keys', 'pos', 'key', 'out')
+	
+	def __init__(self, a, b, path):
+		self.a = a
+		self.b = b
+		self.path = path
+		self.keys = list(b.keys()) if isinstance(b, dict) else range(len(b))
+		self.pos = 0
+		self.key = None			# the key whose merge is on the stack above us
+		self.out = None			# our copy of a, made the first time something changes
+	
+	def set(self, key, value):
+		if self.out is None:
+			self.out = dict(self.a) if isinstance(self.a, dict) else list(self.a)
+		if isinstance(self.out, list) and key == len(self.out):
+			self.out.append(value)
 		else:
-			a[key] = b[key]
-	return a
+			self.out[key] = value
+	
+	def result(self):
+		return self.a if self.out is None else self.out
+
+def merge_changes(a, b, ignore=()):
+	"""
+	Merge b into a like `merge()`, and return (merged, changes): `changes` lists what actually changed, as
+	(path, old value, new value) tuples. An empty list means the merged object is the same as `a`, so there's
+	nothing to write.
+	
+	Changes under any top-level key in `ignore` aren't reported (e.g. our own '_gl_' fields, which the upstream
+	doesn't store).
+	"""
+	changes = []
+	merged = merge(a, b, changes=changes)
+	return merged, [c for c in changes if len(c[0]) == 0 or c[0][0] not in ignore]
+
+def describe_changes(changes, limit=10):
+	"""A short human-readable list of changed paths, for logging."""
+	paths = ['.'.join(str(k) for k in c[0]) for c in changes[:limit]]
+	if len(changes) > limit:
+		paths.append('... and {} more'.format(len(changes) - limit))
+	return ', '.join(paths)
+
+"""Writes sent to and skipped for each upstream, in this worker. See `count_write()`."""
+write_stats = {}
+_write_stats_lock = threading.Lock()
+
+def count_write(kind, skipped):
+	"""Count a write of `kind` (e.g. 'ebay_item') that we either sent or skipped because nothing changed."""
+	with _write_stats_lock:
+		counts = write_stats.setdefault( kind, {'sent': 0, 'skipped': 0} )
+		counts['skipped' if skipped else 'sent'] += 1
+
+def all_write_stats():
+	with _write_stats_lock:
+		return {kind: dict(counts) for kind, counts in write_stats.items()}
 
 def render_product_template(template, shopifyProduct):
-	"""make the HTML description for a product. template is a file path"""
-	with open(template) as f:
-		t = f.read()
+	"""
+	make the HTML description for a product. template is a file path. shopifyProduct can be a shopify.Product or a
+	product dict (like `get_shopify_product()['product']`).
 	
-	fields = {	'item_name': 			shopifyProduct.title,
+	The template is parsed once and kept in memory (see templates.py), so this doesn't touch the disk again unless
+	the template file changes.
+	"""
+	return template_registry.render( template, product_template_fields(shopifyProduct) )
+
+def render_product_templates(template, shopifyProducts):
+	"""Batch version of `render_product_template()`: returns a list of HTML descriptions, one per product."""
+	return template_registry.render_many( template, [product_template_fields(p) for p in shopifyProducts] )
+
+def product_template_fields(shopifyProduct):
+	"""The mustache fields the eBay item template uses, from a shopify.Product or a product dict."""
+	if isinstance(shopifyProduct, dict):
+		return {	'item_name': 			shopifyProduct.get('title'),
+					'item_description': 	shopifyProduct.get('body_html')
+					}
+	return {	'item_name': 			shopifyProduct.title,
 				'item_description': 	shopifyProduct.body_html
 				}
-	
-	return pystache.render(t, fields)
 
 def get_shopify_product_matches( qstring ):
 	"""
@@ -71,9 +202,8 @@ def get_shopify_product_matches( qstring ):
 	# Filter by title for now
 	args['title'] = qstring
 	
-	response = requests.get(
+	response = shopify_client().get(
 		url,
-		auth=(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW']),
 		params=args
 	)
 	
@@ -86,22 +216,246 @@ def get_shopify_product_matches( qstring ):
 		
 	return results
 	
-def get_shopify_product(product_id):
+def iter_shopify_products(fields=None, page_size=250):
+	"""
+	Walk the whole Shopify catalog, one page of `page_size` products per request, yielding each product dict
+	(REST shape - variants as a list, no metafields). Pass `fields` (e.g. 'id,title,variants') to trim the reply.
+	
+	Pages by `since_id`, so products come back in ID order and a product added mid-walk is never skipped.
+	Raises RuntimeError if Shopify replies with something we can't read.
+	"""
+	
+	url = 'https://{domain}/admin/api/2019-04/products.json'.format( domain=app.config['SHOPIFY_STORE_DOMAIN'] )
+	since_id = 0
+	while True:
+		args = {'limit': page_size, 'since_id': since_id}
+		if fields is not None:
+			args['fields'] = fields
+		response = shopify_client().get( url, params=args )
+		try:
+			products = response.json()['products']
+		except (json.JSONDecodeError, KeyError):
+			logger.error('Shopify said something unexpected while listing products: ' + response.text)
+			raise RuntimeError('Bad response from Shopify while listing products: {}'.format(response.text))
+			
+		for p in products:
+			yield p
+			
+		if len(products) < page_size:
+			return
+		since_id = products[-1]['id']
+
+SHOPIFY_PRODUCT_METAFIELD_QUERY = '''
+query productMetafield($first: Int!, $after: String, $namespace: String!, $key: String!) {
+	products(first: $first, after: $after) {
+		pageInfo { hasNextPage }
+		edges { cursor node { legacyResourceId metafield(namespace: $namespace, key: $key) { value } } }
+	}
+}
+'''
+
+def iter_shopify_product_metafield(key, namespace='global', page_size=250):
+	"""
+	Walk the whole Shopify catalog over GraphQL, yielding (product_id, value) for every product that has the
+	metafield `namespace`.`key` set. Much cheaper than fetching every product's metafield list over REST.
+	"""
+	
+	after = None
+	while True:
+		data, cost = shopify_graphql( SHOPIFY_PRODUCT_METAFIELD_QUERY, {
+				'first': page_size,
+				'after': after,
+				'namespace': namespace,
+				'key': key	}, cost=2 + 2 * page_size )
+		edges = data['products']['edges']
+		for e in edges:
+			if e['node']['metafield'] is not None:
+				yield int(e['node']['legacyResourceId']), e['node']['metafield']['value']
+				
+		if not data['products']['pageInfo']['hasNextPage'] or len(edges) == 0:
+			return
+		after = edges[-1]['cursor']
+	
+def get_shopify_product(product_id, max_workers=None):
 	"""
 	Fetch a single Shopify product by its ID, `product_id`.
 	Also retrieve the item's metafields, and merge the dict of metafields into the product dict returned from the Shopify product endpoint.
+	
+	Uses whichever loader app.config['SHOPIFY_PRODUCT_LOADER'] asks for: 'graphql' (one query, see
+	`get_shopify_product_graphql()`) or 'rest' (one request per variant, see `get_shopify_product_rest()`).
+	Both return the same dict.
+	
+	Products are cached (see `shopify_product_cache()`), so viewing the same product again within
+	app.config['SHOPIFY_PRODUCT_CACHE_TTL'] seconds doesn't hit Shopify at all. Behind that is the local catalog
+	mirror (see catalog_store.py), which Shopify webhooks keep up to date and which is served for up to
+	app.config['CATALOG_STORE_MAX_AGE'] seconds. Our own writes through `set_shopify_attributes()` and
+	`set_metafield()` drop the product from both.
 
 	Returns a dict if successful. Raises AuthenticationError or ItemNotFoundError, or returns None, if not.
 	"""
+	
+	p, generations = find_shopify_product(product_id)
+	if p is not None:
+		return p
+	
+	if app.config.get('SHOPIFY_PRODUCT_LOADER', 'rest') == 'graphql':
+		p, cost = get_shopify_product_graphql( product_id )
+		logger.info('Loaded Shopify product {} over GraphQL, query cost {} (requested {}, {} points left in bucket)'.format(
+				product_id,
+				cost.get('actualQueryCost'),
+				cost.get('requestedQueryCost'),
+				cost.get('throttleStatus', {}).get('currentlyAvailable')	))
+	else:
+		p = get_shopify_product_rest( product_id, max_workers=max_workers )
+		
+	remember_shopify_product( p, generations )
+	return p
 
-	# Hit the Product endpoint first
+def find_shopify_product(product_id):
+	"""
+	The part of `get_shopify_product()` (and its async twin) that doesn't ask Shopify: our copy of the product
+	from the cache or the catalog store. Returns (product, generations). If the product is None, load it and
+	hand it to `remember_shopify_product()` with `generations`, so a load that races with our own write isn't kept.
+	"""
+	cache = shopify_product_cache()
+	key = str(product_id)
+	cached = cache.get(key)
+	if cached is not None:
+		logger.debug('Shopify product {} served from cache'.format(product_id))
+		return copy.deepcopy(cached), None
+	store = catalog_store.get_store()
+	generations = (cache.generation(key), store.generation(product_id))
+	
+	p = store.get( product_id, max_age=app.config.get('CATALOG_STORE_MAX_AGE') )
+	if p is not None:
+		logger.debug('Shopify product {} served from the local catalog store'.format(product_id))
+		cache.put( key, copy.deepcopy(p), generation=generations[0] )
+	return p, generations
+
+def remember_shopify_product(p, generations):
+	"""Keep a product we just loaded from Shopify in the cache and the catalog store. `p` can be a failed load, which is ignored."""
+	if isinstance(p, dict):
+		shopify_product_cache().put( str(p['product']['id']), copy.deepcopy(p), generation=generations[0] )
+		catalog_store.get_store().put( p, generation=generations[1] )
+
+"""Product cache, one per worker process"""
+_shopify_product_cache = None
+_shopify_product_cache_lock = threading.Lock()
+
+def shopify_product_cache():
+	"""
+	The cache of loaded Shopify products (keyed by product ID as a string) for this worker process.
+	
+	Writes made through another worker only invalidate that worker's cache, so other workers can serve the old
+	product for up to the cache TTL.
+	"""
+	global _shopify_product_cache
+	with _shopify_product_cache_lock:
+		if _shopify_product_cache is None:
+			_shopify_product_cache = TTLCache(
+				'shopify_products',
+				maxsize=app.config.get('SHOPIFY_PRODUCT_CACHE_SIZE', 256),
+				ttl=app.config.get('SHOPIFY_PRODUCT_CACHE_TTL', 300)	)
+		return _shopify_product_cache
+
+def cached_shopify_product(product_id):
+	"""
+	Return our copy of a Shopify product from the cache or the local catalog store (the same dict as
+	`get_shopify_product()`), or None if we don't have a recent one. Never asks Shopify.
+	
+	The product may be the cache's own copy, so treat it as read-only.
+	"""
+	cached = shopify_product_cache().get( str(product_id) )
+	if cached is not None:
+		return cached
+	return catalog_store.get_store().get( product_id, max_age=app.config.get('CATALOG_STORE_MAX_AGE') )
+
+def shopify_product_unchanged(product_id, product):
+	"""
+	True if writing `product` (a REST product body, variants as a list) wouldn't change our recent copy of the
+	product. False if it would, or if we don't have a copy to compare with.
+	"""
+	current = cached_shopify_product(product_id)
+	if current is None:
+		return False
+	
+	new = dict(product)
+	new.pop('id', None)
+	if 'variants' in new:
+		new['variants'] = {int(v['id']): dict(v, id=int(v['id'])) for v in new['variants']}
+	merged, changes = merge_changes( current['product'], new )
+	if len(changes) > 0:
+		logger.debug('Shopify product {} changed: {}'.format(product_id, describe_changes(changes)))
+		return False
+	
+	logger.info('Nothing changed in Shopify product {}, not writing it'.format(product_id))
+	count_write( 'shopify_product', skipped=True )
+	return True
+
+def invalidate_shopify_product(product_id):
+	"""Forget any cached copy of the Shopify product `product_id`, e.g. because we just wrote to it."""
+	shopify_product_cache().invalidate( str(product_id) )
+	catalog_store.get_store().invalidate( product_id )
+
+def get_shopify_product_rest(product_id, max_workers=None):
+	"""
+	Load a Shopify product over the REST API: the product, its metafields, and the metafields of each variant.
+	
+	The product, its metafields and the metafields of every variant are fetched concurrently, with at most
+	`max_workers` requests in flight at once (defaults to app.config['SHOPIFY_FETCH_CONCURRENCY']).
+
+	Returns a dict if successful. Raises AuthenticationError or ItemNotFoundError, or returns None, if not.
+	"""
+	
+	if max_workers is None:
+		max_workers = app.config.get('SHOPIFY_FETCH_CONCURRENCY', 8)
+	
+	with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+		# The product and its own metafields don't depend on each other, so start both right away
+		product_future = pool.submit( in_context(get_shopify_product_json), product_id )
+		metafields_future = pool.submit( in_context(get_metafields), product_id )
+		
+		p = product_future.result()
+		if not isinstance(p, dict):
+			return p	# non-JSON reply from Shopify, pass it along like we always have
+		
+		# Sigh. Shopify returns the variants as a list of dicts. Reformat this into a dict with
+		# 	variants[variant_id] = {variant_dict}, for ease of manipulation later.
+		# This means we will have to undo this transformation when we're writing a product later.
+		# Also grab the metafields for each Variant as we go - these only need the variant IDs, so they
+		# 	can all go out at once.
+		try:
+			pvs = p['product']['variants']
+		except KeyError:
+			pvs = {}
+		
+		variant_futures = []
+		p['product']['variants'] = {}
+		for v in pvs:
+			vid = v['id']
+			p['product']['variants'][vid] = v				# Add the variant data to the 'variants' dict
+			variant_futures.append( (vid, pool.submit( in_context(get_variant_metafields), product_id, vid )) )
+		
+		# Retrieve metafields and add them in
+		p['product']['metafields'] = metafields_future.result()
+		for vid, f in variant_futures:
+			p['product']['variants'][vid]['metafields'] = f.result()
+		
+	return p
+
+def get_shopify_product_json(product_id):
+	"""
+	Fetch the bare Shopify product JSON (no metafields, variants still a list) for `product_id`.
+	
+	Raises ItemNotFoundError if Shopify doesn't know the product. Returns a string if Shopify replies with something
+	that isn't JSON.
+	"""
+	
 	#   TODO: Why the fuck am I doing this manually when I have the Shopify API right here?
-	url = 'https://' + app.config['SHOPIFY_STORE_DOMAIN'] + '/admin/api/2019-04/products/' + product_id + '.json'
+	url = 'https://' + app.config['SHOPIFY_STORE_DOMAIN'] + '/admin/api/2019-04/products/' + str(product_id) + '.json'
 	logger.debug("Trying to GET the Shopify product {} by hitting {}".format(product_id, url))
-	logger.debug("Using auth: {}:{}".format(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW']))
-	response = requests.get(
+	response = shopify_client().get(
 		url,
-		auth=(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW'])
 	)
 	try:
 		p = response.json()
@@ -110,37 +464,308 @@ def get_shopify_product(product_id):
 		return 'Shopify said...' + response.text
 		
 	if response.status_code == 404:
-		raise ItemNotFoundError()
+		raise ItemNotFoundError('No Shopify product with ID {}'.format(product_id))
+	
+	return p
+
+SHOPIFY_VARIANT_FIELDS = '''
+	legacyResourceId
+	title
+	price
+	sku
+	position
+	inventoryPolicy
+	compareAtPrice
+	fulfillmentService { handle }
+	inventoryManagement
+	selectedOptions { name value }
+	createdAt
+	updatedAt
+	taxable
+	barcode
+	weight
+	weightUnit
+	inventoryItem { legacyResourceId }
+	inventoryQuantity
+	requiresShipping
+	image { id }
+	metafields(first: $variantMetafieldsFirst) {
+		pageInfo { hasNextPage }
+		edges { cursor node { key value } }
+	}
+'''
+
+SHOPIFY_PRODUCT_QUERY = '''
+query loadProduct($id: ID!, $variantsFirst: Int!, $metafieldsFirst: Int!, $variantMetafieldsFirst: Int!, $imagesFirst: Int!) {
+	product(id: $id) {
+		legacyResourceId
+		title
+		descriptionHtml
+		vendor
+		productType
+		createdAt
+		handle
+		updatedAt
+		publishedAt
+		templateSuffix
+		tags
+		options { id name position values }
+		images(first: $imagesFirst) {
+			edges { node { id altText originalSrc width height } }
+		}
+		metafields(first: $metafieldsFirst) {
+			pageInfo { hasNextPage }
+			edges { cursor node { key value } }
+		}
+		variants(first: $variantsFirst) {
+			pageInfo { hasNextPage }
+			edges { cursor node { ''' + SHOPIFY_VARIANT_FIELDS + ''' } }
+		}
+	}
+}
+'''
+
+SHOPIFY_VARIANTS_PAGE_QUERY = '''
+query loadVariants($id: ID!, $variantsFirst: Int!, $variantMetafieldsFirst: Int!, $after: String) {
+	product(id: $id) {
+		variants(first: $variantsFirst, after: $after) {
+			pageInfo { hasNextPage }
+			edges { cursor node { ''' + SHOPIFY_VARIANT_FIELDS + ''' } }
+		}
+	}
+}
+'''
+
+SHOPIFY_METAFIELDS_PAGE_QUERY = '''
+query loadMetafields($id: ID!, $after: String) {
+	node(id: $id) {
+		... on HasMetafields {
+			metafields(first: 250, after: $after) {
+				pageInfo { hasNextPage }
+				edges { cursor node { key value } }
+			}
+		}
+	}
+}
+'''
+
+SHOPIFY_WEIGHT_UNITS = {'POUNDS': 'lb', 'OUNCES': 'oz', 'KILOGRAMS': 'kg', 'GRAMS': 'g'}
+SHOPIFY_GRAMS_PER_UNIT = {'POUNDS': 453.59237, 'OUNCES': 28.349523125, 'KILOGRAMS': 1000.0, 'GRAMS': 1.0}
+
+def shopify_graphql(query, variables=None, cost=None):
+	"""
+	Run a query against the Shopify Admin GraphQL API. `cost` is the query's estimated cost, which the rate limiter
+	makes room for before sending it (Shopify's real cost comes back in the reply).
 	
-	# Retrieve metafields and add them in
-	p['product']['metafields'] = get_metafields( product_id )
+	Returns a tuple of (data, cost), where `cost` is the `extensions.cost` dict Shopify sends back
+	(requestedQueryCost, actualQueryCost, throttleStatus). Raises AuthenticationError if Shopify rejects our
+	credentials, or RuntimeError if the query itself fails.
+	"""
+	
+	url = 'https://{domain}/admin/api/2019-04/graphql.json'.format( domain=app.config['SHOPIFY_STORE_DOMAIN'] )
+	response = shopify_client().post(
+		url,
+		cost=cost,
+		json={'query': query, 'variables': variables or {}}
+	)
+	
+	if response.status_code in (401, 403):
+		raise AuthenticationError('Shopify rejected our credentials: {}'.format(response.text))
 	
-	# Sigh. Shopify returns the metafields as a list of dicts. Reformat this into a dict with
-	# 	variants[variant_id] = {variant_dict}, for ease of manipulation later.
-	# This means we will have to undo this transformation when we're writing a product later.
-	# Also grab the metafields for each Variant as we go.
 	try:
-		pvs = p['product']['variants']
-	except KeyError:
-		pvs = {}
+		j = response.json()
+	except json.JSONDecodeError:
+		logger.error('Shopify said something that is not JSON: ' + response.text)
+		raise RuntimeError('Bad response from Shopify GraphQL: {}'.format(response.text))
+		
+	cost = j.get('extensions', {}).get('cost', {})
+	if 'errors' in j:
+		logger.warning('Shopify GraphQL errors: {}'.format(json.dumps(j['errors'])))
+		raise RuntimeError('Shopify GraphQL error: {}'.format(json.dumps(j['errors'])))
+		
+	return j['data'], cost
+
+def estimate_product_query_cost(variants_first, metafields_first, variant_metafields_first, images_first):
+	"""
+	Rough requested cost of SHOPIFY_PRODUCT_QUERY, using Shopify's rules (objects cost 1, connections cost 2 plus
+	whatever each of their `first` nodes costs). Shopify's own number comes back in the reply; this is only for
+	picking page sizes that stay under the single-query limit.
+	"""
 	
-	p['product']['variants'] = {}
-	for v in pvs:
-		vid = v['id']
-		p['product']['variants'][vid] = v				# Add the variant data to the 'variants' dict
+	variant_cost = 1 + 1 + 1 + 1 + (2 + variant_metafields_first)	# variant, fulfillmentService, inventoryItem, image, metafields
+	return 1 + (2 + images_first) + (2 + metafields_first) + 2 + variants_first * variant_cost
+
+def get_shopify_product_graphql(product_id):
+	"""
+	Load a Shopify product, its variants and all of their metafields with a single GraphQL query.
+	
+	Returns a tuple of (product, cost). `product` is the same dict `get_shopify_product_rest()` returns - REST
+	field names, `variants` keyed by integer variant ID, metafields flattened to {key: value}. `cost` is the
+	`extensions.cost` reported by Shopify, with `actualQueryCost` summed over any follow-up pages.
+	
+	Page sizes are chosen so the query stays under app.config['SHOPIFY_GRAPHQL_COST_BUDGET']. Products with more
+	variants or metafields than fit in one query get follow-up page queries, so nothing is silently truncated.
+	
+	Raises ItemNotFoundError if Shopify doesn't know the product.
+	"""
+	
+	budget = app.config.get('SHOPIFY_GRAPHQL_COST_BUDGET', 1000)
+	variants_first = app.config.get('SHOPIFY_GRAPHQL_VARIANTS_PER_PAGE', 50)
+	metafields_first = 50
+	images_first = 20
+	
+	# Give whatever is left of the budget to variant metafields
+	fixed = estimate_product_query_cost(variants_first, metafields_first, 0, images_first)
+	variant_metafields_first = max(1, min(50, (budget - fixed) // variants_first))
+	
+	gid = 'gid://shopify/Product/{}'.format(product_id)
+	variables = {
+		'id': gid,
+		'variantsFirst': variants_first,
+		'metafieldsFirst': metafields_first,
+		'variantMetafieldsFirst': variant_metafields_first,
+		'imagesFirst': images_first
+		}
+	estimated_cost = estimate_product_query_cost(variants_first, metafields_first, variant_metafields_first, images_first)
+	logger.debug('Trying to load Shopify product {} over GraphQL (estimated cost {})'.format(product_id, estimated_cost))
+	data, cost = shopify_graphql( SHOPIFY_PRODUCT_QUERY, variables, cost=estimated_cost )
+	total_cost = dict(cost)
+	
+	gp = data.get('product')
+	if gp is None:
+		raise ItemNotFoundError('No Shopify product with ID {}'.format(product_id))
 		
-		vmfs = get_variant_metafields( product_id, vid )
-		p['product']['variants'][vid]['metafields'] = vmfs
+	variant_edges = list(gp['variants']['edges'])
+	has_next = gp['variants']['pageInfo']['hasNextPage']
+	while has_next:
+		data, cost = shopify_graphql( SHOPIFY_VARIANTS_PAGE_QUERY, {
+				'id': gid,
+				'variantsFirst': variants_first,
+				'variantMetafieldsFirst': variant_metafields_first,
+				'after': variant_edges[-1]['cursor']	}, cost=estimated_cost )
+		total_cost['actualQueryCost'] = total_cost.get('actualQueryCost', 0) + cost.get('actualQueryCost', 0)
+		total_cost['throttleStatus'] = cost.get('throttleStatus', total_cost.get('throttleStatus'))
+		variant_edges.extend( data['product']['variants']['edges'] )
+		has_next = data['product']['variants']['pageInfo']['hasNextPage']
 		
-	return p
+	def flatten_metafields(owner_gid, connection):
+		"""Turn a metafields connection into {key: value}, fetching any pages that didn't fit in the first query."""
+		m = {}
+		edges = connection['edges']
+		has_next = connection['pageInfo']['hasNextPage']
+		while True:
+			for e in edges:
+				m[e['node']['key']] = e['node']['value']
+			if not has_next:
+				return m
+			data, cost = shopify_graphql( SHOPIFY_METAFIELDS_PAGE_QUERY, {'id': owner_gid, 'after': edges[-1]['cursor']}, cost=252 )
+			total_cost['actualQueryCost'] = total_cost.get('actualQueryCost', 0) + cost.get('actualQueryCost', 0)
+			edges = data['node']['metafields']['edges']
+			has_next = data['node']['metafields']['pageInfo']['hasNextPage']
+			
+	pid = int(gp['legacyResourceId'])
+	product = {
+		'id': pid,
+		'title': gp['title'],
+		'body_html': gp['descriptionHtml'],
+		'vendor': gp['vendor'],
+		'product_type': gp['productType'],
+		'created_at': gp['createdAt'],
+		'handle': gp['handle'],
+		'updated_at': gp['updatedAt'],
+		'published_at': gp['publishedAt'],
+		'template_suffix': gp['templateSuffix'],
+		'tags': ', '.join(gp['tags']),
+		'admin_graphql_api_id': gid,
+		'options': [],
+		'images': [],
+		'variants': {},
+		'metafields': flatten_metafields( gid, gp['metafields'] )
+		}
+	
+	for o in gp['options']:
+		product['options'].append({
+			'id': gid_to_id(o['id']),
+			'product_id': pid,
+			'name': o['name'],
+			'position': o['position'],
+			'values': o['values']
+			})
+	
+	for idx, e in enumerate(gp['images']['edges']):
+		i = e['node']
+		product['images'].append({
+			'id': gid_to_id(i['id']),
+			'product_id': pid,
+			'position': idx + 1,
+			'alt': i['altText'],
+			'width': i['width'],
+			'height': i['height'],
+			'src': i['originalSrc'],
+			'variant_ids': [],
+			'admin_graphql_api_id': i['id']
+			})
+	product['image'] = product['images'][0] if len(product['images']) > 0 else None
+	images_by_id = {i['id']: i for i in product['images']}
+			
+	for e in variant_edges:
+		gv = e['node']
+		vid = int(gv['legacyResourceId'])
+		options = [o['value'] for o in gv['selectedOptions']] + [None, None, None]
+		image_id = gid_to_id(gv['image']['id']) if gv['image'] is not None else None
+		if image_id in images_by_id:
+			images_by_id[image_id]['variant_ids'].append(vid)
+		
+		inventory_management = gv['inventoryManagement'].lower()
+		if inventory_management == 'not_managed':
+			inventory_management = None
+		
+		product['variants'][vid] = {
+			'id': vid,
+			'product_id': pid,
+			'title': gv['title'],
+			'price': gv['price'],
+			'sku': gv['sku'],
+			'position': gv['position'],
+			'inventory_policy': gv['inventoryPolicy'].lower(),
+			'compare_at_price': gv['compareAtPrice'],
+			'fulfillment_service': gv['fulfillmentService']['handle'],
+			'inventory_management': inventory_management,
+			'option1': options[0],
+			'option2': options[1],
+			'option3': options[2],
+			'created_at': gv['createdAt'],
+			'updated_at': gv['updatedAt'],
+			'taxable': gv['taxable'],
+			'barcode': gv['barcode'],
+			'grams': int(round( (gv['weight'] or 0) * SHOPIFY_GRAMS_PER_UNIT.get(gv['weightUnit'], 1.0) )),
+			'image_id': image_id,
+			'weight': gv['weight'],
+			'weight_unit': SHOPIFY_WEIGHT_UNITS.get(gv['weightUnit'], gv['weightUnit']),
+			'inventory_item_id': int(gv['inventoryItem']['legacyResourceId']),
+			'inventory_quantity': gv['inventoryQuantity'],
+			'old_inventory_quantity': gv['inventoryQuantity'],
+			'requires_shipping': gv['requiresShipping'],
+			'admin_graphql_api_id': 'gid://shopify/ProductVariant/{}'.format(vid),
+			'metafields': flatten_metafields( 'gid://shopify/ProductVariant/{}'.format(vid), gv['metafields'] )
+			}
+			
+	return {'product': product}, total_cost
+
+def gid_to_id(gid):
+	"""Turn a Shopify GraphQL global ID ('gid://shopify/ProductImage/123', maybe with a ?query) into the REST integer ID."""
+	return int( gid.split('?')[0].rsplit('/', 1)[-1] )
 
 def set_shopify_attributes(product_id, attributes):
 	"""
 	Set Shopify product attributes from a dict.
 	
 	Shopify's `product` endpoint doesn't include metafields in the response, which is annoying.
-	So - if we have metafields present in the update request, we will make a separate call to 
-	`set_metafield()` for each metafield.
+	So - if we have metafields present in the update request (for the product or any of its variants), we
+	collect them all and hand them to `set_metafields_batch()`, which only writes the ones that changed.
+	
+	If we have a recent copy of the product (see `cached_shopify_product()`) and none of the other attributes
+	differ from it, the product PUT is skipped too.
 	"""
 	
 
@@ -149,9 +774,8 @@ def set_shopify_attributes(product_id, attributes):
 		pRequest = {"product": attributes}
 		pRequest['product']['id'] = product_id
 		
-		if 'metafields' in attributes:
-			for k,v in attributes['metafields'].items():
-				set_metafield(product_id, k, v)
+		product_metafields = attributes.get('metafields')
+		variant_metafields = {}
 		
 		#import pdb; pdb.set_trace();
 		
@@ -159,16 +783,12 @@ def set_shopify_attributes(product_id, attributes):
 		if 'variants' in attributes:
 			newVariants = []
 			for vid in attributes['variants'].keys():
-				v = copy.deepcopy( attributes['variants'][vid] )
+				v = dict( attributes['variants'][vid] )
 				v['id'] = vid
 				
-				# Also need to reformat metafields for each variant
-				if 'metafields' in attributes['variants'][vid]:
-					v['metafields'] = []
-					for key, val in attributes['variants'][vid]['metafields'].items():
-						logger.debug("Adding metafield {} => {}".format(key, val))
-						v['metafields'].append( {"key": key, "value": val, "namespace": "global", "value_type": "string"} )
-						logger.debug("Now variant metafields are: {}".format(json.dumps(v['metafields'])))
+				# Variant metafields get written along with the product's, below
+				if 'metafields' in v:
+					variant_metafields[vid] = v.pop('metafields')
 						
 				newVariants.append(v)
 				
@@ -176,21 +796,25 @@ def set_shopify_attributes(product_id, attributes):
 			
 		pRequest['product'].pop('metafields', None)
 		
-		# Hit the Product endpoint first
-		#   TODO: Why the fuck am I doing this manually when I have the Shopify API right here?
-		url = 'https://' + app.config['SHOPIFY_STORE_DOMAIN'] + '/admin/api/2019-04/products/' + product_id + '.json'
-		logger.debug("Trying to PUT to the Shopify product {} by hitting {}".format(product_id, url))
-		logger.debug("Using auth: {}:{}".format(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW']))
-		response = requests.put(
-			url,
-			auth=(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW']),
-			json=pRequest
-		)
-		p = response.json()
-		logger.debug("Shopify said: " + response.text)
+		# Only PUT the product if there's something besides metafields to write, and it's not what Shopify already has
+		if len(pRequest['product']) > 1 and not shopify_product_unchanged( product_id, pRequest['product'] ):
+			#   TODO: Why the fuck am I doing this manually when I have the Shopify API right here?
+			url = 'https://' + app.config['SHOPIFY_STORE_DOMAIN'] + '/admin/api/2019-04/products/' + str(product_id) + '.json'
+			logger.debug("Trying to PUT to the Shopify product {} by hitting {}".format(product_id, url))
+			response = shopify_client().put(
+				url,
+				json=pRequest
+			)
+			invalidate_shopify_product(product_id)
+			count_write( 'shopify_product', skipped=False )
+			p = response.json()
+			logger.debug("Shopify said: " + response.text)
+			
+			if "errors" in p:
+				raise ProductWriteError( json.dumps(p['errors']) )
 		
-		if "errors" in p:
-			raise ProductWriteError( json.dumps(p['errors']) )
+		if product_metafields or variant_metafields:
+			set_metafields_batch( product_id, product_metafields, variant_metafields )
 			
 	except json.JSONDecodeError:
 		logger.error('Shopify said something that is not JSON: ' + response.text)
@@ -198,6 +822,195 @@ def set_shopify_attributes(product_id, attributes):
 	
 	return True
 
+def ebay_auth_token():
+	"""
+	A valid eBay access token for the current user (or, outside a request, for the background account) from the
+	token manager (see ebay_tokens.py). Raises AuthenticationError if there isn't one.
+	"""
+	try:
+		return ebay_tokens.access_token()
+	except ebay_tokens.TokenError as e:
+		raise AuthenticationError(e.message)
+
+_ebay_object_cache = None
+_ebay_object_cache_lock = threading.Lock()
+
+"""Fields we add to eBay objects for the UI. eBay doesn't store them, so they never count as a change."""
+EBAY_LOCAL_FIELDS = ('_gl_ebay_type', 'offers', 'variants')
+
+"""Kinds of eBay object we cache, used as the first part of the cache key"""
+EBAY_ITEM = 'item'
+EBAY_GROUP = 'group'
+EBAY_OFFER = 'offer'
+
+def ebay_object_cache():
+	"""
+	The last representation of each eBay inventory item, inventory item group and offer this worker fetched or
+	wrote, keyed like 'item:<sku>'. The read-modify-write functions (`set_ebay_attributes()` and friends) merge
+	against these instead of GETting the object again right after the UI loaded it.
+	
+	eBay's copy can still change behind our back (another app, the eBay website, another worker), so entries only
+	live for EBAY_CACHE_TTL seconds, and every write function takes `revalidate=True` to fetch a fresh copy.
+	"""
+	global _ebay_object_cache
+	with _ebay_object_cache_lock:
+		if _ebay_object_cache is None:
+			_ebay_object_cache = TTLCache(
+				'ebay_objects',
+				maxsize=app.config.get('EBAY_CACHE_SIZE', 1024),
+				ttl=app.config.get('EBAY_CACHE_TTL', 120)	)
+		return _ebay_object_cache
+
+def cached_ebay_object(kind, key):
+	"""
+	Return the cached eBay object, or None. It's shared with the cache, so treat it as read-only - `merge()`
+	never changes its inputs, so merging into it is fine.
+	"""
+	return ebay_object_cache().get( '{}:{}'.format(kind, key) )
+
+def ebay_object_generation(kind, key):
+	"""Note this before fetching an object and pass it to `remember_ebay_object()`. See `TTLCache`."""
+	return ebay_object_cache().generation( '{}:{}'.format(kind, key) )
+
+def remember_ebay_object(kind, key, obj, generation=None):
+	"""
+	Cache an eBay object we just fetched (pass the `generation` from before the fetch) or wrote.
+	
+	Only the top level is copied: callers may add keys to the object they got from eBay (like `offers` for the
+	UI), but nothing changes anything below that.
+	"""
+	ebay_object_cache().put( '{}:{}'.format(kind, key), dict(obj), generation=generation )
+
+def invalidate_ebay_object(kind, key):
+	"""
+	Forget the cached eBay object, and make sure reads already in flight don't put it back. The eBay mirror stops
+	serving it until its next sync, too, and its fingerprint (see fingerprints.py) is dropped, so the next
+	incremental sync pushes it again.
+	
+	Call it once a write has gone through (or might have), not before: a read between the invalidate and the
+	write would just cache the old object again.
+	"""
+	ebay_object_cache().invalidate( '{}:{}'.format(kind, key) )
+	ebay_mirror.get_mirror().invalidate( kind, key )
+	fingerprints.get_store().forget( kind, key )
+
+@contextlib.contextmanager
+def ebay_write_attempt(kind, keys):
+	"""
+	Wrap the request of a write to the eBay objects `keys`: if it raises (a timeout, a dropped connection) we
+	can't tell whether eBay took the write, so they're invalidated just in case. Works around an `await`, too.
+	"""
+	try:
+		yield
+	except Exception:
+		for key in keys:
+			invalidate_ebay_object( kind, key )
+		raise
+
+"""The write counter (see count_write()) for each kind of eBay object"""
+EBAY_WRITE_COUNTERS = {EBAY_ITEM: 'ebay_item', EBAY_GROUP: 'ebay_group', EBAY_OFFER: 'ebay_offer'}
+
+def merge_ebay_object(kind, old, attributes):
+	"""
+	Merge new `attributes` into the eBay object `old` the way we write it back. Returns (new, changes), like
+	`merge_changes()`.
+	
+	For a group, the UI's `variants` aren't part of it (they're written as items), and `variesBy` is replaced as
+	a whole rather than merged - or kept as it was, if `attributes` doesn't have one (the catalog sync only sends
+	what it maps).
+	"""
+	if kind != EBAY_GROUP:
+		return merge_changes( old, attributes, ignore=EBAY_LOCAL_FIELDS )
+	
+	attributes = {k: v for k, v in attributes.items() if k != 'variants'}
+	oldVariesBy = old.get('variesBy')
+	old = {k: v for k, v in old.items() if k != 'variesBy'}
+	new, changes = merge_changes( old, attributes, ignore=EBAY_LOCAL_FIELDS + ('sku',) )
+	if 'variesBy' not in attributes and oldVariesBy is not None:
+		new = dict(new, variesBy=oldVariesBy)
+	if new.get('variesBy') != oldVariesBy:
+		changes.append( (('variesBy',), oldVariesBy, new.get('variesBy')) )
+	return new, changes
+
+def plan_ebay_write(kind, key, old, attributes):
+	"""
+	The merge-and-skip half of the read-modify-write functions (`set_ebay_attributes()`, `update_ebay_offer()`,
+	`set_ebay_inventoryitemgroup()` and their glitchlab_async versions): merge `attributes` into `old`, the eBay
+	object `key`, and return what to PUT back - or None if that wouldn't change anything. Counts the write.
+	"""
+	try:
+		new, changes = merge_ebay_object( kind, old, attributes )
+	except Exception as e:
+		from pprint import pformat
+		logger.error('Failed to merge new attributes into eBay {} {}. merge() says: {}'.format(kind, key, e))
+		logger.error('Old {}: {}'.format(kind, pformat(old, width=120)))
+		logger.error('Attributes attempting to merge in: {}'.format(pformat(attributes, width=120)) )
+		raise
+	
+	if len(changes) == 0:
+		logger.debug('Nothing changed in eBay {} {}, not writing it'.format( kind, key ))
+		count_write( EBAY_WRITE_COUNTERS[kind], skipped=True )
+		return None
+	
+	logger.debug('Trying to update eBay {} {} ({})...'.format( kind, key, describe_changes(changes) ))
+	count_write( EBAY_WRITE_COUNTERS[kind], skipped=False )
+	return new
+
+def read_ebay_write_reply(kind, key, new, response):
+	"""
+	The other half: eBay's `response` to the PUT of `new`. Invalidates the object and remembers `new` if eBay
+	took it, and raises the appropriate error if it didn't (leaving the cache, mirror and fingerprint alone, since
+	nothing changed). Returns eBay's reply ({} for 204 No Content).
+	"""
+	logger.debug('Raw reply from eBay: {}'.format(response.text))
+	if response.status_code == 204:
+		# 204 No Content, this is a good thing
+		invalidate_ebay_object( kind, key )
+		remember_ebay_object( kind, key, new )
+		return {}
+	
+	try:
+		j = response.json()
+	except json.JSONDecodeError:
+		# No telling what happened
+		logger.warning('Got a weird reply from eBay: {}'.format(response.text))
+		invalidate_ebay_object( kind, key )
+		raise RuntimeError('eBay weird reply')
+	handle_ebay_errors( j )
+	invalidate_ebay_object( kind, key )
+	return j
+
+def read_ebay_object(kind, key, response, generation):
+	"""
+	The item or group in eBay's `response` to a GET of `key`; raises the appropriate error if eBay doesn't have it.
+	Learns what type of SKU it is and caches it (`generation` is from before the GET).
+	"""
+	try:
+		j = response.json()
+	except json.JSONDecodeError:
+		logger.warning('Got a weird reply from eBay: {}'.format(response.text))
+		raise RuntimeError('eBay weird reply')
+	handle_ebay_errors( j )
+	
+	index = sku_index.get_sku_index()
+	if kind == EBAY_GROUP:
+		index.learn( key, sku_index.INVENTORY_ITEM_GROUP )
+		index.learn_many( j.get('variantSKUs', []), sku_index.INVENTORY_ITEM )
+	else:
+		index.learn( key, sku_index.INVENTORY_ITEM )
+	remember_ebay_object( kind, key, j, generation=generation )
+	return j
+
+def cached_ebay_items(skus, revalidate=False):
+	"""The items in `skus` we have a cached copy of, as {sku: item} (none, if `revalidate`), and a list of the rest."""
+	items = {}
+	if not revalidate:
+		for sku in skus:
+			item = cached_ebay_object( EBAY_ITEM, sku )
+			if item is not None:
+				items[sku] = item
+	return items, [sku for sku in skus if sku not in items]
+
 def get_ebay_offer_ids( product_sku ):
 	"""Get the eBay offer ID (or offer IDs) for a given product SKU."""
 	
@@ -211,19 +1024,12 @@ def get_ebay_offer_ids( product_sku ):
 	
 def get_ebay_offers( product_sku ):
 	"""Get all of the eBay offers for a given product SKU."""
-	try:
-		auth_token = session['access_token']
-	except KeyError as e:
-		raise AuthenticationError("No access token provided")
+	auth_token = ebay_auth_token()
 		
 	url = app.config['EBAY_INVENTORYOFFERS_URL'].format( product_sku )
 	
-	headers = {
-		'Authorization': 'Bearer {}'.format( auth_token ),
-		'Content-Language': 'en-US'
-		}
 	logger.debug('Trying to get offers for eBay SKU {}...'.format( product_sku ))
-	response = requests.get( url, headers=headers )
+	response = ebay_client().get( url, auth_token=auth_token )
 	logger.debug('Raw reply from eBay: {}'.format(response.text))
 	
 	try:
@@ -243,6 +1049,7 @@ def get_ebay_offers( product_sku ):
 	try:
 		for offer in response.json()['offers']:
 			offers.append(offer)
+			remember_ebay_object( EBAY_OFFER, offer['offerId'], offer )
 	except KeyError:
 		logger.warning("Didn't find errors OR offers in eBay reply...")
 		return ('eBay weird reply') #TODO should raise exception here
@@ -260,19 +1067,13 @@ def get_ebay_offer( offer_id ):
 	`inventoryItem` itself.
 	"""
 	
-	try:
-		auth_token = session['access_token']
-	except KeyError as e:
-		raise AuthenticationError("No access token provided")
+	auth_token = ebay_auth_token()
 		
 	url = app.config['EBAY_INVENTORYOFFER_URL'].format( offer_id )
 	
-	headers = {
-		'Authorization': 'Bearer {}'.format( auth_token ),
-		'Content-Language': 'en-US'
-		}
 	logger.debug('Trying to get offer ID {}...'.format( offer_id ))
-	response = requests.get( url, headers=headers )
+	generation = ebay_object_generation( EBAY_OFFER, offer_id )
+	response = ebay_client().get( url, auth_token=auth_token )
 	logger.debug('Raw reply from eBay: {}'.format(response.text))
 	
 	try:
@@ -289,61 +1090,40 @@ def get_ebay_offer( offer_id ):
 		
 	handle_ebay_errors(j)
 	
+	remember_ebay_object( EBAY_OFFER, offer_id, j, generation=generation )
 	return( j )
 	
-def update_ebay_offer( offer_id, update_fields ):
+def update_ebay_offer( offer_id, update_fields, revalidate=False ):
 	"""
 	Update an eBay offer by its ID (`offer_id`). 
 	
 	`update_ebay_offer()` will fetch the existing eBay offer, then merge in the fields provided in `update_fields`.
+	If we fetched or wrote the offer in the last EBAY_CACHE_TTL seconds, that copy is used instead of fetching it
+	again, unless `revalidate` is True.
 	
 	It will fail if the eBay offer does not exist yet (you can't use it to make a new offer.)
 	"""
-	try:
-		auth_token = session['access_token']
-	except KeyError as e:
-		raise AuthenticationError("No access token provided")
+	auth_token = ebay_auth_token()
 		
 	"""1. Fetch old offer to update"""
+	old = None if revalidate else cached_ebay_object( EBAY_OFFER, offer_id )
 	try:
-		old = get_ebay_offer( offer_id )
+		if old is None:
+			old = get_ebay_offer( offer_id )
 	except ItemNotFoundError:
 		logger.info('set_ebay_attributes called for offer ID {}, but eBay says item not found'.format(offer_id))
 		return None
 	
 	"""2. Merge in new fields"""
-	try:
-		new = merge( old, update_fields )
-	except RuntimeError as e:
-		from pprint import pprint
-		logger.error('Failed to merge new attributes into eBay offer dict. merge() says: {}'.format(e))
-		logger.error('Attributes attempting to merge in: {}'.format(pprint(update_fields)) )
+	new = plan_ebay_write( EBAY_OFFER, offer_id, old, update_fields )
+	if new is None:
+		return {}
 		
 	"""3. Call eBay's updateOffer with the merged offer"""
 	url = app.config['EBAY_INVENTORYOFFER_URL'].format( offer_id )
-	headers = {
-		'Authorization': 'Bearer {}'.format( auth_token ),
-		'Content-Language': 'en-US'
-		}
-	logger.debug('Trying to update eBay offer ID {}...'.format( offer_id ))
-	response = requests.put( url, headers=headers, json=new )
-	logger.debug('Raw reply from eBay: {}'.format(response.text))
-	
-	if response.status_code == 204:
-		# 204 No Content, this is a good thing
-		logger.debug('eBay returned 204 No Content, assume all went well')
-		return {}
-		
-	try:
-		j = response.json()
-	except json.JSONDecodeError:
-		j = None
-		logger.warning('Got a weird reply from eBay: {}'.format(response.text))
-		raise RuntimeError("eBay weird reply")
-		
-	handle_ebay_errors( j )
-	
-	return None
+	with ebay_write_attempt( EBAY_OFFER, [offer_id] ):
+		response = ebay_client().put( url, auth_token=auth_token, json=new )
+	return read_ebay_write_reply( EBAY_OFFER, offer_id, new, response )
 		
 def handle_ebay_errors( ebay_reply ):
 	"""
@@ -368,66 +1148,216 @@ def handle_ebay_errors( ebay_reply ):
 				logger.warning("Unexpected eBay error: {}".format( json.dumps(ebay_reply) ))
 				raise RuntimeError( ebay_reply )
 	
-def set_ebay_attributes(product_sku, attributes):
-	"""Set eBay inventory item attributes from a dict."""
+def set_ebay_attributes(product_sku, attributes, revalidate=False):
+	"""
+	Set eBay inventory item attributes from a dict.
 	
-	try:
-		auth_token = session['access_token']
-	except KeyError as e:
-		raise AuthenticationError("No access token provided")
+	Merges against the copy of the item we fetched or wrote in the last EBAY_CACHE_TTL seconds, if there is one,
+	unless `revalidate` is True.
+	"""
+	
+	auth_token = ebay_auth_token()
 	
 	# 1. Fetch the existing inventory item (eBay will overwrite all fields when we update, so merge locally)
+	iOld = None if revalidate else cached_ebay_object( EBAY_ITEM, product_sku )
 	try:
-		iOld = get_ebay_product( auth_token, product_sku )
+		if iOld is None:
+			iOld = get_ebay_product( auth_token, product_sku )
 	except ItemNotFoundError:
-		logger.info('set_ebay_attributes called for SKU {sku}, but eBay says item not found'.format(product_sku))
+		logger.info('set_ebay_attributes called for SKU {}, but eBay says item not found'.format(product_sku))
 		raise
 	
 	# 2. Merge new attributes with existing inventory item
-	try:
-		iNew = merge(iOld, attributes)
-	except Exception as e:
-		from pprint import pformat
-		logger.error('Failed to merge new attributes into eBay product dict. merge() says: {}'.format(e))
-		logger.error('Old item: {}'.format(pformat(iOld, width=120)))
-		logger.error('Attributes attempting to merge in: {}'.format(pformat(attributes, width=120)) )
-		raise
+	iNew = plan_ebay_write( EBAY_ITEM, product_sku, iOld, attributes )
+	if iNew is None:
+		return {}
 	
 	# 3. Call createOrReplaceInventoryItem
 	url = app.config['EBAY_INVENTORYITEM_URL'].format( product_sku )
-	headers = {
-		'Authorization': 'Bearer {}'.format( auth_token ),
-		'Content-Language': 'en-US'
-		}
-	logger.debug('Trying to update eBay SKU {}...'.format( product_sku ))
-	response = requests.put( url, headers=headers, json=iNew )
-	logger.debug('Raw reply from eBay: {}'.format(response.text))
+	with ebay_write_attempt( EBAY_ITEM, [product_sku] ):
+		response = ebay_client().put( url, auth_token=auth_token, json=iNew )
+	return read_ebay_write_reply( EBAY_ITEM, product_sku, iNew, response )
 	
-	if response.status_code == 204:
-		# 204 No Content, this is a good thing
-		logger.debug('eBay returned 204 No Content, assume all went well')
-		return {}
+"""bulkCreateOrReplaceInventoryItem takes at most this many items per call"""
+EBAY_BULK_WRITE_LIMIT = 25
+
+"""Fields getInventoryItem returns that can't be sent back in bulkCreateOrReplaceInventoryItem"""
+EBAY_READ_ONLY_ITEM_FIELDS = ('groupIds', 'inventoryItemGroupKeys')
+
+def set_ebay_attributes_bulk(attributes_by_sku, revalidate=False):
+	"""
+	Bulk version of `set_ebay_attributes()`: `attributes_by_sku` is a dict of {sku: attributes dict}.
+	
+	Like `set_ebay_attributes()`, every existing item is downloaded first and the new attributes merged in, since
+	eBay overwrites the whole item - but the downloads go through `get_ebay_products()` and the uploads through
+	bulkCreateOrReplaceInventoryItem, 25 items per call, so N items take a handful of requests instead of 2N.
+	
+	Returns a dict of {sku: {'ok': bool, 'status': HTTP status for that SKU, 'errors': [eBay error dicts]}}, one
+	entry per SKU. Items with nothing to change aren't sent at all; their entry has 'unchanged': True. Raises AuthenticationError if not authenticated.
+	
+	Items we fetched or wrote in the last EBAY_CACHE_TTL seconds aren't downloaded again, unless `revalidate` is
+	True.
+	"""
+	auth_token = ebay_auth_token()
+	
+	results = {}
+	
+	# 1. Fetch the existing inventory items (eBay will overwrite all fields when we update, so merge locally)
+	old_items, missing = cached_ebay_items( list(attributes_by_sku.keys()), revalidate )
+	if len(missing) > 0:
+		old_items.update( get_ebay_products( auth_token, missing ) )
+	
+	# 2. Merge new attributes with existing inventory items
+	item_requests, merged_items = plan_ebay_bulk_write( attributes_by_sku, old_items, results )
+	
+	# 3. Call bulkCreateOrReplaceInventoryItem
+	url = app.config['EBAY_BULKCREATEORREPLACEINVENTORYITEM_URL']
+	for i in range(0, len(item_requests), EBAY_BULK_WRITE_LIMIT):
+		batch = item_requests[i:i + EBAY_BULK_WRITE_LIMIT]
+		skus = [item['sku'] for item in batch]
+		logger.debug('Trying to bulk update eBay SKUs {}...'.format(skus))
+		with ebay_write_attempt( EBAY_ITEM, skus ):
+			response = ebay_client().post( url, auth_token=auth_token, json={'requests': batch} )
+		record_ebay_bulk_write( response, skus, merged_items, results )
+	
+	return results
+
+def plan_ebay_bulk_write(attributes_by_sku, old_items, results):
+	"""
+	Merge each SKU's new attributes into its item in `old_items` for bulkCreateOrReplaceInventoryItem. Returns
+	(request bodies, {sku: merged item}) for the items that changed; SKUs that are missing, fail to merge or
+	didn't change get their entry in `results` right away.
+	"""
+	item_requests = []
+	merged_items = {}
+	for sku, attributes in attributes_by_sku.items():
+		if sku not in old_items:
+			logger.info('set_ebay_attributes_bulk called for SKU {}, but eBay says item not found'.format(sku))
+			results[sku] = {'ok': False, 'status': 404, 'errors': [{'message': 'Item not found: {}'.format(sku)}]}
+			continue
+		try:
+			iNew, changes = merge_changes(old_items[sku], attributes, ignore=EBAY_LOCAL_FIELDS)
+		except Exception as e:
+			logger.error('Failed to merge new attributes into eBay product dict for SKU {}. merge() says: {}'.format(sku, e))
+			results[sku] = {'ok': False, 'status': 400, 'errors': [{'message': 'Could not merge attributes: {}'.format(e)}]}
+			continue
 		
+		if len(changes) == 0:
+			logger.debug('Nothing changed in eBay SKU {}, not writing it'.format(sku))
+			count_write( 'ebay_item', skipped=True )
+			results[sku] = {'ok': True, 'status': None, 'errors': [], 'unchanged': True}
+			continue
+		count_write( 'ebay_item', skipped=False )
+		
+		merged_items[sku] = iNew
+		body = {k: v for k, v in iNew.items() if k not in EBAY_READ_ONLY_ITEM_FIELDS}
+		body['sku'] = sku
+		body.setdefault('locale', 'en_US')
+		item_requests.append(body)
+	return item_requests, merged_items
+
+def record_ebay_bulk_write(response, skus, merged_items, results):
+	"""
+	Put the outcome of one bulkCreateOrReplaceInventoryItem call for `skus` in `results`, and invalidate and
+	remember the items eBay accepted (or all of them, if we can't tell which it did). `response` can be a `requests`
+	response or anything that looks like one.
+	"""
+	logger.debug('Raw reply from eBay: {}'.format(response.text))
+	
 	try:
 		j = response.json()
 	except json.JSONDecodeError:
-		j = None
+		j = {}
 		logger.warning('Got a weird reply from eBay: {}'.format(response.text))
-		
-	if 'errors' in j:
-		for e in j['errors']:
-			if e['errorId'] == app.config['constants']['EBAY_ERROR_SKU_NOT_FOUND']:
-				raise ItemNotFoundError(e['message'])
-			elif (	e['errorId'] == app.config['constants']['EBAY_ERROR_INVALID_ACCESS_TOKEN'] 	\
-				or 	e['errorId'] == app.config['constants']['EBAY_ERROR_MISSING_ACCESS_TOKEN'] 	\
-				or 	e['errorId'] == app.config['constants']['EBAY_ERROR_ACCESS_DENIED']		    ):
-				raise AuthenticationError(e['message'])
-			else:
-				logger.warning("Unexpected eBay error: {}".format( response.text ))
-				raise RuntimeError("eBay error: {}".format(response.text) )
-				
-	return j
 	
+	if response.status_code not in (200, 207) or 'responses' not in j:
+		try:
+			handle_ebay_errors( j )
+		except (RuntimeError, ItemNotFoundError):
+			pass
+		logger.warning('eBay bulkCreateOrReplaceInventoryItem failed ({}): {}'.format(response.status_code, response.text))
+		for sku in skus:
+			results[sku] = {'ok': False, 'status': response.status_code, 'errors': j.get('errors', [{'message': response.text}])}
+			if response.status_code >= 500 or 'errors' not in j:
+				# Not a clean rejection, so some of them may have been written
+				invalidate_ebay_object( EBAY_ITEM, sku )
+		return
+	
+	for r in j['responses']:
+		status = r.get('statusCode')
+		results[r.get('sku')] = {'ok': status in (200, 201, 204), 'status': status, 'errors': r.get('errors', [])}
+		if results[r.get('sku')]['ok'] and r.get('sku') in skus:
+			invalidate_ebay_object( EBAY_ITEM, r.get('sku') )
+			remember_ebay_object( EBAY_ITEM, r.get('sku'), merged_items[r.get('sku')] )
+	for sku in skus:
+		if sku not in results:
+			results[sku] = {'ok': False, 'status': None, 'errors': [{'message': "eBay didn't report a result for this SKU"}]}
+
+def update_ebay_price_quantity_bulk(updates):
+	"""
+	Set the stock and/or prices of many eBay SKUs with bulkUpdatePriceQuantity, 25 SKUs per call. `updates` is a
+	list of its request bodies: {'sku', 'shipToLocationAvailability': {'quantity'}, 'offers': [{'offerId',
+	'availableQuantity', 'price': {'value', 'currency'}}]}, leaving out whatever isn't changing.
+
+	Unlike `set_ebay_attributes()` nothing is fetched or merged first: eBay only touches the quantity and price
+	fields, and leaves the rest of the item and its offers alone.
+
+	Returns {sku: {'ok': bool, 'status': HTTP status, 'errors': [eBay error dicts]}}, one entry per SKU. Raises
+	AuthenticationError if not authenticated, and RuntimeError if a whole call fails (so none of its SKUs were set).
+	"""
+	auth_token = ebay_auth_token()
+
+	results = {}
+	url = app.config['EBAY_BULKUPDATEPRICEQUANTITY_URL']
+	for i in range(0, len(updates), EBAY_BULK_WRITE_LIMIT):
+		batch = updates[i:i + EBAY_BULK_WRITE_LIMIT]
+		skus = [u['sku'] for u in batch]
+		logger.debug('Trying to bulk update price and quantity of eBay SKUs {}...'.format(skus))
+		for u in batch:
+			count_write( 'ebay_price_quantity', skipped=False )
+		try:
+			response = ebay_client().post( url, auth_token=auth_token, json={'requests': batch} )
+		except Exception:
+			invalidate_price_quantity( batch )
+			raise
+		logger.debug('Raw reply from eBay: {}'.format(response.text))
+
+		try:
+			j = response.json()
+		except json.JSONDecodeError:
+			j = {}
+			logger.warning('Got a weird reply from eBay: {}'.format(response.text))
+
+		if response.status_code not in (200, 207) or 'responses' not in j:
+			if response.status_code >= 500 or 'errors' not in j:
+				# Not a clean rejection, so some of them may have been set
+				invalidate_price_quantity( batch )
+			handle_ebay_errors( j )
+			raise RuntimeError('eBay bulkUpdatePriceQuantity failed ({}): {}'.format(response.status_code, response.text))
+		invalidate_price_quantity( batch )
+
+		# One response per offer, plus one for the item if its quantity was set - a SKU is OK if all of its are
+		for r in j['responses']:
+			sku = r.get('sku')
+			result = results.setdefault( sku, {'ok': True, 'status': None, 'errors': []} )
+			status = r.get('statusCode')
+			result['status'] = status if result['status'] is None or status not in (200, 201, 204) else result['status']
+			if status not in (200, 201, 204):
+				result['ok'] = False
+			result['errors'].extend( r.get('errors', []) )
+		for sku in skus:
+			if sku not in results:
+				results[sku] = {'ok': False, 'status': None, 'errors': [{'message': "eBay didn't report a result for this SKU"}]}
+
+	return results
+
+def invalidate_price_quantity(batch):
+	"""Invalidate the items and offers in a bulkUpdatePriceQuantity `batch` we've sent."""
+	for u in batch:
+		invalidate_ebay_object( EBAY_ITEM, u['sku'] )
+		for offer in u.get('offers', []):
+			invalidate_ebay_object( EBAY_OFFER, offer['offerId'] )
+
 def get_ebay_product(auth_token, product_sku):
 	"""
 	Fetch the eBay product details for product with sku `product_sku`. Return them as a dict.
@@ -437,89 +1367,139 @@ def get_ebay_product(auth_token, product_sku):
 	Raises ItemNotFoundError if item doesn't exist.
 	"""
 	url = app.config['EBAY_INVENTORYITEM_URL'].format(product_sku)
-	auth = {'Authorization': 'Bearer {}'.format(auth_token)}
 	logger.debug('Trying to fetch eBay SKU {}...'.format(product_sku))
-	response = requests.get( url, headers=auth )
+	generation = ebay_object_generation( EBAY_ITEM, product_sku )
+	response = ebay_client().get( url, auth_token=auth_token )
+	return read_ebay_object( EBAY_ITEM, product_sku, response, generation )
+	
+"""bulkGetInventoryItem takes at most this many SKUs per call"""
+EBAY_BULK_GET_LIMIT = 25
+
+def get_ebay_products(auth_token, product_skus, max_workers=None):
+	"""
+	Fetch the eBay inventory items for every SKU in `product_skus`. Returns a dict of {sku: item dict}; SKUs
+	eBay doesn't have are left out.
+	
+	Uses bulkGetInventoryItem, 25 SKUs per call, so a whole inventoryItemGroup usually loads in one or two
+	round trips. If a bulk call fails, or eBay returns an unexpected error for some SKUs, those SKUs are fetched
+	one by one with `get_ebay_product()` instead, at most `max_workers` at once (defaults to
+	app.config['EBAY_FETCH_CONCURRENCY']).
 	
+	Raises AuthenticationError if not authenticated.
+	"""
+	if max_workers is None:
+		max_workers = app.config.get('EBAY_FETCH_CONCURRENCY', 8)
+	
+	skus = []
+	for sku in product_skus:
+		if sku not in skus:
+			skus.append(sku)
+	
+	items = {}
+	retry = []
+	for i in range(0, len(skus), EBAY_BULK_GET_LIMIT):
+		batch = skus[i:i + EBAY_BULK_GET_LIMIT]
+		found, failed = bulk_get_ebay_products( auth_token, batch )
+		items.update(found)
+		retry.extend(failed)
+	
+	if len(retry) > 0:
+		logger.info('Fetching {} eBay SKUs one at a time: {}'.format(len(retry), retry))
+		for sku, item, e in bounded_map( lambda sku: get_ebay_product(auth_token, sku), retry, max_workers ):
+			if isinstance(e, ItemNotFoundError):
+				continue
+			elif e is not None:
+				raise e
+			items[sku] = item
+	
+	sku_index.get_sku_index().learn_many( list(items.keys()), sku_index.INVENTORY_ITEM )
+	return items
+
+def bulk_get_ebay_products(auth_token, product_skus):
+	"""
+	One bulkGetInventoryItem call for up to 25 SKUs. Returns ({sku: item dict}, [SKUs to fetch some other way]).
+	SKUs eBay says don't exist are in neither.
+	"""
+	url = app.config['EBAY_BULKGETINVENTORYITEM_URL']
+	logger.debug('Trying to bulk fetch eBay SKUs {}...'.format(product_skus))
+	generations = {sku: ebay_object_generation( EBAY_ITEM, sku ) for sku in product_skus}
+	response = ebay_client().post( url, auth_token=auth_token, json={'requests': [{'sku': sku} for sku in product_skus]} )
+	return read_ebay_bulk_get( response, product_skus, generations )
+
+def read_ebay_bulk_get(response, product_skus, generations):
+	"""
+	Sort a bulkGetInventoryItem reply into ({sku: item dict}, [SKUs to fetch some other way]) and remember the
+	items, like `bulk_get_ebay_products()`. `generations` is {sku: generation from before the call}.
+	"""
 	try:
 		j = response.json()
 	except json.JSONDecodeError:
-		logger.debug('Got a weird reply from eBay: {}'.format(response.text))
-		
-	handle_ebay_errors( j )
-				
-	return j
+		logger.warning('Got a weird reply from eBay bulkGetInventoryItem: {}'.format(response.text))
+		return {}, list(product_skus)
 	
-def set_ebay_inventoryitemgroup(inventoryitemgroup_key, attributes_in):
+	if response.status_code not in (200, 207) or 'responses' not in j:
+		try:
+			handle_ebay_errors( j )
+		except (RuntimeError, ItemNotFoundError):
+			pass
+		logger.warning('eBay bulkGetInventoryItem failed ({}): {}'.format(response.status_code, response.text))
+		return {}, list(product_skus)
+	
+	items = {}
+	failed = []
+	for r in j['responses']:
+		sku = r.get('sku')
+		if r.get('statusCode') == 200 and 'inventoryItem' in r:
+			item = r['inventoryItem']
+			item.setdefault('sku', sku)
+			items[sku] = item
+			remember_ebay_object( EBAY_ITEM, sku, item, generation=generations.get(sku) )
+			continue
+		
+		try:
+			handle_ebay_errors( r )
+		except ItemNotFoundError:
+			continue
+		except RuntimeError:
+			pass
+		if r.get('statusCode') == 404:
+			continue
+		failed.append(sku)
+	
+	# Anything eBay didn't mention at all gets another try too
+	mentioned = set( r.get('sku') for r in j['responses'] )
+	failed.extend( sku for sku in product_skus if sku not in mentioned )
+	return items, failed
+
+def set_ebay_inventoryitemgroup(inventoryitemgroup_key, attributes_in, revalidate=False):
 	"""
 	Just like `set_ebay_attributes()`, write the attributes given in the `attributes` arg to the given eBay
 	inventoryItemGroup. 
 	
-	Like `set_ebay_attributes()`, download the whole thing first, then update the relevant bits, then re-upload.
+	Like `set_ebay_attributes()`, download the whole thing first (or use the copy from the last EBAY_CACHE_TTL
+	seconds, unless `revalidate` is True), then update the relevant bits, then re-upload.
 	"""
-	try:
-		auth_token = session['access_token']
-	except KeyError as e:
-		raise AuthenticationError("No access token provided")
+	auth_token = ebay_auth_token()
 	
 	# 1. Fetch the existing inventory item (eBay will overwrite all fields when we update, so merge locally)
+	iOld = None if revalidate else cached_ebay_object( EBAY_GROUP, inventoryitemgroup_key )
 	try:
-		iOld = get_ebay_inventoryitemgroup( auth_token, inventoryitemgroup_key )
+		if iOld is None:
+			iOld = get_ebay_inventoryitemgroup( auth_token, inventoryitemgroup_key )
 	except ItemNotFoundError:
-		logger.info('set_ebay_inventoryitemgroup() called for SKU {sku}, but eBay says item not found'.format(inventoryitemgroup_key))
+		logger.info('set_ebay_inventoryitemgroup() called for SKU {}, but eBay says item not found'.format(inventoryitemgroup_key))
 		raise
 		
 	# 2. Merge new attributes with existing inventory item
-	try:
-		attributes = copy.deepcopy(attributes_in)
-		if 'variants' in attributes:
-			del attributes['variants']
-			
-		if 'variesBy' in iOld:			# expect to be passed this in the new item. fuck this code
-			del iOld['variesBy']
-			
-		iNew = merge(iOld, attributes)
-	except Exception as e:
-		from pprint import pformat
-		logger.error('Failed to merge new attributes into eBay product dict. merge() says: {}'.format(e))
-		logger.error('Old item: {}'.format(pformat(iOld, width=120)))
-		logger.error('Attributes attempting to merge in: {}'.format(pformat(attributes, width=120)) )
-		raise
-		
-	# 3. Call createOrReplaceInventoryItem
-	url = app.config['EBAY_INVENTORYITEMGROUP_URL'].format( inventoryitemgroup_key )
-	headers = {
-		'Authorization': 'Bearer {}'.format( auth_token ),
-		'Content-Language': 'en-US'
-		}
-	logger.debug('Trying to update eBay SKU {}...'.format( inventoryitemgroup_key ))
-	response = requests.put( url, headers=headers, json=iNew )
-	logger.debug('Raw reply from eBay: {}'.format(response.text))
-	
-	if response.status_code == 204:
-		# 204 No Content, this is a good thing
-		logger.debug('eBay returned 204 No Content, assume all went well')
+	iNew = plan_ebay_write( EBAY_GROUP, inventoryitemgroup_key, iOld, attributes_in )
+	if iNew is None:
 		return {}
 		
-	try:
-		j = response.json()
-	except json.JSONDecodeError:
-		j = None
-		logger.warning('Got a weird reply from eBay: {}'.format(response.text))
-		
-	if 'errors' in j:
-		for e in j['errors']:
-			if e['errorId'] == app.config['constants']['EBAY_ERROR_SKU_NOT_FOUND']:
-				raise ItemNotFoundError(e['message'])
-			elif (	e['errorId'] == app.config['constants']['EBAY_ERROR_INVALID_ACCESS_TOKEN'] 	\
-				or 	e['errorId'] == app.config['constants']['EBAY_ERROR_MISSING_ACCESS_TOKEN'] 	\
-				or 	e['errorId'] == app.config['constants']['EBAY_ERROR_ACCESS_DENIED']		    ):
-				raise AuthenticationError(e['message'])
-			else:
-				logger.warning("Unexpected eBay error: {}".format( response.text ))
-				raise RuntimeError("eBay error: {}".format(response.text) )
-				
-	return j
+	# 3. Call createOrReplaceInventoryItemGroup
+	url = app.config['EBAY_INVENTORYITEMGROUP_URL'].format( inventoryitemgroup_key )
+	with ebay_write_attempt( EBAY_GROUP, [inventoryitemgroup_key] ):
+		response = ebay_client().put( url, auth_token=auth_token, json=iNew )
+	return read_ebay_write_reply( EBAY_GROUP, inventoryitemgroup_key, iNew, response )
 
 def get_ebay_inventoryitemgroup(auth_token, inventoryitemgroup_key):
 	"""
@@ -531,18 +1511,10 @@ def get_ebay_inventoryitemgroup(auth_token, inventoryitemgroup_key):
 	Raises ItemNotFoundError if item doesn't exist.
 	"""
 	url = app.config['EBAY_INVENTORYITEMGROUP_URL'].format(inventoryitemgroup_key)
-	auth = {'Authorization': 'Bearer {}'.format(auth_token)}
 	logger.debug('Trying to fetch eBay inventoryItemGroup {}...'.format(inventoryitemgroup_key))
-	response = requests.get( url, headers=auth )
-	
-	try:
-		j = response.json()
-	except json.JSONDecodeError:
-		logger.debug('Got a weird reply from eBay: {}'.format(response.text))
-		
-	handle_ebay_errors( j )
-				
-	return j
+	generation = ebay_object_generation( EBAY_GROUP, inventoryitemgroup_key )
+	response = ebay_client().get( url, auth_token=auth_token )
+	return read_ebay_object( EBAY_GROUP, inventoryitemgroup_key, response, generation )
 				
 def shopify_authenticate(api_key=None, api_password=None):
 	"""Authenticate with the Shopify API given a certain API key and password. If none given, check the app config""" 
@@ -579,9 +1551,8 @@ def get_metafields(product_id, with_ids=False):
 	url = 'https://' + app.config['SHOPIFY_STORE_DOMAIN'] + '/admin/api/2019-04/products/' + product_id + '/metafields.json'
 	logger.debug("Trying to GET the Shopify product metafields {} by hitting {}".format(product_id, url))
 	logger.debug("Using auth: {}:{}".format(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW']))
-	response = requests.get(
+	response = shopify_client().get(
 		url,
-		auth=(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW'])
 	)
 	try:
 		ms = response.json()
@@ -616,9 +1587,8 @@ def get_variant_metafields(product_id, variant_id, with_ids=False):
 		)
 	logger.debug("Trying to GET the Shopify variant metafields for product {}, variant {}, by hitting {}".format(product_id, variant_id, url))
 	logger.debug("Using auth: {}:{}".format(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW']))
-	response = requests.get(
+	response = shopify_client().get(
 		url,
-		auth=(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW'])
 	)
 	try:
 		ms = response.json()
@@ -665,76 +1635,200 @@ def set_metafield(product_id, key, value, variant_id=None):
 	
 	If `variant_id` is set, write the metafield to the Product Variant instead of the base product.
 	
-	set_metafield() will download the existing metafields for the product or variant. If the metafield with key `key` exists, 
-		its value will be updated to be `value`. If not, it will be created.
+	If the metafield with key `key` exists, its value will be updated to be `value`. If not, it will be created.
+	If it already has that value, nothing is written. See `set_metafields_batch()`.
 	
 	Doesn't return anything.
 	"""
 	
 	if variant_id is None:
 		logger.debug('Going to set metafield with key={} to {} for product {}.'.format(key, value, product_id))
-		existing = get_metafields(product_id, with_ids=True)
+		set_metafields_batch( product_id, product_metafields={key: value} )
 	else:
 		logger.debug('Going to set metafield {} = {} for variant {} of product {}.'.format(key,value, variant_id,product_id))
-		existing = get_variant_metafields(product_id, with_ids=True)
-		
-	if key in existing:
-		if variant_id is None:
-			logger.debug('Looks like {k} already exists for product {pid} (currently set to {v}). Will update.'.format(k=key,pid=product_id,v=existing[key]['value']))
-		else:
-			logger.debug('Looks like {k} already exists for variant {vid} of product {pid} (currently set to {v}). Will update.'.format(k=key,pid=product_id,vid=variant_id,v=existing[key]['value']))
-		
-		# Update that particular metafield
-		metafield_id = existing[key]['id']
-		update_data = {"metafield": {"id": metafield_id, "key": key, "value": value}}
-		
-		if variant_id is None:
-			url = 'https://{store_domain}/admin/api/2019-04/products/{product_id}/metafields/{metafield_id}.json'
+		set_metafields_batch( product_id, variant_metafields={variant_id: {key: value}} )
+
+SHOPIFY_METAFIELD_IDS_QUERY = '''
+query metafieldIds($ids: [ID!]!, $first: Int!) {
+	nodes(ids: $ids) {
+		id
+		... on HasMetafields {
+			metafields(first: $first) {
+				pageInfo { hasNextPage }
+				edges { cursor node { id namespace key value valueType } }
+			}
+		}
+	}
+}
+'''
+
+SHOPIFY_METAFIELD_IDS_PAGE_QUERY = '''
+query metafieldIdsPage($id: ID!, $after: String) {
+	node(id: $id) {
+		... on HasMetafields {
+			metafields(first: 250, after: $after) {
+				pageInfo { hasNextPage }
+				edges { cursor node { id namespace key value valueType } }
+			}
+		}
+	}
+}
+'''
+
+def get_metafields_with_ids_batch(owner_gids):
+	"""
+	Fetch the metafields of several owners (products and/or variants, as GraphQL global IDs) in as few queries as
+	fit under the cost budget - usually one.
+	
+	Returns {owner_gid: {key: {'id': gid, 'value': value, 'value_type': value_type, 'namespace': namespace}}}, with
+	value_type lowercased to match the REST API ('string', 'integer', 'json_string').
+	"""
+	
+	budget = app.config.get('SHOPIFY_GRAPHQL_COST_BUDGET', 1000)
+	owner_gids = list(owner_gids)
+	existing = {}
+	
+	# Each owner costs about 3 plus one per metafield asked for; keep at least 10 metafields per owner per query
+	per_query = max(1, min(len(owner_gids), budget // 13))
+	for start in range(0, len(owner_gids), per_query):
+		chunk = owner_gids[start:start + per_query]
+		first = max(10, min(250, budget // len(chunk) - 3))
+		data, cost = shopify_graphql( SHOPIFY_METAFIELD_IDS_QUERY, {'ids': chunk, 'first': first}, cost=len(chunk) * (first + 3) )
+		for node in data['nodes']:
+			if node is None:
+				continue
+			m = existing.setdefault(node['id'], {})
+			connection = node['metafields']
+			while True:
+				for e in connection['edges']:
+					f = e['node']
+					m[f['key']] = {'id': f['id'], 'value': f['value'], 'value_type': f['valueType'].lower(), 'namespace': f['namespace']}
+				if not connection['pageInfo']['hasNextPage']:
+					break
+				page, cost = shopify_graphql( SHOPIFY_METAFIELD_IDS_PAGE_QUERY, {'id': node['id'], 'after': connection['edges'][-1]['cursor']}, cost=252 )
+				connection = page['node']['metafields']
+	
+	for gid in owner_gids:
+		existing.setdefault(gid, {})
+	return existing
+
+def metafield_value_string(value):
+	"""Metafield values go over the wire as strings; dump collections as JSON like Shopify does."""
+	if isinstance(value, (dict, list)):
+		return json.dumps(value)
+	return str(value)
+
+def plan_metafield_writes(existing, values):
+	"""
+	Work out what has to be written to make an owner's metafields match `values` ({key: value}).
+	
+	`existing` is {key: {'id', 'value', 'value_type', ...}} as returned by `get_metafields_with_ids_batch()`.
+	Returns a tuple of (creates, updates, unchanged): creates and updates are lists of GraphQL MetafieldInput
+	dicts, unchanged is a list of keys that already have the right value.
+	"""
+	
+	creates, updates, unchanged = [], [], []
+	for key, value in values.items():
+		new_value = metafield_value_string(value)
+		if key in existing:
+			if metafield_value_string(existing[key]['value']) == new_value:
+				unchanged.append(key)
+			else:
+				updates.append({'id': existing[key]['id'], 'value': new_value, 'valueType': existing[key]['value_type'].upper()})
 		else:
-			url = 'https://{store_domain}/admin/api/2019-04/products/{product_id}/variants/{variant_id}/metafields/{metafield_id}.json'	
-		
-		url = url.format(
-			store_domain=app.config['SHOPIFY_STORE_DOMAIN'],
-			product_id=product_id,
-			variant_id=variant_id,
-			metafield_id=metafield_id
-			)
-		response = requests.put(
-			url,
-			auth=(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW']),
-			json=update_data
-			)
-	else:
-		# Make a new metafield
-		type_string = 'string'
-		new_data = {"metafield": {"key": key, "value": value, "value_type": type_string, "namespace": "global"}}
-		
-		if variant_id is None:
-			url = 'https://{domain}/admin/api/2019-04/products/{pid}/metafields.json'
+			creates.append({'namespace': 'global', 'key': key, 'value': new_value, 'valueType': 'STRING'})
+	return creates, updates, unchanged
+
+def set_metafields_batch(product_id, product_metafields=None, variant_metafields=None):
+	"""
+	Write many metafields for one product and its variants at once.
+	
+	`product_metafields` is {key: value} for the product itself, `variant_metafields` is
+	{variant_id: {key: value}}. The existing metafields of every owner involved are read in one GraphQL query,
+	each key is sorted into create, update or no-op, and all of the creates and updates go out in a single
+	GraphQL request (one aliased productUpdate / productVariantUpdate per owner that actually changes). Nothing is
+	written at all if every value is already current.
+	
+	Returns a dict of counts: {'created': n, 'updated': n, 'unchanged': n}. Raises ProductWriteError if Shopify
+	rejects any of the writes.
+	"""
+	
+	product_metafields = product_metafields or {}
+	variant_metafields = variant_metafields or {}
+	
+	product_gid = 'gid://shopify/Product/{}'.format(product_id)
+	owners = {}
+	if len(product_metafields) > 0:
+		owners[product_gid] = product_metafields
+	for vid, values in variant_metafields.items():
+		if len(values) > 0:
+			owners['gid://shopify/ProductVariant/{}'.format(vid)] = values
+	
+	counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+	if len(owners) == 0:
+		return counts
+	
+	existing = get_metafields_with_ids_batch( owners.keys() )
+	
+	writes = []
+	for gid, values in owners.items():
+		creates, updates, unchanged = plan_metafield_writes( existing[gid], values )
+		counts['created'] += len(creates)
+		counts['updated'] += len(updates)
+		counts['unchanged'] += len(unchanged)
+		if len(creates) + len(updates) > 0:
+			writes.append( (gid, creates + updates) )
+	
+	if len(writes) == 0:
+		logger.debug('All {} metafields for product {} already up to date, not writing anything'.format(counts['unchanged'], product_id))
+		return counts
+	
+	# One aliased mutation per owner, all in the same request
+	declarations, fields, variables = [], [], {}
+	for idx, (gid, metafields) in enumerate(writes):
+		if gid == product_gid:
+			declarations.append('$w{}: ProductInput!'.format(idx))
+			fields.append('w{i}: productUpdate(input: $w{i}) {{ userErrors {{ field message }} }}'.format(i=idx))
 		else:
-			url = 'https://{domain}/admin/api/2019-04/products/{pid}/variants/{vid}/metafields.json'
-			
-		url = url.format( 	domain=app.config['SHOPIFY_STORE_DOMAIN'],
-							pid=product_id,
-							vid=variant_id 		)
-	
-		logger.debug('OK, making a new metafield for product {pid} (variant {vid}): {newdata}'.format(
-				pid=product_id, 
-				vid=variant_id,
-				newdata=json.dumps(new_data)	))
-		response = requests.post(
-			url,
-			auth=(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW']),
-			json=new_data
-			)
+			declarations.append('$w{}: ProductVariantInput!'.format(idx))
+			fields.append('w{i}: productVariantUpdate(input: $w{i}) {{ userErrors {{ field message }} }}'.format(i=idx))
+		variables['w{}'.format(idx)] = {'id': gid, 'metafields': metafields}
+	mutation = 'mutation setMetafields({}) {{\n\t{}\n}}'.format( ', '.join(declarations), '\n\t'.join(fields) )
+	
+	logger.debug('Writing metafields for product {}: {} created, {} updated, {} unchanged, in {} mutation(s)'.format(
+			product_id, counts['created'], counts['updated'], counts['unchanged'], len(writes) ))
+	try:
+		data, cost = shopify_graphql( mutation, variables, cost=10 * len(writes) )
+	finally:
+		invalidate_shopify_product(product_id)
+	
+	errors = []
+	for key, result in data.items():
+		if result is not None:
+			errors.extend( result.get('userErrors') or [] )
+	if len(errors) > 0:
+		logger.warning('Shopify rejected some metafield writes for product {}: {}'.format(product_id, json.dumps(errors)))
+		raise ProductWriteError( json.dumps(errors) )
+	
+	return counts
 
-	if response.status_code >= 200 and response.status_code < 300: 
-		logger.debug('Got status in 200s back from Shopify, assuming metafield set OK.')
-		return	# assume all is well
-	else:
-		logger.warning('Got unexpected response from Shopify: {}'.format(response.text))
-		return response.text
-		
+def group_metafield_writes(entries):
+	"""
+	Sort a list of metafield writes ({product_id, variant_id (optional), key, value}) into one
+	`set_metafields_batch()` call per product: returns {product_id: (product_metafields, variant_metafields)}.
+	A key written more than once for the same owner keeps the last value. Raises KeyError if an entry is missing
+	product_id, key or value.
+	"""
+	by_product = {}
+	for entry in entries:
+		product_id = int(entry['product_id'])
+		key, value = entry['key'], entry['value']
+		product_metafields, variant_metafields = by_product.setdefault( product_id, ({}, {}) )
+		if entry.get('variant_id') is not None:
+			variant_metafields.setdefault( int(entry['variant_id']), {} )[key] = value
+		else:
+			product_metafields[key] = value
+	return by_product
 
 def guess_metafield_type(value):
 	"""
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from flask import current_app as app
+
+import localdb
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.jobs')
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+	id				TEXT PRIMARY KEY,
+	kind			TEXT,		-- which handler runs it, see register()
+	payload			TEXT,		-- JSON, handed to the handler
+	status			TEXT,		-- see the STATUS_* constants
+	created_at		REAL,
+	started_at		REAL,
+	finished_at		REAL,
+	attempts		INTEGER DEFAULT 0,
+	lease_until		REAL,		-- a running job whose lease has run out was dropped by a dead worker
+	result			TEXT,		-- JSON, whatever the handler returned (or attached to its JobFailed)
+	error			TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_skus (
+	job_id			TEXT,
+	sku				TEXT,
+	status			TEXT,
+	error			TEXT,
+	updated_at		REAL,
+	PRIMARY KEY (job_id, sku)
+);
+'''
+
+"""Where a job (or one SKU in it) is at"""
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+"""A job picked up this many times without finishing (its worker keeps dying) is given up on"""
+MAX_ATTEMPTS = 3
+
+"""Handlers by job kind: fn(payload, progress) -> result. See register()."""
+_handlers = {}
+
+class JobFailed(Exception):
+	"""Raised by a handler to fail its job with a message, and optionally a result to show alongside it."""
+	def __init__(self, message, result=None):
+		self.message = message
+		self.result = result
+
+def register(kind, fn):
+	"""
+	Run jobs of `kind` with `fn(payload, progress)`, in a worker thread with an app context. `progress(sku,
+	status, error=None)` records how one SKU went. Whatever `fn` returns (JSON-able) is the job's result; if it
+	raises, the job fails.
+	"""
+	_handlers[kind] = fn
+
+class JobQueue(object):
+	"""
+	A durable job queue in SQLite, for work that's too slow to do inside an HTTP request. Every gunicorn worker
+	enqueues into the same file and runs `workers` threads that take jobs out of it, so a job queued by one
+	worker may be run by another.
+
+	A running job holds a lease, renewed every time it reports progress and by a heartbeat while its handler runs,
+	so a slow handler (a rate-limited group save) keeps it. If its worker dies (deploy, OOM, timeout) the lease runs
+	out and another worker picks the job up again, up to MAX_ATTEMPTS times.
+	"""
+
+	def __init__(self, path, lease=300, retention=7 * 86400, poll_interval=1.0):
+		self.path = path
+		self.lease = lease
+		self.retention = retention
+		self.poll_interval = poll_interval
+		self._wakeup = threading.Event()
+		self._workers = []
+		self.ran = 0
+		self.failed = 0
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def enqueue(self, kind, payload, skus=()):
+		"""Queue a job. `skus` are the SKUs it's going to touch, listed as queued in its status. Returns the job ID."""
+		job_id = uuid.uuid4().hex
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			conn.execute(
+				'INSERT INTO jobs (id, kind, payload, status, created_at) VALUES (?, ?, ?, ?, ?)',
+				(job_id, kind, json.dumps(payload), STATUS_QUEUED, now) )
+			conn.executemany(
+				'INSERT OR IGNORE INTO job_skus (job_id, sku, status, updated_at) VALUES (?, ?, ?, ?)',
+				[(job_id, sku, STATUS_QUEUED, now) for sku in skus] )
+			conn.execute(
+				'DELETE FROM job_skus WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)', (now - self.retention,))
+			conn.execute('DELETE FROM jobs WHERE finished_at < ?', (now - self.retention,))
+		self._wakeup.set()
+		return job_id
+
+	def claim(self):
+		"""Take the oldest job that's waiting (or was dropped by a dead worker) and mark it running. Returns it, or None."""
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			row = conn.execute(
+				'SELECT * FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY created_at LIMIT 1',
+				(STATUS_QUEUED, STATUS_RUNNING, now) ).fetchone()
+			if row is None:
+				return None
+			if row['attempts'] >= MAX_ATTEMPTS:
+				conn.execute(
+					'UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?',
+					(STATUS_FAILED, now, 'Gave up after {} attempts'.format(row['attempts']), row['id']) )
+				return None
+			conn.execute(
+				'UPDATE jobs SET status = ?, started_at = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?',
+				(STATUS_RUNNING, now, now + self.lease, row['id']) )
+		return row
+
+	def progress(self, job_id, sku, status, error=None):
+		"""Record how `sku` went in job `job_id` (and keep the job's lease)."""
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			conn.execute(
+				'INSERT OR REPLACE INTO job_skus (job_id, sku, status, error, updated_at) VALUES (?, ?, ?, ?, ?)',
+				(job_id, sku, status, error, now) )
+			conn.execute('UPDATE jobs SET lease_until = ? WHERE id = ?', (now + self.lease, job_id))
+
+	def renew(self, job_id):
+		"""Keep the lease on running job `job_id` for another `lease` seconds."""
+		self.conn.execute(
+			'UPDATE jobs SET lease_until = ? WHERE id = ? AND status = ?', (time.time() + self.lease, job_id, STATUS_RUNNING) )
+
+	def _heartbeat(self, job_id, stop):
+		"""Renew `job_id`'s lease every third of a lease until `stop` is set."""
+		while not stop.wait(self.lease / 3.0):
+			try:
+				self.renew(job_id)
+			except Exception:
+				logger.exception('Could not renew the lease on job {}'.format(job_id))
+
+	def finish(self, job_id, status, result=None, error=None):
+		self.conn.execute(
+			'UPDATE jobs SET status = ?, finished_at = ?, lease_until = NULL, result = ?, error = ? WHERE id = ?',
+			(status, time.time(), json.dumps(result) if result is not None else None, error, job_id) )
+
+	def get(self, job_id):
+		"""A job's status, with each of its SKUs, as a dict. None if there's no such job."""
+		conn = self.conn
+		row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+		if row is None:
+			return None
+		job = {k: row[k] for k in ('id', 'kind', 'status', 'created_at', 'started_at', 'finished_at', 'attempts', 'error')}
+		job['result'] = json.loads(row['result']) if row['result'] is not None else None
+		job['skus'] = {
+			r['sku']: {'status': r['status'], 'error': r['error']}
+			for r in conn.execute('SELECT sku, status, error FROM job_skus WHERE job_id = ? ORDER BY sku', (job_id,)) }
+		return job
+
+	def run_one(self, row):
+		"""Run the claimed job `row` to completion, recording how it went."""
+		job_id = row['id']
+		handler = _handlers.get(row['kind'])
+		if handler is None:
+			self.failed += 1
+			self.finish( job_id, STATUS_FAILED, error='No handler for job kind {}'.format(row['kind']) )
+			return
+		logger.debug('Running job {} ({}), attempt {}'.format(job_id, row['kind'], row['attempts'] + 1))
+		stop = threading.Event()
+		heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop), name='job-heartbeat-{}'.format(job_id), daemon=True)
+		heartbeat.start()
+		try:
+			result = handler( json.loads(row['payload']), lambda sku, status, error=None: self.progress(job_id, sku, status, error) )
+		except JobFailed as e:
+			logger.info('Job {} ({}) failed: {}'.format(job_id, row['kind'], e.message))
+			self.failed += 1
+			self.finish( job_id, STATUS_FAILED, e.result, e.message )
+		except Exception as e:
+			logger.exception('Job {} ({}) blew up'.format(job_id, row['kind']))
+			self.failed += 1
+			self.finish( job_id, STATUS_FAILED, error=getattr(e, 'message', None) or str(e) )
+		else:
+			self.finish( job_id, STATUS_DONE, result )
+		finally:
+			stop.set()
+		self.ran += 1
+
+	def start_workers(self, flask_app, workers):
+		"""Start `workers` threads taking jobs from the queue."""
+		def run():
+			while True:
+				with flask_app.app_context():
+					try:
+						row = self.claim()
+						if row is not None:
+							self.run_one(row)
+							continue
+					except Exception:
+						logger.exception('Job worker hit an error')
+				# Nothing to do. Jobs queued in this process wake us straight away; other workers' after a poll.
+				self._wakeup.wait(self.poll_interval)
+				self._wakeup.clear()
+
+		for n in range(workers):
+			t = threading.Thread(target=run, name='job-worker-{}'.format(n), daemon=True)
+			t.start()
+			self._workers.append(t)
+
+	def stats(self):
+		rows = self.conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status').fetchall()
+		s = {row['status']: row['n'] for row in rows}
+		s.update({'workers': len(self._workers), 'ran_here': self.ran, 'failed_here': self.failed})
+		return s
+
+"""One queue per process, so each worker starts its job threads once"""
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+	"""The job queue for this app, in DATA_DIR. Starts this process's job workers the first time."""
+	global _queue
+	with _queue_lock:
+		if _queue is None:
+			_queue = JobQueue(
+				os.path.join(app.config['DATA_DIR'], 'jobs.sqlite3'),
+				retention=app.config.get('JOB_RETENTION', 7 * 86400) )
+			workers = app.config.get('JOB_WORKERS', 2)
+			if workers > 0:
+				_queue.start_workers( app._get_current_object(), workers )
+		return _queue
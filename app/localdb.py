@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import logging
+import threading
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.localdb')
+logger.setLevel(logging.DEBUG)
+
+"""One connection per (thread, database file) - sqlite3 connections can't be shared between threads"""
+_local = threading.local()
+
+def connect(path, schema=None):
+	"""
+	Return this thread's connection to the SQLite database at `path`, creating the file (and running `schema`,
+	a script of CREATE ... IF NOT EXISTS statements) the first time.
+
+	Databases are opened in WAL mode with a generous busy timeout, so several gunicorn workers and background
+	threads can read and write the same file at once.
+	"""
+	conns = getattr(_local, 'conns', None)
+	if conns is None:
+		conns = _local.conns = {}
+
+	conn = conns.get(path)
+	if conn is None:
+		os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+		conn = sqlite3.connect(path, timeout=30, isolation_level=None)	# autocommit; use transaction() for more
+		conn.row_factory = sqlite3.Row
+		conn.execute('PRAGMA journal_mode=WAL')
+		conn.execute('PRAGMA synchronous=NORMAL')
+		if schema is not None:
+			conn.executescript(schema)
+		conns[path] = conn
+	return conn
+
+class transaction(object):
+	"""
+	Context manager for a write transaction on a connection from `connect()`.
+
+	Takes the database write lock up front (BEGIN IMMEDIATE), so a read-then-write inside the block can't race
+	with another process doing the same. Commits on success, rolls back if the block raises.
+	"""
+
+	def __init__(self, conn):
+		self.conn = conn
+
+	def __enter__(self):
+		self.conn.execute('BEGIN IMMEDIATE')
+		return self.conn
+
+	def __exit__(self, exc_type, exc, tb):
+		if exc_type is None:
+			self.conn.execute('COMMIT')
+		else:
+			self.conn.execute('ROLLBACK')
+		return False
@@ -0,0 +1,286 @@
+import os
+import json
+import logging
+import threading
+from flask import current_app as app
+
+import glitchlab_shopify
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.mapping')
+logger.setLevel(logging.DEBUG)
+
+"""Shopify "Condition" option values (what the item template shows) to eBay condition enums"""
+SHOPIFY_CONDITIONS = {
+	'New': 'NEW',
+	'Pre-Owned': 'USED_EXCELLENT',
+	'Used': 'USED_EXCELLENT',
+	'For Parts': 'FOR_PARTS_OR_NOT_WORKING'
+	}
+
+"""
+How a Shopify product becomes eBay payloads. One section per kind of eBay object; each maps a dotted path in
+the eBay payload to where its value comes from:
+
+	'title'						a product field
+	'metafields.MPN'			a product metafield
+	'variant.price'				a variant field ('variant.metafields.X' for a variant metafield)
+	'option.Condition'			the variant's value for the product option called "Condition"
+	{'template': 'x.html'}		the product rendered with a template in STATIC_FILE_DIR (item_name, item_description)
+	{'value': 'USD'}			a constant
+
+A dict source can also have 'from' (one of the strings above), 'map' (a dict the value is looked up in),
+'type' ('int', 'quantity' - an int, at least 0 - 'price' or 'str') and 'list' (wrap the value in a list, for
+aspects). A value that comes out as None is left out of the payload, so whatever eBay has stays.
+
+The group section's 'variesBy' is special: {'aspect': 'Condition', 'from_item': 'condition'} lists the distinct
+values of that field across the group's items.
+
+Set EBAY_MAPPING_FILE to a JSON file with the same shape to use a different mapping.
+"""
+DEFAULT_MAPPING = {
+	'item': {
+		'product.title':										'title',
+		'product.description':									{'template': 'item-template.html'},
+		'product.brand':										'metafields.Manufacturer',
+		'product.mpn':											'metafields.MPN',
+		'product.aspects.Brand':								{'from': 'metafields.Manufacturer', 'list': True},
+		'product.aspects.MPN':									{'from': 'metafields.MPN', 'list': True},
+		'condition':											{'from': 'option.Condition', 'map': SHOPIFY_CONDITIONS},
+		'availability.shipToLocationAvailability.quantity':		{'from': 'variant.inventory_quantity', 'type': 'quantity'}
+		},
+	'offer': {
+		'pricingSummary.price.value':							{'from': 'variant.price', 'type': 'price'},
+		'pricingSummary.price.currency':						{'value': 'USD'},
+		'availableQuantity':									{'from': 'variant.inventory_quantity', 'type': 'quantity'}
+		},
+	'group': {
+		'title':												'title',
+		'description':											{'template': 'item-template.html'},
+		'aspects.Brand':										{'from': 'metafields.Manufacturer', 'list': True},
+		'variesBy':												{'aspect': 'Condition', 'from_item': 'condition'}
+		}
+	}
+
+class MappingError(Exception):
+	"""The mapping spec doesn't make sense."""
+	def __init__(self, message):
+		self.message = message
+
+def _price(v):
+	return '{:.2f}'.format(float(v))
+
+_TYPES = {
+	'int': int,
+	'quantity': lambda v: max(int(v), 0),
+	'price': _price,
+	'str': str
+	}
+
+def _compile_getter(source):
+	"""
+	Turn one source (see DEFAULT_MAPPING) into fn(product, variant, rendered) -> value. `rendered` is
+	{template file: rendered HTML} for the product. All the parsing happens here, once, not per product.
+	"""
+	if isinstance(source, str):
+		source = {'from': source}
+	if not isinstance(source, dict):
+		raise MappingError('Bad mapping source: {!r}'.format(source))
+
+	if 'value' in source:
+		value = source['value']
+		get = lambda product, variant, rendered: value
+	elif 'template' in source:
+		template = source['template']
+		get = lambda product, variant, rendered: rendered[template]
+	elif 'from' in source:
+		parts = source['from'].split('.')
+		if parts[0] == 'metafields' and len(parts) == 2:
+			key = parts[1]
+			get = lambda product, variant, rendered: product.get('metafields', {}).get(key)
+		elif parts[0] == 'variant' and len(parts) == 3 and parts[1] == 'metafields':
+			key = parts[2]
+			get = lambda product, variant, rendered: variant.get('metafields', {}).get(key) if variant is not None else None
+		elif parts[0] == 'variant' and len(parts) == 2:
+			key = parts[1]
+			get = lambda product, variant, rendered: variant.get(key) if variant is not None else None
+		elif parts[0] == 'option' and len(parts) == 2:
+			name = parts[1]
+			def get(product, variant, rendered):
+				if variant is None:
+					return None
+				for o in product.get('options', []):
+					if o.get('name') == name:
+						return variant.get('option{}'.format(o.get('position')))
+				return None
+		elif len(parts) == 1:
+			key = parts[0]
+			get = lambda product, variant, rendered: product.get(key)
+		else:
+			raise MappingError('Bad mapping source: {!r}'.format(source['from']))
+	else:
+		raise MappingError('Bad mapping source: {!r}'.format(source))
+
+	# Stack the modifiers on top. Each one passes None through, so missing values stay missing.
+	if 'map' in source:
+		table, inner_map = source['map'], get
+		get = lambda product, variant, rendered: table.get( inner_map(product, variant, rendered) )
+	if 'type' in source:
+		if source['type'] not in _TYPES:
+			raise MappingError('Unknown mapping type: {!r}'.format(source['type']))
+		convert, inner_type = _TYPES[source['type']], get
+		def get(product, variant, rendered):
+			v = inner_type(product, variant, rendered)
+			return convert(v) if v is not None else None
+	if source.get('list'):
+		inner_list = get
+		def get(product, variant, rendered):
+			v = inner_list(product, variant, rendered)
+			return [v] if v is not None else None
+	return get
+
+def _compile_section(section, skip=()):
+	"""
+	Compile one section of a spec into build(product, variant, rendered) -> payload. Returns (build, the template
+	files it uses).
+	"""
+	fields = []
+	used = set()
+	for path, source in section.items():
+		if path in skip:
+			continue
+		path = path.split('.')
+		fields.append( (tuple(path[:-1]), path[-1], _compile_getter(source)) )
+		if isinstance(source, dict) and 'template' in source:
+			used.add(source['template'])
+
+	def build(product, variant, rendered):
+		payload = {}
+		for parents, leaf, get in fields:
+			v = get(product, variant, rendered)
+			if v is None:
+				continue
+			d = payload
+			for k in parents:
+				d = d.setdefault(k, {})
+			d[leaf] = v
+		return payload
+	return build, used
+
+"""What `CompiledMapping.transform()` can make for each product"""
+KINDS = ('item', 'variants', 'offers', 'group')
+
+class CompiledMapping(object):
+	"""
+	A mapping spec compiled into transform functions. Build one with `compile_mapping()`, or use `get_mapping()`.
+
+	`transform()` turns a batch of Shopify products (dicts like `get_shopify_product()['product']`) into eBay
+	payloads. Each template is checked and parsed once per batch, and every field is a precompiled getter, so
+	most of the time goes on rendering templates. See bench/bench_mapping.py.
+	"""
+
+	def __init__(self, spec):
+		self.spec = spec
+		self._item, item_templates = _compile_section( spec.get('item', {}) )
+		self._offer, offer_templates = _compile_section( spec.get('offer', {}) )
+		self._group, group_templates = _compile_section( spec.get('group', {}), skip=('variesBy',) )
+		self._varies_by = spec.get('group', {}).get('variesBy')
+		self._templates = {
+			'item': item_templates,
+			'variants': item_templates,
+			'offers': offer_templates,
+			'group': group_templates | (item_templates if self._varies_by is not None else set())
+			}
+
+	def varies_by(self, items):
+		"""A group's variesBy, from its items' payloads (a list), or None if the mapping doesn't say or there are no values."""
+		if self._varies_by is None:
+			return None
+		values = []
+		for item in items:
+			v = item
+			for k in self._varies_by['from_item'].split('.'):
+				v = v.get(k) if isinstance(v, dict) else None
+			if v is not None and v not in values:
+				values.append(v)
+		if len(values) == 0:
+			return None
+		return {'specifications': [{'name': self._varies_by['aspect'], 'values': values}]}
+
+	def transform(self, products, kinds=KINDS, template_dir=None):
+		"""
+		Map a list of Shopify products to eBay payloads. Returns a list (in the same order) of dicts with whichever
+		of these `kinds` were asked for:
+
+			'item':		the inventoryItem for the product as a whole - variant fields too if it has just one variant
+			'variants':	{variant ID: inventoryItem}, one per variant
+			'offers':	{variant ID: offer fields}, to merge into the variant's existing offers
+			'group':	the inventoryItemGroup, with variesBy worked out from the variants' items
+
+		Only the templates the requested kinds use are rendered. They're looked up in `template_dir` (default
+		STATIC_FILE_DIR).
+		"""
+		if template_dir is None:
+			template_dir = app.config['STATIC_FILE_DIR']
+		needed = set()
+		for kind in kinds:
+			needed |= self._templates[kind]
+		rendered = [{} for p in products]
+		if len(needed) > 0:
+			fields = [glitchlab_shopify.product_template_fields(p) for p in products]
+			for t in needed:
+				for r, html in zip( rendered, glitchlab_shopify.template_registry.render_many(os.path.join(template_dir, t), fields) ):
+					r[t] = html
+
+		want_items = 'variants' in kinds or ('group' in kinds and self._varies_by is not None)
+		out = []
+		for product, r in zip(products, rendered):
+			variants = product.get('variants', {})
+			if isinstance(variants, list):
+				variants = {v['id']: v for v in variants}
+			payloads = {}
+			items = {vid: self._item(product, v, r) for vid, v in variants.items()} if want_items else None
+			if 'variants' in kinds:
+				payloads['variants'] = items
+			if 'item' in kinds:
+				if len(variants) == 1:
+					only_id, only = next(iter(variants.items()))
+					# Same as the variant's item, so don't build it twice (payloads are read-only anyway)
+					payloads['item'] = items[only_id] if items is not None else self._item(product, only, r)
+				else:
+					payloads['item'] = self._item(product, None, r)
+			if 'offers' in kinds:
+				payloads['offers'] = {vid: self._offer(product, v, r) for vid, v in variants.items()}
+			if 'group' in kinds:
+				group = self._group(product, None, r)
+				varies_by = self.varies_by( list(items.values()) ) if items is not None else None
+				if varies_by is not None:
+					group['variesBy'] = varies_by
+				payloads['group'] = group
+			out.append(payloads)
+		return out
+
+def compile_mapping(spec):
+	"""Compile a mapping spec (see DEFAULT_MAPPING). Raises MappingError if it doesn't make sense."""
+	return CompiledMapping(spec)
+
+"""Compiled mappings by (spec file, mtime), so each process compiles a spec once, and again only if the file changes"""
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+def get_mapping():
+	"""The mapping for this app: the JSON file in EBAY_MAPPING_FILE if there is one, DEFAULT_MAPPING if not."""
+	path = app.config.get('EBAY_MAPPING_FILE') or None
+	key = (path, os.path.getmtime(path) if path is not None else None)
+	with _compiled_lock:
+		if key not in _compiled:
+			if path is None:
+				spec = DEFAULT_MAPPING
+			else:
+				with open(path) as f:
+					spec = json.load(f)
+				logger.info('Compiled eBay mapping from {}'.format(path))
+			_compiled.clear()
+			_compiled[key] = compile_mapping(spec)
+		return _compiled[key]
@@ -0,0 +1,352 @@
+import os
+import time
+import logging
+import threading
+from flask import current_app as app
+
+import localdb
+import mapping
+import sku_index
+import ebay_mirror
+import ebay_tokens
+import glitchlab_shopify
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.price-quantity')
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pending (
+	sku				TEXT PRIMARY KEY,
+	price			TEXT,		-- NULL: leave the price alone
+	currency		TEXT,
+	quantity		INTEGER,	-- NULL: leave the stock alone
+	first_at		REAL,		-- when the oldest change still waiting came in; the SKU is flushed `window` secs after
+	updated_at		REAL,
+	attempts		INTEGER DEFAULT 0,
+	claimed_until	REAL,		-- a flusher is sending it; if that runs out, the flusher died and it's up for grabs again
+	account			TEXT		-- eBay account (see ebay_tokens.py) the newest change came from; NULL: the background account
+);
+CREATE INDEX IF NOT EXISTS pending_first_at ON pending (first_at);
+'''
+
+"""Product or variant metafield holding the eBay SKU a Shopify variant's stock and price go to"""
+EBAY_SKU_METAFIELD = 'ebay_sku'
+
+"""SKUs whose flush keeps failing (eBay down, nobody signed in, a weird getOffers reply) are dropped after this many tries"""
+MAX_ATTEMPTS = 5
+
+class PriceQuantityQueue(object):
+	"""
+	The fast path for stock and price changes: instead of a read-modify-write of the whole inventory item and its
+	offers, changes go through eBay's bulkUpdatePriceQuantity, which only touches quantities and prices.
+
+	Changes are collected per SKU in a SQLite file shared by every worker, newest value wins, so a burst of
+	inventory webhooks for one SKU becomes one update. A SKU is flushed `window` seconds after its first change
+	that hasn't been sent yet, 25 SKUs per eBay call, by a background thread in each worker process.
+
+	A flusher claims the rows it sends for `lease` seconds, so two workers never send the same change, and only
+	deletes them once eBay has answered. If the flusher dies in between, the claim runs out and another worker
+	sends them. A SKU that fails waits another `window` before it's tried again.
+
+	Each SKU goes out as the eBay account that queued its newest change, or the background account for changes
+	nobody in particular made (webhooks).
+	"""
+
+	def __init__(self, path, window=5, poll_interval=1.0, lease=120):
+		self.path = path
+		self.window = window
+		self.poll_interval = poll_interval
+		self.lease = lease
+		self._flusher = None
+		self.calls = 0
+		self.flushed = 0
+		self.failed = 0
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def put(self, sku, price=None, currency=None, quantity=None, account=None):
+		"""
+		Queue a new price (a string, like the mapping makes) and/or quantity for eBay SKU `sku`, to be sent as eBay
+		`account` (the background account if None). None leaves the price or quantity as it is.
+		"""
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			row = conn.execute('SELECT * FROM pending WHERE sku = ?', (sku,)).fetchone()
+			if row is None:
+				conn.execute(
+					'INSERT INTO pending (sku, price, currency, quantity, first_at, updated_at, account) VALUES (?, ?, ?, ?, ?, ?, ?)',
+					(sku, price, currency, quantity, now, now, account) )
+			else:
+				conn.execute(
+					'UPDATE pending SET price = ?, currency = ?, quantity = ?, updated_at = ?, account = ? WHERE sku = ?',
+					(	price if price is not None else row['price'],
+						currency if price is not None else row['currency'],
+						quantity if quantity is not None else row['quantity'],
+						now, account, sku ) )
+
+	def claim(self, limit=glitchlab_shopify.EBAY_BULK_WRITE_LIMIT):
+		"""
+		Claim up to `limit` SKUs whose window has run out and that nobody else is sending. Returns them as dicts,
+		oldest first. Each one has to be handed to `done()` or `retry()` afterwards.
+		"""
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			rows = conn.execute(
+				'SELECT * FROM pending WHERE first_at <= ? AND (claimed_until IS NULL OR claimed_until < ?) ORDER BY first_at LIMIT ?',
+				(now - self.window, now, limit) ).fetchall()
+			conn.executemany(
+				'UPDATE pending SET claimed_until = ? WHERE sku = ?', [(now + self.lease, row['sku']) for row in rows] )
+		return [dict(row) for row in rows]
+
+	def done(self, row):
+		"""
+		Take a claimed row off the queue, now that eBay has answered for it. If a change came in while it was being
+		sent, the row stays, unclaimed, and goes out again after its window.
+		"""
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			cur = conn.execute('DELETE FROM pending WHERE sku = ? AND updated_at = ?', (row['sku'], row['updated_at']))
+			if cur.rowcount == 0:
+				conn.execute(
+					'UPDATE pending SET claimed_until = NULL, attempts = 0, first_at = ? WHERE sku = ?', (now, row['sku']) )
+
+	def retry(self, row, error):
+		"""Give a claimed row back after sending it failed, to be tried again a `window` from now - or drop it, if it keeps failing."""
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			current = conn.execute('SELECT * FROM pending WHERE sku = ?', (row['sku'],)).fetchone()
+			if current is None:
+				return
+			if current['attempts'] + 1 >= MAX_ATTEMPTS and current['updated_at'] == row['updated_at']:
+				logger.warning('Giving up on price/quantity update for eBay SKU {} after {} tries: {}'.format(
+					row['sku'], current['attempts'] + 1, error ))
+				self.failed += 1
+				conn.execute('DELETE FROM pending WHERE sku = ?', (row['sku'],))
+				return
+			conn.execute(
+				'UPDATE pending SET claimed_until = NULL, attempts = ?, first_at = ? WHERE sku = ?',
+				(current['attempts'] + 1 if current['updated_at'] == row['updated_at'] else 0, now, row['sku']) )
+
+	def flush(self):
+		"""Send every SKU that's due to eBay, 25 per call, each as the account that queued it. Returns how many SKUs were sent."""
+		sent = 0
+		while True:
+			rows = self.claim()
+			if len(rows) == 0:
+				return sent
+
+			by_account = {}
+			for row in rows:
+				by_account.setdefault(row['account'], []).append(row)
+			failed = False
+			for account, account_rows in by_account.items():
+				with ebay_tokens.acting_as(account):
+					n = self._send(account_rows)
+				if n is None:
+					failed = True
+				else:
+					sent += n
+			if failed:
+				return sent		# eBay is down or won't take our token; the retries wait a window
+
+	def _send(self, rows):
+		"""Send claimed `rows` (all queued by the current account) in one call. Returns how many were sent, or None if the call failed."""
+		# Work out each SKU's request on its own, so one SKU eBay won't list the offers of doesn't hold up the rest
+		updates, batch = [], {}
+		for row in rows:
+			try:
+				update = price_quantity_request(row)
+			except Exception as e:
+				logger.warning('Could not build price/quantity update for eBay SKU {}: {}'.format(row['sku'], e))
+				self.retry(row, getattr(e, 'message', None) or str(e))
+				continue
+			if update is None:
+				self.done(row)
+				continue
+			updates.append(update)
+			batch[row['sku']] = row
+		if len(updates) == 0:
+			return 0
+
+		try:
+			results = glitchlab_shopify.update_ebay_price_quantity_bulk(updates)
+		except Exception as e:
+			if isinstance(e, glitchlab_shopify.AuthenticationError):
+				logger.warning("Can't flush price/quantity updates, eBay authentication failed: {}".format(e.message))
+			else:
+				logger.warning('Flushing price/quantity updates for {} SKUs failed: {}'.format(len(updates), e))
+			for row in batch.values():
+				self.retry(row, getattr(e, 'message', None) or str(e))
+			return None
+		self.calls += 1
+		for sku, row in batch.items():
+			r = results.get(sku, {'ok': False, 'errors': []})
+			if r['ok']:
+				self.flushed += 1
+			else:
+				# eBay turned this SKU down (bad price, no such SKU), so trying again won't help
+				self.failed += 1
+				logger.warning('eBay refused price/quantity update for SKU {}: {}'.format(
+					sku, '; '.join(e.get('message', '') for e in r['errors']) ))
+			self.done(row)
+		return len(updates)
+
+	def start_flusher(self, flask_app):
+		"""Flush due SKUs every `poll_interval` seconds in a background thread."""
+		def run():
+			while True:
+				time.sleep(self.poll_interval)
+				with flask_app.app_context():
+					try:
+						self.flush()
+					except Exception:
+						logger.exception('Price/quantity flusher hit an error')
+
+		self._flusher = threading.Thread(target=run, name='price-quantity-flusher', daemon=True)
+		self._flusher.start()
+
+	def stats(self):
+		row = self.conn.execute(
+			'SELECT COUNT(*) AS n, MIN(first_at) AS oldest, SUM(claimed_until > ?) AS sending FROM pending', (time.time(),) ).fetchone()
+		return {
+			'pending': row['n'],
+			'sending': row['sending'] or 0,
+			'oldest_secs': time.time() - row['oldest'] if row['oldest'] is not None else None,
+			'window': self.window,
+			'calls_here': self.calls,
+			'flushed_here': self.flushed,
+			'failed_here': self.failed,
+			'flushing': self._flusher is not None and self._flusher.is_alive()
+			}
+
+def offer_ids(sku):
+	"""The offer IDs for eBay SKU `sku`: from the eBay mirror if it has fetched them, else from eBay."""
+	ids = ebay_mirror.get_mirror().offer_ids(sku)
+	if ids is not None:
+		return ids
+	try:
+		offers = glitchlab_shopify.get_ebay_offers(sku)
+	except glitchlab_shopify.ItemNotFoundError:
+		return []
+	if not isinstance(offers, list):
+		raise RuntimeError('Weird reply from eBay listing offers for SKU {}'.format(sku))
+	return [offer['offerId'] for offer in offers]
+
+def price_quantity_request(row):
+	"""The bulkUpdatePriceQuantity request for one queued row, or None if there's nothing eBay can be told."""
+	update = {'sku': row['sku']}
+	if row['quantity'] is not None:
+		update['shipToLocationAvailability'] = {'quantity': row['quantity']}
+	offer = {}
+	if row['quantity'] is not None:
+		offer['availableQuantity'] = row['quantity']
+	if row['price'] is not None:
+		offer['price'] = {'value': row['price'], 'currency': row['currency'] or 'USD'}
+	ids = offer_ids(row['sku'])
+	if len(ids) > 0:
+		update['offers'] = [dict(offer, offerId=offer_id) for offer_id in ids]
+	elif row['quantity'] is None:
+		logger.info('Not updating the price of eBay SKU {}: it has no offers'.format(row['sku']))
+		return None
+	return update
+
+def group_variant_skus(key):
+	"""
+	The SKUs of the items in eBay item group `key` - from the eBay mirror, our cached copy or else eBay - or None if
+	`key` isn't a group.
+	"""
+	if sku_index.get_sku_index().lookup(key) == sku_index.INVENTORY_ITEM:
+		return None
+	skus = ebay_mirror.get_mirror().group_variant_skus(key)
+	if skus is not None:
+		return skus
+	group = glitchlab_shopify.cached_ebay_object( glitchlab_shopify.EBAY_GROUP, key )
+	if group is None:
+		try:
+			group = glitchlab_shopify.get_ebay_inventoryitemgroup( glitchlab_shopify.ebay_auth_token(), key )
+		except glitchlab_shopify.ItemNotFoundError:
+			return None
+	return group.get('variantSKUs', [])
+
+def variant_skus(product):
+	"""
+	{variant ID: eBay SKU} for a Shopify product (a dict like `get_shopify_product()['product']`). A product with
+	one variant goes to the product's `ebay_sku`. In a product with several, a variant goes to its own `ebay_sku`
+	variant metafield if it has one, or else - if the product's `ebay_sku` is an item group, as it is when the UI
+	links it - to the item in the group whose SKU is the variant's Shopify SKU.
+	"""
+	variants = product.get('variants', {})
+	if isinstance(variants, list):
+		variants = {v['id']: v for v in variants}
+	product_sku = product.get('metafields', {}).get(EBAY_SKU_METAFIELD)
+	if len(variants) == 1:
+		return {vid: product_sku for vid in variants} if product_sku else {}
+	skus = {
+		vid: v['metafields'][EBAY_SKU_METAFIELD]
+		for vid, v in variants.items() if v.get('metafields', {}).get(EBAY_SKU_METAFIELD) }
+	if product_sku and len(skus) < len(variants):
+		try:
+			members = set( group_variant_skus(product_sku) or [] )
+		except (glitchlab_shopify.Error, RuntimeError) as e:
+			logger.warning("Can't tell which items in eBay group {} product {}'s variants go to: {}".format(
+				product_sku, product.get('id'), getattr(e, 'message', None) or e ))
+			members = set()
+		for vid, v in variants.items():
+			if vid not in skus and v.get('sku') in members:
+				skus[vid] = v['sku']
+	return skus
+
+def price_quantities(product):
+	"""{eBay SKU: (price, currency, quantity)} for the variants of `product` that are linked to eBay, per the mapping's offer section."""
+	skus = variant_skus(product)
+	if len(skus) == 0:
+		return {}
+	offers = mapping.get_mapping().transform( [product], kinds=('offers',) )[0]['offers']
+	out = {}
+	for vid, sku in skus.items():
+		offer = offers.get(vid, {})
+		price = offer.get('pricingSummary', {}).get('price', {})
+		out[sku] = (price.get('value'), price.get('currency'), offer.get('availableQuantity'))
+	return out
+
+def queue_changes(old, new):
+	"""
+	Queue the stock and price changes between two versions of a Shopify product (`old` may be None, to queue
+	everything in `new`). Only fields that changed are sent. Returns how many SKUs were queued.
+	"""
+	queue = get_queue()
+	if queue.window <= 0:
+		return 0
+	before = price_quantities(old) if old is not None else {}
+	queued = 0
+	for sku, (price, currency, quantity) in price_quantities(new).items():
+		old_price, old_currency, old_quantity = before.get(sku, (None, None, None))
+		changed_price = price if (price, currency) != (old_price, old_currency) else None
+		changed_quantity = quantity if quantity != old_quantity else None
+		if changed_price is None and changed_quantity is None:
+			continue
+		queue.put( sku, price=changed_price, currency=currency, quantity=changed_quantity )
+		queued += 1
+	if queued > 0:
+		logger.debug('Queued price/quantity changes for {} eBay SKUs of product {}'.format(queued, new.get('id')))
+	return queued
+
+"""One queue per process, so each worker starts its flusher once"""
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+	"""The price/quantity queue for this app, in DATA_DIR. Starts this process's flusher the first time, unless it's turned off."""
+	global _queue
+	with _queue_lock:
+		if _queue is None:
+			_queue = PriceQuantityQueue(
+				os.path.join(app.config['DATA_DIR'], 'ebay-price-quantity.sqlite3'),
+				window=app.config.get('EBAY_PRICE_QUANTITY_WINDOW', 5) )
+			if _queue.window > 0:
+				_queue.start_flusher( app._get_current_object() )
+		return _queue
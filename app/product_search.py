@@ -0,0 +1,435 @@
+import os
+import re
+import json
+import time
+import uuid
+import bisect
+import heapq
+import logging
+import threading
+from flask import current_app as app
+
+import localdb
+import glitchlab_shopify
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.product-search')
+logger.setLevel(logging.DEBUG)
+
+"""How much a match in each field counts towards a product's score"""
+FIELD_WEIGHTS = {
+	'id':		3.0,
+	'sku':		2.0,
+	'barcode':	2.0,
+	'mpn':		2.0,
+	'title':	1.0,
+	'vendor':	0.5
+	}
+
+"""How much each kind of token match counts, relative to an exact match"""
+MATCH_EXACT = 1.0
+MATCH_PREFIX = 0.7
+MATCH_FUZZY = 0.4
+
+"""Don't expand a query token to more than this many prefix matches (keeps 1-letter queries fast)"""
+MAX_PREFIX_EXPANSIONS = 200
+
+"""Shortest query token we'll try fuzzy (1-typo) matching on"""
+MIN_FUZZY_LENGTH = 4
+
+"""Seconds a worker waits before trying a rebuild again, if another worker was already doing one or it failed"""
+REBUILD_RETRY_INTERVAL = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+	product_id			INTEGER PRIMARY KEY,
+	doc					TEXT,		-- JSON search document (see document_for_product()); NULL once the product is deleted
+	seq					INTEGER,	-- bumped on every change, so workers can pick up just what changed since they last looked
+	updated_at			REAL
+);
+CREATE INDEX IF NOT EXISTS docs_seq ON docs (seq);
+CREATE TABLE IF NOT EXISTS builds (
+	started_at			REAL,
+	finished_at			REAL,
+	products			INTEGER
+);
+CREATE TABLE IF NOT EXISTS lease (
+	name				TEXT PRIMARY KEY,
+	holder				TEXT,
+	until				REAL
+);
+'''
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+def tokenize(text):
+	"""Lowercase `text` and split it into alphanumeric tokens."""
+	if text is None:
+		return []
+	return TOKEN_RE.findall(str(text).lower())
+
+def code_tokens(code):
+	"""
+	Tokens for a part number-ish field (SKU, barcode, MPN). Includes each piece plus the whole thing with the
+	punctuation squeezed out, so 'ABC-123' matches 'abc', '123', 'abc123' and 'abc-12'.
+	"""
+	tokens = tokenize(code)
+	if len(tokens) > 1:
+		tokens.append(''.join(tokens))
+	return tokens
+
+def deletions(token):
+	"""Every string you can make by deleting one character from `token`."""
+	return set(token[:i] + token[i+1:] for i in range(len(token)))
+
+def within_one_edit(a, b):
+	"""True if `a` and `b` differ by at most one insertion, deletion or substitution."""
+	if abs(len(a) - len(b)) > 1:
+		return False
+	if len(a) > len(b):
+		a, b = b, a
+	i = 0
+	while i < len(a) and a[i] == b[i]:
+		i += 1
+	if len(a) == len(b):
+		return a[i+1:] == b[i+1:]
+	return a[i:] == b[i+1:]
+
+class ProductSearchIndex(object):
+	"""
+	In-memory inverted index over the Shopify catalog, for the search omnibox.
+
+	Each product is a small document (id, title, vendor, variant SKUs and barcodes, MPN metafield) - see
+	`document_for_product()`. Query tokens match index tokens exactly, by prefix (so results show up while the
+	user is still typing), or with a single typo. A product has to match every query token to be returned, and
+	results are ranked by how well and in which fields they matched.
+
+	Safe to search from several threads while another one adds or removes products.
+	"""
+
+	def __init__(self):
+		self._lock = threading.RLock()
+		self.docs = {}				# product id => document
+		self.postings = {}			# token => {product id: best field weight}
+		self.doc_tokens = {}		# product id => set of tokens, so a product can be removed again
+		self.deletes = {}			# one-deletion variant => set of tokens, for typo matching
+		self._vocab = []			# sorted tokens, for prefix matching
+		self._vocab_dirty = False
+		self.built_at = None
+
+	def __len__(self):
+		return len(self.docs)
+
+	def add(self, doc):
+		"""Add a document to the index, replacing any existing document for the same product."""
+		pid = int(doc['id'])
+		with self._lock:
+			self.remove(pid)
+
+			weights = {}
+			def add_tokens(field, tokens):
+				for t in tokens:
+					weights[t] = max(weights.get(t, 0), FIELD_WEIGHTS[field])
+			add_tokens('id', [str(pid)])
+			add_tokens('title', tokenize(doc.get('title')))
+			add_tokens('vendor', tokenize(doc.get('vendor')))
+			add_tokens('mpn', code_tokens(doc.get('mpn')))
+			for sku in doc.get('skus', []):
+				add_tokens('sku', code_tokens(sku))
+			for barcode in doc.get('barcodes', []):
+				add_tokens('barcode', code_tokens(barcode))
+
+			for t, w in weights.items():
+				if t not in self.postings:
+					self.postings[t] = {}
+					self._vocab_dirty = True
+					self.deletes.setdefault(t, set()).add(t)
+					for d in deletions(t):
+						self.deletes.setdefault(d, set()).add(t)
+				self.postings[t][pid] = w
+
+			self.docs[pid] = doc
+			self.doc_tokens[pid] = set(weights)
+
+	def remove(self, product_id):
+		"""Drop a product from the index. Does nothing if it isn't there."""
+		pid = int(product_id)
+		with self._lock:
+			for t in self.doc_tokens.pop(pid, ()):
+				posting = self.postings.get(t)
+				if posting is None:
+					continue
+				posting.pop(pid, None)
+				if len(posting) == 0:
+					del self.postings[t]
+					self._vocab_dirty = True
+					for d in deletions(t) | set([t]):
+						variants = self.deletes.get(d)
+						if variants is not None:
+							variants.discard(t)
+							if len(variants) == 0:
+								del self.deletes[d]
+			self.docs.pop(pid, None)
+
+	def _candidates(self, qt):
+		"""Return {index token: match strength} for one query token."""
+		matches = {}
+		if qt in self.postings:
+			matches[qt] = MATCH_EXACT
+
+		if self._vocab_dirty:
+			self._vocab = sorted(self.postings)
+			self._vocab_dirty = False
+		i = bisect.bisect_left(self._vocab, qt)
+		expansions = 0
+		while i < len(self._vocab) and self._vocab[i].startswith(qt) and expansions < MAX_PREFIX_EXPANSIONS:
+			matches.setdefault(self._vocab[i], MATCH_PREFIX)
+			i += 1
+			expansions += 1
+
+		if len(qt) >= MIN_FUZZY_LENGTH:
+			for d in deletions(qt) | set([qt]):
+				for t in self.deletes.get(d, ()):
+					if t not in matches and within_one_edit(qt, t):
+						matches[t] = MATCH_FUZZY
+		return matches
+
+	def search(self, query, limit=10):
+		"""
+		Return up to `limit` products matching `query`, best first, as a list of {'id': ..., 'title': ...} dicts -
+		the same shape Shopify's products.json?fields=id,title returns.
+		"""
+		qtokens = tokenize(query)
+		if len(qtokens) == 0:
+			return []
+
+		with self._lock:
+			scores = None
+			for qt in qtokens:
+				token_scores = {}
+				for t, strength in self._candidates(qt).items():
+					for pid, w in self.postings[t].items():
+						s = strength * w
+						if s > token_scores.get(pid, 0):
+							token_scores[pid] = s
+				if scores is None:
+					scores = token_scores
+				else:
+					scores = {pid: scores[pid] + s for pid, s in token_scores.items() if pid in scores}
+				if len(scores) == 0:
+					return []
+
+			# Best score first; ties go to the newest product (highest ID)
+			ranked = heapq.nlargest(limit, zip(scores.values(), scores.keys()))
+			return [{'id': pid, 'title': self.docs[pid].get('title')} for s, pid in ranked]
+
+def document_for_product(product, mpn=None):
+	"""
+	Build a search document from a Shopify product dict (REST shape, with `variants` either as a list or
+	keyed by ID). The MPN comes from the product's metafields if present, or from `mpn`.
+	"""
+	variants = product.get('variants') or []
+	if isinstance(variants, dict):
+		variants = variants.values()
+	metafields = product.get('metafields') or {}
+	return {
+		'id': int(product['id']),
+		'title': product.get('title'),
+		'vendor': product.get('vendor'),
+		'skus': [v['sku'] for v in variants if v.get('sku')],
+		'barcodes': [v['barcode'] for v in variants if v.get('barcode')],
+		'mpn': metafields.get('MPN', mpn)
+		}
+
+class SearchDocStore(object):
+	"""
+	The search documents for the whole catalog, in a SQLite file shared by every worker. Each worker searches its
+	own in-memory `ProductSearchIndex`, loaded from here, and catches up on what changed (by `seq`) before every
+	search - so a product a webhook changes in one worker shows up changed in all of them.
+
+	The catalog walk that (re)builds the documents runs in one worker at a time, holding a lease here.
+	"""
+
+	def __init__(self, path, lease=1800):
+		self.path = path
+		self.lease = lease
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def last_build(self):
+		"""The last catalog walk that finished, as a dict, or None."""
+		row = self.conn.execute('SELECT * FROM builds ORDER BY started_at DESC LIMIT 1').fetchone()
+		return dict(row) if row is not None else None
+
+	def changes(self, since):
+		"""Documents changed after `seq` `since`, as a list of (product ID, doc or None if deleted, seq), oldest first."""
+		rows = self.conn.execute('SELECT product_id, doc, seq FROM docs WHERE seq > ? ORDER BY seq', (since,)).fetchall()
+		return [(row['product_id'], json.loads(row['doc']) if row['doc'] is not None else None, row['seq']) for row in rows]
+
+	def get(self, product_id):
+		row = self.conn.execute('SELECT doc FROM docs WHERE product_id = ?', (int(product_id),)).fetchone()
+		return json.loads(row['doc']) if row is not None and row['doc'] is not None else None
+
+	def put(self, product_id, doc):
+		"""Store `doc` for `product_id`, or mark the product deleted if `doc` is None."""
+		with localdb.transaction(self.conn) as conn:
+			self._put(conn, int(product_id), doc, self._next_seq(conn), time.time())
+
+	def _next_seq(self, conn):
+		return conn.execute('SELECT COALESCE(MAX(seq), 0) + 1 AS seq FROM docs').fetchone()['seq']
+
+	def _put(self, conn, product_id, doc, seq, now):
+		conn.execute(
+			'INSERT OR REPLACE INTO docs (product_id, doc, seq, updated_at) VALUES (?, ?, ?, ?)',
+			(product_id, json.dumps(doc, sort_keys=True) if doc is not None else None, seq, now) )
+
+	def replace_all(self, docs, started_at):
+		"""
+		Store the documents from a catalog walk that started at `started_at` (a dict of {product ID: doc}), and mark
+		products it didn't see as deleted. Documents stored since the walk started (by webhooks, say) are newer than
+		what it fetched, so they're kept. Only documents that actually changed get a new `seq`.
+		"""
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			seq = self._next_seq(conn)
+			stored = {row['product_id']: row for row in conn.execute('SELECT product_id, doc, updated_at FROM docs')}
+			for pid, doc in docs.items():
+				row = stored.get(pid)
+				if row is not None and (row['updated_at'] >= started_at or row['doc'] == json.dumps(doc, sort_keys=True)):
+					continue
+				self._put(conn, pid, doc, seq, now)
+				seq += 1
+			for pid, row in stored.items():
+				if pid not in docs and row['doc'] is not None and row['updated_at'] < started_at:
+					self._put(conn, pid, None, seq, now)
+					seq += 1
+			conn.execute(
+				'INSERT INTO builds (started_at, finished_at, products) VALUES (?, ?, ?)', (started_at, now, len(docs)) )
+
+	def take_lease(self, holder):
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			row = conn.execute("SELECT holder, until FROM lease WHERE name = 'build'").fetchone()
+			if row is not None and row['until'] > now and row['holder'] != holder:
+				return False
+			conn.execute("INSERT OR REPLACE INTO lease (name, holder, until) VALUES ('build', ?, ?)", (holder, now + self.lease))
+		return True
+
+	def drop_lease(self, holder):
+		self.conn.execute("DELETE FROM lease WHERE name = 'build' AND holder = ?", (holder,))
+
+def walk_catalog():
+	"""
+	Walk the whole Shopify catalog and return a search document for every product, as {product ID: doc}. Takes a
+	while on a big catalog - this is what the background rebuild runs, don't call it from a request.
+	"""
+	started = time.time()
+	docs = {}
+	for p in glitchlab_shopify.iter_shopify_products( fields='id,title,vendor,variants' ):
+		docs[p['id']] = document_for_product(p)
+	for pid, mpn in glitchlab_shopify.iter_shopify_product_metafield('MPN'):
+		if pid in docs:
+			docs[pid]['mpn'] = mpn
+	logger.info('Walked the Shopify catalog for the search index: {} products in {:.1f}s'.format(len(docs), time.time() - started))
+	return docs
+
+"""The document store, and this worker's index of it (as of `_seq`) plus the bookkeeping for rebuilding it"""
+_store = None
+_store_lock = threading.Lock()
+_index = None
+_seq = 0
+_index_lock = threading.Lock()
+_building = False
+_next_rebuild = 0
+
+def get_store():
+	"""The search document store for this app, in DATA_DIR."""
+	global _store
+	with _store_lock:
+		if _store is None:
+			_store = SearchDocStore( os.path.join(app.config['DATA_DIR'], 'product-search.sqlite3') )
+		return _store
+
+def _rebuild_in_background(flask_app):
+	global _building, _next_rebuild
+	holder = uuid.uuid4().hex
+	done = False
+	try:
+		with flask_app.app_context():
+			store = get_store()
+			if store.take_lease(holder):
+				try:
+					started = time.time()
+					store.replace_all( walk_catalog(), started )
+					done = True
+				finally:
+					store.drop_lease(holder)
+	except Exception as e:
+		logger.error('Failed to rebuild the product search index: {}'.format(e))
+	finally:
+		with _index_lock:
+			_building = False
+			if not done:
+				_next_rebuild = time.time() + REBUILD_RETRY_INTERVAL
+
+def get_index():
+	"""
+	Return this worker's search index, up to date with the document store, or None if no catalog walk has
+	finished yet.
+
+	If the last walk is older than app.config['SEARCH_INDEX_MAX_AGE'] seconds (or there hasn't been one), a new one
+	is started in a background thread - unless another worker is already walking, in which case we check again in
+	REBUILD_RETRY_INTERVAL seconds. The index keeps answering from the documents it has until the walk is done.
+	"""
+	global _index, _seq, _building
+	store = get_store()
+	last = store.last_build()
+	with _index_lock:
+		stale = last is None or time.time() - last['started_at'] > app.config.get('SEARCH_INDEX_MAX_AGE', 6 * 3600)
+		if stale and not _building and time.time() >= _next_rebuild:
+			_building = True
+			t = threading.Thread(
+				target=_rebuild_in_background,
+				args=(app._get_current_object(),),
+				name='product-search-rebuild',
+				daemon=True	)
+			t.start()
+		if last is None:
+			return None
+
+		if _index is None:
+			_index = ProductSearchIndex()
+			_seq = 0
+		for pid, doc, seq in store.changes(_seq):
+			if doc is None:
+				_index.remove(pid)
+			else:
+				_index.add(doc)
+			_seq = seq
+		_index.built_at = last['finished_at']
+		return _index
+
+def index_product(product):
+	"""Add or refresh one product (a Shopify product dict) in the search index, e.g. right after loading it."""
+	doc = document_for_product(product)
+	if 'metafields' not in product:
+		# Webhook payloads don't carry metafields - keep the MPN we already know about
+		doc['mpn'] = (get_store().get(doc['id']) or {}).get('mpn')
+	get_store().put(doc['id'], doc)
+
+def unindex_product(product_id):
+	"""Remove a deleted product from the search index."""
+	get_store().put(product_id, None)
+
+def search(query, limit=10):
+	"""
+	Search the local index. Returns a list of {'id', 'title'} dicts, or None if the index isn't built yet (the
+	caller should fall back to asking Shopify).
+	"""
+	index = get_index()
+	if index is None:
+		return None
+	return index.search(query, limit=limit)
@@ -0,0 +1,208 @@
+import time
+import logging
+import threading
+
+import localdb
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.ratelimit')
+logger.setLevel(logging.DEBUG)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS buckets (
+	name			TEXT PRIMARY KEY,
+	level			REAL,		-- how full the bucket was at updated_at
+	updated_at		REAL,
+	blocked_until	REAL		-- upstream told us to back off until then (Retry-After)
+);
+'''
+
+"""Never sleep longer than this in one go, so we notice when another process drains the bucket for us"""
+MAX_SLEEP = 1.0
+
+class LeakyBucket(object):
+	"""
+	A leaky bucket whose state lives in a SQLite file, so every gunicorn worker (and every thread in each of them)
+	shares one view of how much of an upstream's limit is in use.
+
+	The bucket holds up to `capacity` units and drains at `leak_rate` units per second - the same model Shopify
+	uses. `acquire(cost)` blocks until `cost` units fit under `capacity - headroom`, then adds them. The headroom
+	leaves room for requests we don't know about (other apps on the same store, clock skew), so we pace ourselves
+	just under the limit instead of bouncing off it.
+
+	When the upstream reports its own idea of the bucket level, `observe()` corrects ours, and `block()` records a
+	Retry-After.
+	"""
+
+	def __init__(self, path, name, capacity, leak_rate, headroom=0):
+		self.path = path
+		self.name = name
+		self.capacity = float(capacity)
+		self.leak_rate = float(leak_rate)
+		self.headroom = float(headroom)
+		self.waits = 0
+		self.waited_seconds = 0.0
+		self._lock = threading.Lock()
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def _load(self, conn, now):
+		"""Return (level, blocked_until) as of `now`, with the leak since the last update applied."""
+		row = conn.execute('SELECT level, updated_at, blocked_until FROM buckets WHERE name = ?', (self.name,)).fetchone()
+		if row is None:
+			return 0.0, 0.0
+		level = max(0.0, row['level'] - (now - row['updated_at']) * self.leak_rate)
+		return level, row['blocked_until'] or 0.0
+
+	def _save(self, conn, level, now, blocked_until):
+		conn.execute(
+			'INSERT OR REPLACE INTO buckets (name, level, updated_at, blocked_until) VALUES (?, ?, ?, ?)',
+			(self.name, level, now, blocked_until) )
+
+	def acquire(self, cost=1):
+		"""Block until there's room for `cost` units in the bucket, then take them. Returns the seconds spent waiting."""
+		cost = min(float(cost), self.capacity - self.headroom)
+		waited = 0.0
+		while True:
+			now = time.time()
+			with localdb.transaction(self.conn) as conn:
+				level, blocked_until = self._load(conn, now)
+				if now >= blocked_until and level + cost <= self.capacity - self.headroom:
+					self._save(conn, level + cost, now, blocked_until)
+					break
+			if now < blocked_until:
+				wait = blocked_until - now
+			else:
+				wait = (level + cost - (self.capacity - self.headroom)) / self.leak_rate
+			wait = min(max(wait, 0.01), MAX_SLEEP)
+			time.sleep(wait)
+			waited += wait
+
+		if waited > 0:
+			with self._lock:
+				self.waits += 1
+				self.waited_seconds += waited
+			logger.debug('Waited {:.2f}s for room in the {} rate limit bucket'.format(waited, self.name))
+		return waited
+
+	def observe(self, level, capacity=None):
+		"""Set the bucket level to what the upstream says it is right now."""
+		if capacity is not None:
+			self.capacity = float(capacity)
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			old_level, blocked_until = self._load(conn, now)
+			self._save(conn, float(level), now, blocked_until)
+
+	def block(self, seconds):
+		"""The upstream throttled us: nobody sends anything to it for `seconds`."""
+		now = time.time()
+		logger.warning('{} throttled us, backing off for {:.1f}s'.format(self.name, seconds))
+		with localdb.transaction(self.conn) as conn:
+			level, blocked_until = self._load(conn, now)
+			self._save(conn, self.capacity, now, max(blocked_until, now + seconds))
+
+	def stats(self):
+		now = time.time()
+		level, blocked_until = self._load(self.conn, now)
+		return {
+			'level': round(level, 2),
+			'capacity': self.capacity,
+			'leak_rate': self.leak_rate,
+			'blocked_for': max(0.0, blocked_until - now),
+			'waits': self.waits,
+			'waited_seconds': round(self.waited_seconds, 2)
+			}
+
+def retry_after_seconds(response, default):
+	"""How long a throttled `response` asks us to wait, from its Retry-After header (seconds), or `default`."""
+	try:
+		return float(response.headers['Retry-After'])
+	except (KeyError, ValueError):
+		return default
+
+class ShopifyRateLimit(object):
+	"""
+	Rate limiting for the Shopify Admin API. REST and GraphQL have separate buckets:
+
+	* REST: 40 requests, leaking 2 per second. Every reply carries X-Shopify-Shop-Api-Call-Limit ('32/40'),
+		which we use to correct our bucket.
+	* GraphQL: 1000 cost points, restoring 50 per second. We take the query's estimated cost up front, and every
+		reply reports the real bucket in extensions.cost.throttleStatus.
+
+	A 429 (or a GraphQL 'Throttled' error) blocks the bucket for Retry-After seconds and asks the client to
+	retry the request.
+	"""
+
+	def __init__(self, path, headroom=2, graphql_headroom=50):
+		self.rest = LeakyBucket(path, 'shopify-rest', capacity=40, leak_rate=2, headroom=headroom)
+		self.graphql = LeakyBucket(path, 'shopify-graphql', capacity=1000, leak_rate=50, headroom=graphql_headroom)
+
+	def _bucket(self, url):
+		return self.graphql if url.split('?')[0].endswith('/graphql.json') else self.rest
+
+	def before(self, method, url, cost=None):
+		self._bucket(url).acquire( cost if cost is not None else 1 )
+
+	def after(self, response):
+		"""Update the buckets from `response`. Returns True if the request was throttled and should be retried."""
+		bucket = self._bucket(response.request.url)
+		if response.status_code == 429:
+			bucket.block( retry_after_seconds(response, 2.0) )
+			return True
+
+		if bucket is self.rest:
+			limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+			if limit is not None:
+				try:
+					used, capacity = limit.split('/')
+					bucket.observe( float(used), capacity=float(capacity) )
+				except ValueError:
+					pass
+			return False
+
+		try:
+			j = response.json()
+		except ValueError:
+			return False
+		throttle = j.get('extensions', {}).get('cost', {}).get('throttleStatus')
+		if throttle is not None:
+			bucket.leak_rate = float(throttle['restoreRate'])
+			bucket.observe( throttle['maximumAvailable'] - throttle['currentlyAvailable'], capacity=throttle['maximumAvailable'] )
+		if any( e.get('extensions', {}).get('code') == 'THROTTLED' or e.get('message') == 'Throttled' for e in j.get('errors') or [] ):
+			requested = j.get('extensions', {}).get('cost', {}).get('requestedQueryCost', 0)
+			if throttle is not None:
+				bucket.block( max(0.5, (requested - throttle['currentlyAvailable']) / float(throttle['restoreRate'])) )
+			else:
+				bucket.block(1.0)
+			return True
+		return False
+
+	def stats(self):
+		return {'rest': self.rest.stats(), 'graphql': self.graphql.stats()}
+
+class EbayRateLimit(object):
+	"""
+	Rate limiting for the eBay APIs. eBay doesn't tell us where we are against its limits, so we pace ourselves
+	at `per_second` calls per second with bursts of up to `burst`, and back off for Retry-After (or
+	`backoff` seconds) whenever eBay answers 429.
+	"""
+
+	def __init__(self, path, per_second=5, burst=10, backoff=5.0):
+		self.bucket = LeakyBucket(path, 'ebay', capacity=burst, leak_rate=per_second)
+		self.backoff = backoff
+
+	def before(self, method, url, cost=None):
+		self.bucket.acquire( cost if cost is not None else 1 )
+
+	def after(self, response):
+		if response.status_code == 429:
+			self.bucket.block( retry_after_seconds(response, self.backoff) )
+			return True
+		return False
+
+	def stats(self):
+		return {'ebay': self.bucket.stats()}
@@ -0,0 +1,80 @@
+import os
+import time
+import logging
+from flask import current_app as app
+
+import localdb
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.sku-index')
+logger.setLevel(logging.DEBUG)
+
+"""What an eBay SKU turned out to be. Same strings as the `_gl_ebay_type` the UI gets."""
+INVENTORY_ITEM = 'inventoryitem'
+INVENTORY_ITEM_GROUP = 'inventoryitemgroup'
+UNKNOWN = 'unknown'			# eBay has neither an item nor a group with this SKU
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS skus (
+	sku				TEXT PRIMARY KEY,
+	type			TEXT,
+	learned_at		REAL		-- unix time
+);
+'''
+
+class SkuIndex(object):
+	"""
+	Remembers whether each eBay SKU is an inventory item, an inventory item group or neither, so
+	`/api/ebay/product` can ask the right eBay API first instead of probing getInventoryItem and waiting for the
+	404. Shared by every worker through a SQLite file.
+
+	Types are learned from eBay's replies. An entry is trusted for `max_age` seconds; UNKNOWN entries only for
+	`unknown_max_age`, since a missing SKU is likely to be created soon. A wrong entry only costs the round trip
+	it was meant to save - callers fall back to probing and correct it.
+	"""
+
+	def __init__(self, path, max_age=7 * 86400, unknown_max_age=600):
+		self.path = path
+		self.max_age = max_age
+		self.unknown_max_age = unknown_max_age
+
+	@property
+	def conn(self):
+		return localdb.connect(self.path, SCHEMA)
+
+	def lookup(self, sku):
+		"""Return the type we last learned for `sku`, or None if we don't know or it's expired."""
+		row = self.conn.execute('SELECT type, learned_at FROM skus WHERE sku = ?', (sku,)).fetchone()
+		if row is None:
+			return None
+		max_age = self.unknown_max_age if row['type'] == UNKNOWN else self.max_age
+		if time.time() - row['learned_at'] > max_age:
+			return None
+		return row['type']
+
+	def learn(self, sku, sku_type):
+		"""Record that `sku` is `sku_type`."""
+		self.learn_many( [sku], sku_type )
+
+	def learn_many(self, skus, sku_type):
+		now = time.time()
+		with localdb.transaction(self.conn) as conn:
+			conn.executemany(
+				'INSERT OR REPLACE INTO skus (sku, type, learned_at) VALUES (?, ?, ?)',
+				[(sku, sku_type, now) for sku in skus] )
+
+	def forget(self, sku):
+		"""Drop what we know about `sku` (e.g. eBay contradicted it)."""
+		self.conn.execute('DELETE FROM skus WHERE sku = ?', (sku,))
+
+	def stats(self):
+		rows = self.conn.execute('SELECT type, COUNT(*) AS n FROM skus GROUP BY type').fetchall()
+		return {row['type']: row['n'] for row in rows}
+
+def get_sku_index():
+	"""The SKU index for this app, in DATA_DIR."""
+	return SkuIndex(
+		os.path.join(app.config['DATA_DIR'], 'sku-index.sqlite3'),
+		max_age=app.config.get('SKU_INDEX_MAX_AGE', 7 * 86400),
+		unknown_max_age=app.config.get('SKU_INDEX_UNKNOWN_MAX_AGE', 600) )
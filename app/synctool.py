@@ -2,11 +2,14 @@ import logging
 import json
 from flask import Flask, render_template, request, abort, send_from_directory, session, redirect, url_for, jsonify
 import os
-import requests
 import datetime
 from flask_cors import CORS
 import re
-import copy
+import hmac
+import hashlib
+import base64
+import asyncio
+import click
 
 """Flask app setup"""
 app = Flask(__name__)
@@ -29,6 +32,8 @@ if os.path.exists('.env'):
 	
 app.config['STATIC_FILE_DIR'] 			= os.getenv('STATIC_FILE_DIR', 
 											 '/static'			)
+app.config['DATA_DIR']					= os.getenv('DATA_DIR',		# local indexes, caches and queues live here
+											 '/tmp/ebay-sync'	)
 app.config['APP_SECRET_KEY'] 				= os.getenv('APP_SECRET_KEY',	# for encrypting sesh
 											 None 				)
 app.config['EBAY_OAUTH_CLIENT_ID']		= os.getenv('EBAY_OAUTH_CLIENT_ID',
@@ -55,6 +60,63 @@ app.config['SHOPIFY_API_PW'] 			= os.getenv('SHOPIFY_API_PW',
 											 None )
 app.config['SHOPIFY_STORE_DOMAIN'] 		= os.getenv('SHOPIFY_STORE_DOMAIN',
 											 'glitchlab.myshopify.com' )
+app.config['SHOPIFY_FETCH_CONCURRENCY']	= int(os.getenv('SHOPIFY_FETCH_CONCURRENCY',	# max parallel reqs per product load
+											 8 ))
+app.config['SHOPIFY_PRODUCT_LOADER']		= os.getenv('SHOPIFY_PRODUCT_LOADER',	# 'graphql' (one query) or 'rest'
+											 'graphql' )
+app.config['SHOPIFY_GRAPHQL_COST_BUDGET']	= int(os.getenv('SHOPIFY_GRAPHQL_COST_BUDGET',	# max requested cost per query
+											 1000 ))
+app.config['SHOPIFY_GRAPHQL_VARIANTS_PER_PAGE'] = int(os.getenv('SHOPIFY_GRAPHQL_VARIANTS_PER_PAGE',
+											 50 ))
+app.config['SEARCH_INDEX_MAX_AGE']		= int(os.getenv('SEARCH_INDEX_MAX_AGE',	# secs before the search index is rebuilt
+											 6 * 3600 ))
+app.config['SHOPIFY_WEBHOOK_SECRET']		= os.getenv('SHOPIFY_WEBHOOK_SECRET',	# signs webhooks, from Shopify admin
+											 None )
+app.config['CATALOG_STORE_MAX_AGE']		= int(os.getenv('CATALOG_STORE_MAX_AGE',	# secs a stored product is served
+											 24 * 3600 ))
+app.config['SHOPIFY_PRODUCT_CACHE_TTL']	= int(os.getenv('SHOPIFY_PRODUCT_CACHE_TTL',	# secs a loaded product is reused
+											 300 ))
+app.config['SHOPIFY_PRODUCT_CACHE_SIZE']	= int(os.getenv('SHOPIFY_PRODUCT_CACHE_SIZE',	# products kept per worker
+											 256 ))
+app.config['SHOPIFY_RATE_LIMIT_HEADROOM']	= int(os.getenv('SHOPIFY_RATE_LIMIT_HEADROOM',	# REST calls left unused in bucket
+											 2 ))
+app.config['EBAY_RATE_LIMIT_PER_SEC']	= float(os.getenv('EBAY_RATE_LIMIT_PER_SEC',	# sustained eBay calls per second
+											 5 ))
+app.config['EBAY_RATE_LIMIT_BURST']		= int(os.getenv('EBAY_RATE_LIMIT_BURST',
+											 10 ))
+app.config['EBAY_FETCH_CONCURRENCY']		= int(os.getenv('EBAY_FETCH_CONCURRENCY',	# max parallel eBay calls per load/save
+											 8 ))
+app.config['SKU_INDEX_MAX_AGE']			= int(os.getenv('SKU_INDEX_MAX_AGE',	# secs we trust a SKU's item/group type
+											 7 * 86400 ))
+app.config['SKU_INDEX_UNKNOWN_MAX_AGE']	= int(os.getenv('SKU_INDEX_UNKNOWN_MAX_AGE',	# same, for SKUs eBay didn't have
+											 600 ))
+app.config['EBAY_CACHE_TTL']			= int(os.getenv('EBAY_CACHE_TTL',	# secs a fetched eBay object is merged against
+											 120 ))
+app.config['EBAY_CACHE_SIZE']			= int(os.getenv('EBAY_CACHE_SIZE',	# eBay items/groups/offers kept per worker
+											 1024 ))
+app.config['EBAY_TOKEN_REFRESH_MARGIN']	= int(os.getenv('EBAY_TOKEN_REFRESH_MARGIN',	# refresh eBay tokens this many secs early
+											 600 ))
+app.config['EBAY_TOKEN_REFRESH_INTERVAL']	= int(os.getenv('EBAY_TOKEN_REFRESH_INTERVAL',	# secs between checks, 0 = never
+											 60 ))
+app.config['EBAY_BACKGROUND_ACCOUNT']	= os.getenv('EBAY_BACKGROUND_ACCOUNT',	# token store account for background work
+											 None )
+app.config['EBAY_MIRROR_MAX_AGE']		= int(os.getenv('EBAY_MIRROR_MAX_AGE',	# secs the eBay mirror is served after a sync
+											 3600 ))
+app.config['EBAY_MIRROR_OFFERS_MAX_AGE']	= int(os.getenv('EBAY_MIRROR_OFFERS_MAX_AGE',	# secs before a sync refetches offers
+											 86400 ))
+app.config['EBAY_MIRROR_SYNC_INTERVAL']	= int(os.getenv('EBAY_MIRROR_SYNC_INTERVAL',	# secs between mirror syncs, 0 = never
+											 0 ))
+app.config['JOB_WORKERS']				= int(os.getenv('JOB_WORKERS',		# job queue threads per worker process
+											 2 ))
+app.config['JOB_RETENTION']				= int(os.getenv('JOB_RETENTION',	# secs finished jobs are kept for /api/jobs
+											 7 * 86400 ))
+app.config['EBAY_MAPPING_FILE']			= os.getenv('EBAY_MAPPING_FILE')		# JSON Shopify->eBay mapping, instead of mapping.DEFAULT_MAPPING
+app.config['EBAY_PRICE_QUANTITY_WINDOW']	= int(os.getenv('EBAY_PRICE_QUANTITY_WINDOW',	# secs price/stock changes are collected per SKU, 0 = don't push
+											 5 ))
+app.config['UPSTREAM_POOL_SIZE']			= int(os.getenv('UPSTREAM_POOL_SIZE',	# keep-alive conns per upstream host
+											 max( int(os.getenv('GUNICORN_THREADS', 1)),
+											 	  app.config['SHOPIFY_FETCH_CONCURRENCY'],
+											 	  app.config['EBAY_FETCH_CONCURRENCY'] ) ))
 											 
 app.config['SESSION_COOKIE_DOMAIN'] 	= 'ebay-sync.slirp.aaronbeekay.info'
 app.config['SESSION_COOKIE_HTTPONLY'] 	= False
@@ -62,9 +124,13 @@ app.config['SESSION_COOKIE_SAMESITE'] 	= 'Lax'
 											 
 """Constants"""
 app.config['EBAY_INVENTORYITEM_URL'] = 'https://api.ebay.com/sell/inventory/v1/inventory_item/{}'
+app.config['EBAY_INVENTORYITEMS_URL'] = 'https://api.ebay.com/sell/inventory/v1/inventory_item'
 app.config['EBAY_INVENTORYITEMGROUP_URL'] = 'https://api.ebay.com/sell/inventory/v1/inventory_item_group/{}'
 app.config['EBAY_INVENTORYOFFERS_URL'] = 'https://api.ebay.com/sell/inventory/v1/offer?sku={}'
 app.config['EBAY_INVENTORYOFFER_URL'] = 'https://api.ebay.com/sell/inventory/v1/offer/{}'
+app.config['EBAY_BULKGETINVENTORYITEM_URL'] = 'https://api.ebay.com/sell/inventory/v1/bulk_get_inventory_item'
+app.config['EBAY_BULKCREATEORREPLACEINVENTORYITEM_URL'] = 'https://api.ebay.com/sell/inventory/v1/bulk_create_or_replace_inventory_item'
+app.config['EBAY_BULKUPDATEPRICEQUANTITY_URL'] = 'https://api.ebay.com/sell/inventory/v1/bulk_update_price_quantity'
 app.config['constants'] = {	
 	'EBAY_ERROR_SKU_NOT_FOUND': 		25702,
 	'EBAY_ERROR_ENTITY_NOT_FOUND':		25710,
@@ -79,6 +145,21 @@ app.secret_key = app.config['APP_SECRET_KEY']
 
 # need to do this after setting up app for the time being because glitchlab_shopify.py relies on global object `app`
 import glitchlab_shopify
+import glitchlab_async
+import aioupstream
+import upstream
+import product_search
+import cache
+import catalog_store
+import sku_index
+import fingerprints
+import mapping
+import fanout
+import ebay_tokens
+import ebay_mirror
+import batch_sync
+import jobs
+import price_quantity
 
 def crossdomain(origin=None, methods=None, headers=None, max_age=21600,
                 attach_to_all=True, automatic_options=True):
@@ -118,7 +199,8 @@ def crossdomain(origin=None, methods=None, headers=None, max_age=21600,
             if automatic_options and request.method == 'OPTIONS':
                 resp = current_app.make_default_options_response()
             else:
-                resp = make_response(f(*args, **kwargs))
+                # ensure_sync lets this wrap `async def` views too
+                resp = make_response(current_app.ensure_sync(f)(*args, **kwargs))
             if not attach_to_all and request.method != 'OPTIONS':
                 return resp
 
@@ -182,9 +264,8 @@ if __name__ != '__main__':	# only do this when running w gunicorn
 @app.route('/api/shopify/test-auth')
 def test_shopify_auth():
 	"""Do a test call to the Shopify API to make sure we have good credentials"""
-	response = requests.get(
-		'https://' + app.config['SHOPIFY_STORE_DOMAIN'] + '/admin/api/2019-04/products/count.json',
-		auth=(app.config['SHOPIFY_API_KEY'],app.config['SHOPIFY_API_PW'])
+	response = upstream.shopify_client().get(
+		'https://' + app.config['SHOPIFY_STORE_DOMAIN'] + '/admin/api/2019-04/products/count.json'
 	)
 	
 	try:
@@ -206,20 +287,18 @@ def test_ebay_auth():
 	
 	#logger.debug('/api/ebay/test-auth: Session variables are => {}'.format(json.dumps(dict(session))))
 	
-	if 'access_token' not in session:
+	if ebay_tokens.current_account() is None:
 		return jsonify({'ebay_auth_success': False, 'error': 'ebay_auth_missing', 'ebay_consent_url': app.config['EBAY_OAUTH_CONSENT_URL']}), 403
-		
-	if session.get('access_token_expiry') < datetime.datetime.utcnow():
 	
-		if 'refresh_token' in session:
-			refresh_access_token(session.get('refresh_token'))		
-			return jsonify({'ebay_auth_success': False, 'error': 'ebay_auth_refreshed', 'message': 'eBay token has been refreshed, try reloading'}), 403
-		else:	
-			return jsonify({'ebay_auth_success': False, 'error': 'ebay_auth_expired'}), 403
+	# The token manager refreshes the token if it needs to, so this is either a good token or a dead end
+	try:
+		auth_token = ebay_tokens.access_token()
+	except ebay_tokens.TokenError as e:
+		return jsonify({'ebay_auth_success': False, 'error': 'ebay_auth_expired', 'message': e.message, 'ebay_consent_url': app.config['EBAY_OAUTH_CONSENT_URL']}), 403
 	
-	response = requests.get(
+	response = upstream.ebay_client().get(
 		'https://api.ebay.com/sell/inventory/v1/inventory_item?limit=1',
-		headers={'Authorization': 'Bearer {}'.format(session['access_token'])})
+		auth_token=auth_token)
 	
 	try:
 		j = response.json()
@@ -242,6 +321,11 @@ def shopify_search():
 	if 'q' not in request.args:
 		return jsonify({"error": "You need to supply the id parameter"}), 400
 	
+	# Answer from the local search index; until it's built, ask Shopify (title match only)
+	r = product_search.search( request.args.get('q') )
+	if r is not None:
+		return jsonify(r)
+	
 	try:	
 		r = glitchlab_shopify.get_shopify_product_matches( request.args.get('q') ).get('products')
 		return jsonify(r)
@@ -249,15 +333,19 @@ def shopify_search():
 		return jsonify({}), 404	
 	
 @app.route('/api/shopify/product', methods=['GET', 'POST'])
-def shopify_product_endpoint():
+async def shopify_product_endpoint():
 	if 'id' not in request.args:
 		return jsonify({"error": "You need to supply the id parameter"}), 400
+	if not request.args['id'].isdigit():
+		return jsonify({"error": "The id parameter should be a Shopify product ID (a number)"}), 400
 	
 	if request.method == 'GET':
 		with app.app_context():
 			try:
-				p = glitchlab_shopify.get_shopify_product( request.args['id'] )	
+				p = await aioupstream.call( glitchlab_async.get_shopify_product( aioupstream.shopify_async_client(), request.args['id'] ) )
+				
 				json.dumps(p)
+				product_search.index_product( p['product'] )
 				return jsonify(p)
 			except TypeError:
 				return jsonify({"error": "TypeError in shopify_product_endpoint()"}), 500 
@@ -274,7 +362,13 @@ def shopify_product_endpoint():
 		except glitchlab_shopify.ProductWriteError as e:
 			logger.error("Product write error: {}".format(e.message))
 			return jsonify({"error": e.message}), 400
-			
+		except glitchlab_shopify.AuthenticationError as e:
+			logger.error("Shopify turned down our credentials writing product {}: {}".format(request.args['id'], e.message))
+			return jsonify({"error": e.message}), 403
+		except RuntimeError as e:
+			logger.error("Writing Shopify product {} failed: {}".format(request.args['id'], e))
+			return jsonify({"error": str(e)}), 500
+
 		return jsonify({"Status": "OK"}), 200 
 		
 @app.route('/api/shopify/product-metafield', methods=['GET', 'POST'])
@@ -308,7 +402,124 @@ def shopify_product_metafield():
 		except KeyError as e:
 			logger.info('POST request to /api/shopify/product-metafield was missing key: {}'.format(e))
 			return('Missing a key or two', 400)
-		
+
+@app.route('/api/shopify/product-metafields', methods=['POST'])
+def shopify_product_metafields():
+	"""
+	Write many metafields at once. The body is a list of {"product_id", "variant_id" (optional), "key", "value"},
+	in the order they were edited; a key written twice for the same product or variant keeps the last value. Each
+	product's writes go out as one `set_metafields_batch()` call, and the products in parallel.
+
+	Answers 200 with {created, updated, unchanged} counts per product, or 207 with an error for each product
+	Shopify turned down (500 if that was all of them). If Shopify turned down our credentials, it's 403, like the
+	single-metafield endpoint.
+	"""
+	entries = request.get_json(force=True, silent=True)
+	if not isinstance(entries, list):
+		return jsonify({'error': 'Expected a list of {"product_id", "variant_id", "key", "value"} objects'}), 400
+	try:
+		by_product = glitchlab_shopify.group_metafield_writes(entries)
+	except (KeyError, TypeError, ValueError) as e:
+		logger.info('POST request to /api/shopify/product-metafields had a bad entry: {}'.format(e))
+		return jsonify({'error': 'Every entry needs a product_id, a key and a value'}), 400
+
+	def write(product_id):
+		product_metafields, variant_metafields = by_product[product_id]
+		return glitchlab_shopify.set_metafields_batch( product_id, product_metafields, variant_metafields )
+
+	results, errors, auth_error = {}, {}, None
+	for product_id, counts, e in fanout.bounded_map( write, sorted(by_product), app.config['SHOPIFY_FETCH_CONCURRENCY'] ):
+		if e is None:
+			results[product_id] = counts
+		elif isinstance(e, glitchlab_shopify.ProductWriteError):
+			errors[product_id] = e.message
+		elif isinstance(e, glitchlab_shopify.AuthenticationError):
+			errors[product_id] = auth_error = e.message
+		else:
+			logger.error('Writing metafields for product {} failed: {}'.format(product_id, e))
+			errors[product_id] = str(e)
+
+	logger.debug('Wrote {} metafield(s) for {} product(s) in one request'.format(len(entries), len(by_product)))
+	if auth_error is not None:
+		logger.error('Shopify turned down our credentials writing metafields: {}'.format(auth_error))
+		return jsonify({'error': auth_error, 'products': results, 'errors': errors}), 403
+	if len(errors) > 0 and len(results) == 0:
+		return jsonify({'error': 'No products were written', 'products': results, 'errors': errors}), 500
+	if len(errors) > 0:
+		return jsonify({'error': 'Some products were not written', 'products': results, 'errors': errors}), 207
+	return jsonify({'Status': 'OK', 'products': results}), 200
+
+	
+@app.route('/api/shopify/webhooks', methods=['POST'])
+def shopify_webhooks():
+	"""
+	Receive Shopify webhooks and apply them to the local catalog store, the product cache and the search index.
+	
+	Handles products/create, products/update, products/delete and inventory_levels/update. Every request has to
+	carry a valid X-Shopify-Hmac-Sha256 signature made with SHOPIFY_WEBHOOK_SECRET.
+	"""
+	
+	if app.config['SHOPIFY_WEBHOOK_SECRET'] is None:
+		logger.warning('Got a Shopify webhook but SHOPIFY_WEBHOOK_SECRET is not set, ignoring it')
+		return jsonify({'error': 'Webhooks are not configured'}), 503
+	
+	body = request.get_data()
+	digest = hmac.new( app.config['SHOPIFY_WEBHOOK_SECRET'].encode('utf-8'), body, hashlib.sha256 ).digest()
+	expected = base64.b64encode(digest).decode('ascii')
+	if not hmac.compare_digest( expected, request.headers.get('X-Shopify-Hmac-Sha256', '') ):
+		logger.warning('Rejected a Shopify webhook with a bad HMAC signature (topic {})'.format(request.headers.get('X-Shopify-Topic')))
+		return jsonify({'error': 'Bad signature'}), 401
+	
+	topic = request.headers.get('X-Shopify-Topic')
+	try:
+		payload = json.loads(body)
+	except ValueError:
+		return jsonify({'error': 'Invalid JSON body'}), 400
+	logger.debug('Shopify webhook {} for {}'.format(topic, payload.get('id', payload.get('inventory_item_id'))))
+	
+	store = catalog_store.get_store()
+	if topic in ('products/create', 'products/update'):
+		old = store.get( payload['id'] )
+		store.apply_product(payload)
+		glitchlab_shopify.shopify_product_cache().invalidate( str(payload['id']) )
+		product_search.index_product(payload)
+		queue_price_quantity_changes( store, old, payload['id'] )
+	elif topic == 'products/delete':
+		store.delete( payload['id'] )
+		glitchlab_shopify.shopify_product_cache().invalidate( str(payload['id']) )
+		product_search.unindex_product( payload['id'] )
+	elif topic == 'inventory_levels/update':
+		old_id = store.product_id_for_inventory_item( payload['inventory_item_id'] )
+		old = store.get(old_id) if old_id is not None else None
+		product_id = store.apply_inventory_level(payload)
+		if product_id is not None:
+			glitchlab_shopify.shopify_product_cache().invalidate( str(product_id) )
+			queue_price_quantity_changes( store, old, product_id )
+	else:
+		logger.info('Ignoring Shopify webhook with unhandled topic {}'.format(topic))
+	
+	# Shopify only cares that we answer 2xx quickly, otherwise it retries
+	return jsonify({'Status': 'OK'}), 200
+
+def queue_price_quantity_changes(store, old, product_id):
+	"""
+	Send the stock and price changes a webhook made to product `product_id` to eBay, through the price/quantity
+	fast path (see price_quantity.py). `old` is the stored product from before the webhook. We only know which eBay
+	SKUs a product goes to once it has been loaded in full (the webhooks don't carry metafields), so products we
+	only have a partial copy of are skipped; the next save or `flask sync` covers them.
+	"""
+	if old is None:
+		return
+	new = store.get(product_id)
+	if new is None:
+		return
+	try:
+		# Nobody in particular asked for this, so any eBay lookups run as the background account
+		with ebay_tokens.acting_as( app.config.get('EBAY_BACKGROUND_ACCOUNT') ):
+			price_quantity.queue_changes( old['product'], new['product'] )
+	except Exception:
+		# Never fail the webhook over this, or Shopify retries it and our catalog store gets it twice
+		logger.exception('Failed to queue eBay price/quantity changes for product {}'.format(product_id))
 	
 @app.route('/api/ebay-oauth-callback', methods=['GET'])
 def handle_ebay_callback():
@@ -363,34 +574,109 @@ def set_session_keys():
 		
 @app.route('/api/test-ebay-call')
 def test_ebay_api_call():
-	if 'access_token' in session and datetime.datetime.utcnow() < session.get('access_token_expiry'):
-		response = requests.get(
-			'https://api.ebay.com/sell/inventory/v1/inventory_item',
-			headers={'Authorization': 'Bearer {}'.format(session['access_token'])})
-			
-		# Return tokens in JSON so that we can grab them for dev use
-		return jsonify({'access_token': session['access_token'], 'access_token_expiry': session['access_token_expiry'], 'refresh_token': session['refresh_token']})
-	elif 'refresh_token' in session:
-		# access token is expired, go refresh it
-		logger.debug('User access token expired, refreshing it...')
-		new_auth = refresh_access_token( session['refresh_token'] )
-		
-		# Return tokens in JSON so that we can grab them for dev use
-		return jsonify({'access_token': session['access_token'], 'access_token_expiry': session['access_token_expiry'], 'refresh_token': session['refresh_token']})
-	else:
-		logger.debug('User access token or user refresh token not present, redirecting to eBay consent thing: {}'.format(app.config['EBAY_OAUTH_CONSENT_URL']))
+	try:
+		auth_token = ebay_tokens.access_token()
+	except ebay_tokens.TokenError:
+		logger.debug('No usable eBay token for this session, redirecting to eBay consent thing: {}'.format(app.config['EBAY_OAUTH_CONSENT_URL']))
 		return redirect(app.config['EBAY_OAUTH_CONSENT_URL'])
 		
+	response = upstream.ebay_client().get(
+		'https://api.ebay.com/sell/inventory/v1/inventory_item',
+		auth_token=auth_token)
+		
+	# Return the token in JSON so that we can grab it for dev use
+	status = ebay_tokens.get_manager().status( ebay_tokens.current_account() )
+	status['access_token'] = auth_token
+	return jsonify(status)
+		
+@app.route('/api/dev/upstream-stats')
+def upstream_stats():
+	"""
+	Debug/dev use: request and connection counts for the pooled Shopify and eBay clients in this worker, and how
+	many writes were sent or skipped because nothing had changed.
+	"""
+	stats = upstream.all_stats()
+	stats['writes'] = glitchlab_shopify.all_write_stats()
+	stats['ebay_tokens'] = ebay_tokens.get_manager().stats()
+	return jsonify(stats)
+
+@app.route('/api/dev/cache-stats')
+def cache_stats():
+	"""Debug/dev use: hit/miss/eviction counters for the in-process caches in this worker."""
+	stats = cache.all_stats()
+	stats['sku_index'] = sku_index.get_sku_index().stats()
+	stats['fingerprints'] = fingerprints.get_store().stats()
+	stats['ebay_mirror'] = ebay_mirror.get_mirror().stats()
+	stats['jobs'] = jobs.get_queue().stats()
+	stats['price_quantity'] = price_quantity.get_queue().stats()
+	return jsonify(stats)
+		
+@app.route('/api/ebay/mirror', methods=['GET', 'POST'])
+def ebay_mirror_endpoint():
+	"""
+	The local eBay mirror: its stats (GET), or start a sync in the background (POST, `?full=1` to refetch every
+	item's offers). Same as running `flask ebay-mirror-sync`.
+	"""
+	mirror = ebay_mirror.get_mirror()
+	if request.method == 'POST':
+		try:
+			glitchlab_shopify.ebay_auth_token()		# only signed-in users get to start one
+		except glitchlab_shopify.AuthenticationError as e:
+			return jsonify({'error': 'ebay_auth_invalid', 'message': e.message}), 403
+		full = request.args.get('full', '').lower() in ('1', 'true', 'yes')
+		started = mirror.start_sync( app, full=full, account=ebay_tokens.current_account() )
+		return jsonify({'started': started, 'mirror': mirror.stats()}), 202 if started else 409
+	return jsonify(mirror.stats())
+
+@app.cli.command('ebay-mirror-sync')
+@click.option('--full', is_flag=True, help="Refetch every item's offers, not just the ones that are due.")
+def ebay_mirror_sync_command(full):
+	"""Bring the local eBay mirror up to date, as the background account (EBAY_BACKGROUND_ACCOUNT)."""
+	try:
+		stats = ebay_mirror.get_mirror().sync(full=full)
+	except ebay_mirror.SyncError as e:
+		raise click.ClickException(e.message)
+	click.echo(json.dumps(stats, indent=2))
+
+@app.cli.command('ebay-accounts')
+def ebay_accounts_command():
+	"""List the eBay accounts in the token store, newest sign-in first - pick one for EBAY_BACKGROUND_ACCOUNT."""
+	click.echo(json.dumps(ebay_tokens.get_manager().accounts(), indent=2))
+
+@app.cli.command('sync')
+@click.option('--workers', default=8, show_default=True, help='Products synced at once.')
+@click.option('--processes', is_flag=True, help='Run the workers as separate processes instead of threads.')
+@click.option('--restart', is_flag=True, help="Start a new run even if the last one didn't finish.")
+@click.option('--incremental', is_flag=True, help="Skip products whose eBay payload hasn't changed since the last push.")
+@click.option('--checkpoint', type=click.Path(dir_okay=False), help='Where to keep progress (default DATA_DIR/batch-sync.sqlite3).')
+def sync_command(workers, processes, restart, incremental, checkpoint):
+	"""
+	Push every Shopify product that's linked to an eBay SKU to eBay, as the background account
+	(EBAY_BACKGROUND_ACCOUNT). If a run is interrupted, running this again picks up where it stopped (and retries
+	the products that failed, up to batch_sync.MAX_ATTEMPTS times each).
+	"""
+	def progress(done, total):
+		if done % 100 == 0 or done == total:
+			click.echo('{}/{} products'.format(done, total), err=True)
+	try:
+		summary = batch_sync.run(workers=workers, processes=processes, restart=restart, incremental=incremental,
+			checkpoint_file=checkpoint, progress=progress)
+	except glitchlab_shopify.AuthenticationError as e:
+		raise click.ClickException(e.message)
+	click.echo(json.dumps(summary, indent=2))
+
 @app.route('/api/ebay/product', methods=['GET','POST'])
 @crossdomain('http://ui.ebay-sync.slirp.aaronbeekay.info')
 #@crossdomain(origin='https://clever-hare-1.glitch.me')
-def ebay_product_endpoint():
+async def ebay_product_endpoint():
 	"""
 	Get an eBay inventory item by its SKU (GET), or update an existing item with new attributes (POST).
+	
+	Async, so the eBay calls one load or save needs go out together, on the upstream event loop (see
+	glitchlab_async.py and aioupstream.py).
 	"""
 	if request.method == 'GET':
-		
-		return get_ebay_product( request.args.get('sku') )
+		return await aioupstream.call( get_ebay_product( aioupstream.ebay_async_client(), request.args.get('sku') ) )
 		
 	elif request.method == 'POST':
 		if 'sku' not in request.args:
@@ -402,123 +688,290 @@ def ebay_product_endpoint():
 			logger.info('Bad request body sent to /api/ebay/product endpoint. Error: {}'.format(str(e)))
 			logger.debug('Request body in question was {}'.format(request.text))
 			return jsonify({"error": "Non-JSON request body"}), 400
+		
+		# By default we merge against the copy of each eBay object the UI just loaded. ?revalidate=1 fetches them again.
+		revalidate = request.args.get('revalidate', '').lower() in ('1', 'true', 'yes')
+		
+		sku = request.args.get('sku')
+		skus = ebay_save_skus( sku, epNew )
+		if skus is None:
+			return jsonify({"error": "Missing `_gl_ebay_type` parameter, don't know what to do"}), 400
+		account = ebay_tokens.current_account()
+		if account is None:
+			return jsonify({"error": "Not signed in to eBay"}), 403
+		
+		# ?wait=1 saves inside the request, like before saves were queued
+		if request.args.get('wait', '').lower() in ('1', 'true', 'yes'):
+			reply, status = await aioupstream.call( save_ebay_product( aioupstream.ebay_async_client(), sku, epNew, revalidate ) )
+			return jsonify(reply), status
+		
+		# A group save can be dozens of eBay calls - too long to hold a worker for - so hand it to the job queue
+		job_id = jobs.get_queue().enqueue( EBAY_SAVE_JOB, {
+				'sku': sku,
+				'product': epNew,
+				'revalidate': revalidate,
+				'account': account }, skus=skus )
+		status_url = url_for('job_endpoint', job_id=job_id, _external=True)	# the UI is on another origin
+		logger.debug("Queued save of eBay SKU {} as job {}".format(sku, job_id))
+		return jsonify({"Status": "Queued", "job_id": job_id, "status_url": status_url}), 202, {'Location': status_url}
+
+"""Job kind for queued /api/ebay/product saves"""
+EBAY_SAVE_JOB = 'ebay_product_save'
+
+def ebay_save_skus(sku, epNew):
+	"""The SKUs saving `epNew` to eBay SKU `sku` will write, for the job's progress list. None if `epNew` has no known type."""
+	if epNew.get('_gl_ebay_type') == 'inventoryitem':
+		return [sku]
+	elif epNew.get('_gl_ebay_type') == 'inventoryitemgroup':
+		return list(epNew.get('variants', {})) + [sku]
+	return None
+
+async def save_ebay_product(ebay, sku, epNew, revalidate=False, progress=None):
+	"""
+	Write `epNew` (an item or group, as the UI sends it to POST /api/ebay/product) to eBay SKU `sku`. Returns the
+	reply for the UI and its HTTP status. `progress(sku, status, error=None)` is told how each SKU went.
+	"""
+	if progress is None:
+		progress = lambda *args, **kwargs: None
+	
+	if epNew['_gl_ebay_type'] == 'inventoryitem':
+		try:
+			# Offers are written separately, after the item
+			offers = epNew.pop('offers', [])
 			
-		if epNew['_gl_ebay_type'] == 'inventoryitem':
-			try:
-				newoffers = copy.deepcopy(epNew)
-				
-				if 'offers' in epNew:
-					del epNew['offers']
-				
-				# Update product first
-				logger.debug( "Updating eBay SKU {} - got new attributes {}".format(request.args.get('sku'), epNew))
-				glitchlab_shopify.set_ebay_attributes( request.args.get('sku'), epNew )
+			# Update product first
+			logger.debug( "Updating eBay SKU {} - got new attributes {}".format(sku, epNew))
+			await glitchlab_async.set_ebay_attributes( ebay, sku, epNew, revalidate=revalidate )
 			
-				if 'offers' in newoffers and len(newoffers['offers']) > 0:
-					# We need to update each of the associated offers too
-					for offer in newoffers['offers']:
-						glitchlab_shopify.update_ebay_offer( offer['offerId'], offer )
+			if len(offers) > 0:
+				# We need to update each of the associated offers too. They don't depend on each other, so
+				# 	send them all at once
+				offerResults = await glitchlab_async.update_ebay_offers( ebay, offers, revalidate )
+				if any( r['error'] == 'ebay_auth_invalid' for r in offerResults ):
+					progress( sku, jobs.STATUS_FAILED, "eBay authentication failed" )
+					return {"error": "eBay authentication failed", "offers": offerResults}, 403
+				failed = [r['offerId'] for r in offerResults if not r['ok']]
+				if len(failed) > 0:
+					progress( sku, jobs.STATUS_FAILED, "Failed to update offers: {}".format(', '.join(failed)) )
+					return {"error": "Failed to update offers: {}".format(', '.join(failed)), "offers": offerResults}, 207
+				progress( sku, jobs.STATUS_DONE )
+				return {"Status": "OK", "offers": offerResults}, 200
 			
-				return jsonify({"Status": "OK"}), 200
+			progress( sku, jobs.STATUS_DONE )
+			return {"Status": "OK"}, 200
 		
-			except glitchlab_shopify.AuthenticationError as e:
-				return jsonify({"error": e.message}), 403
-			except glitchlab_shopify.ItemNotFoundError as e:
-				return jsonify({"error": "Item not found: {}".format(e.message)}), 404
-			except RuntimeError as e:
-				return jsonify({"error": str(e) }), 500
-				
-		elif epNew['_gl_ebay_type'] == 'inventoryitemgroup':
+		except glitchlab_shopify.AuthenticationError as e:
+			progress( sku, jobs.STATUS_FAILED, e.message )
+			return {"error": e.message}, 403
+		except glitchlab_shopify.ItemNotFoundError as e:
+			progress( sku, jobs.STATUS_FAILED, e.message )
+			return {"error": "Item not found: {}".format(e.message)}, 404
+		except RuntimeError as e:
+			progress( sku, jobs.STATUS_FAILED, str(e) )
+			return {"error": str(e) }, 500
+			
+	elif epNew['_gl_ebay_type'] == 'inventoryitemgroup':
+	
+		# First update all of the member products, in bulk
+		logger.debug("Now updating each of the children of the inventoryItemGroup...")
+		try:
+			variantResults = await glitchlab_async.set_ebay_attributes_bulk( ebay, epNew['variants'], revalidate=revalidate )
+		except glitchlab_shopify.AuthenticationError as e:
+			progress( sku, jobs.STATUS_FAILED, e.message )
+			return {"error": e.message}, 403
+		except RuntimeError as e:
+			progress( sku, jobs.STATUS_FAILED, str(e) )
+			return {"error": str(e)}, 500
 		
-			# Hard-coded because I hate my future self: build a list of all the conditions that are present
-			# 	in the variants, so that we can update the inventoryItemGroup later
-			variantConditions = []
+		for variant_sku, r in variantResults.items():
+			if r['ok']:
+				progress( variant_sku, jobs.STATUS_DONE )
+			else:
+				progress( variant_sku, jobs.STATUS_FAILED, '; '.join(e.get('message', '') for e in r['errors']) or None )
+		
+		# Leave the inventoryItemGroup alone unless every variant made it
+		failed = [variant_sku for variant_sku, r in variantResults.items() if not r['ok']]
+		if len(failed) > 0:
+			logger.warning("eBay didn't update variant SKUs {}, not updating the inventoryItemGroup".format(failed))
+			progress( sku, jobs.STATUS_FAILED, "Not updated, because some variants failed" )
+			return {"error": "Failed to update variant SKUs: {}".format(', '.join(failed)), "variants": variantResults}, 207
 				
-			# First go through and update each of the member products
-			logger.debug("Now updating each of the children of the inventoryItemGroup...")
-			for sku, inventoryItem in epNew['variants'].items():
-				try:
-					variantConditions.append( inventoryItem['condition'] )
-					glitchlab_shopify.set_ebay_attributes( sku, inventoryItem )
-				except glitchlab_shopify.AuthenticationError as e:
-					return jsonify({"error": e.message}), 403
-				except glitchlab_shopify.ItemNotFoundError as e:
-					return jsonify({"error": "Item not found: {}".format(e.message)}), 404
-				except RuntimeError as e:
-					return jsonify({"error": str(e)}), 500
-					
-			# Update inventoryItemGroup second
-			try:
-				# Make a list of the conditions represented, update the inventoryItemGroup with these conditions
-				epNew['variesBy'] = {"specifications": [{"name": "Condition", "values": variantConditions}]}
-				glitchlab_shopify.set_ebay_inventoryitemgroup( request.args.get('sku'), epNew )
-			except glitchlab_shopify.AuthenticationError as e:
-				return jsonify({"error": e.message}), 403
-			except glitchlab_shopify.ItemNotFoundError as e:
-				return jsonify({"error": "Item not found: {}".format(e.message)}), 404
-			except RuntimeError as e:
-				return jsonify({"error": str(e)}), 500
-			
-			return jsonify({"Status": "OK"}), 200
+		# Update inventoryItemGroup second
+		try:
+			# The group varies by whatever the mapping says (the variants' conditions), worked out from the variants
+			varies_by = mapping.get_mapping().varies_by( list(epNew['variants'].values()) )
+			if varies_by is not None:
+				epNew['variesBy'] = varies_by
+			await glitchlab_async.set_ebay_inventoryitemgroup( ebay, sku, epNew, revalidate=revalidate )
+		except glitchlab_shopify.AuthenticationError as e:
+			progress( sku, jobs.STATUS_FAILED, e.message )
+			return {"error": e.message}, 403
+		except glitchlab_shopify.ItemNotFoundError as e:
+			progress( sku, jobs.STATUS_FAILED, e.message )
+			return {"error": "Item not found: {}".format(e.message)}, 404
+		except RuntimeError as e:
+			progress( sku, jobs.STATUS_FAILED, str(e) )
+			return {"error": str(e)}, 500
 		
-		else:
-			return jsonify({"error": "Missing `_gl_ebay_type` parameter, don't know what to do"}), 400
+		progress( sku, jobs.STATUS_DONE )
+		return {"Status": "OK", "variants": variantResults}, 200
+
+def run_ebay_save_job(payload, progress):
+	"""Job handler for queued saves: `save_ebay_product()` as the user who queued it."""
+	with ebay_tokens.acting_as( payload['account'] ):
+		reply, status = aioupstream.run( save_ebay_product(
+			aioupstream.ebay_async_client(), payload['sku'], payload['product'], payload['revalidate'], progress ) )
+	if status >= 300:
+		raise jobs.JobFailed( reply.get('error'), reply )
+	return reply
+
+jobs.register( EBAY_SAVE_JOB, run_ebay_save_job )
+
+@app.before_request
+def start_job_workers():
+	"""
+	Start this worker's job threads and price/quantity flusher on its first request, so jobs and updates left
+	queued by a restart get picked up.
+	"""
+	jobs.get_queue()
+	price_quantity.get_queue()
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@crossdomain('http://ui.ebay-sync.slirp.aaronbeekay.info')
+def job_endpoint(job_id):
+	"""How a queued job is doing: its status, and the status (and error, if any) of each SKU it touches."""
+	job = jobs.get_queue().get(job_id)
+	if job is None:
+		return jsonify({'error': 'job_not_found', 'message': 'No job {}'.format(job_id)}), 404
+	return jsonify(job)
+
+@app.route('/api/ebay/price-quantity', methods=['POST'])
+@crossdomain('http://ui.ebay-sync.slirp.aaronbeekay.info')
+def ebay_price_quantity_endpoint():
+	"""
+	Queue stock and/or price changes for eBay SKUs, without touching anything else about the items. The body is a
+	list of {"sku", "quantity", "price", "currency"}, leaving out what isn't changing. They're sent to eBay within
+	EBAY_PRICE_QUANTITY_WINDOW seconds (see price_quantity.py).
+	"""
+	queue = price_quantity.get_queue()
+	if queue.window <= 0:
+		return jsonify({'error': 'Price/quantity updates are turned off (EBAY_PRICE_QUANTITY_WINDOW is 0)'}), 503
+	if ebay_tokens.current_account() is None:
+		return jsonify({'error': 'Not signed in to eBay'}), 403
+
+	updates = request.get_json(silent=True)
+	if not isinstance(updates, list):
+		return jsonify({'error': 'Expected a list of {"sku", "quantity", "price"} objects'}), 400
+	checked = []
+	for u in updates:
+		try:
+			price = '{:.2f}'.format(float(u['price'])) if u.get('price') is not None else None
+			quantity = max(int(u['quantity']), 0) if u.get('quantity') is not None else None
+			sku = u['sku']
+		except (TypeError, ValueError, KeyError, AttributeError):
+			return jsonify({'error': 'Bad update: {}'.format(json.dumps(u))}), 400
+		if price is None and quantity is None:
+			return jsonify({'error': 'Update for SKU {} has no price or quantity'.format(sku)}), 400
+		checked.append( (sku, price, u.get('currency', 'USD') if price is not None else None, quantity) )
+
+	for sku, price, currency, quantity in checked:
+		queue.put( sku, price=price, currency=currency, quantity=quantity, account=ebay_tokens.current_account() )
+	return jsonify({'Status': 'Queued', 'skus': len(checked), 'window': queue.window}), 202
 				
-			
-def get_ebay_product(sku):
+async def get_ebay_product(ebay, sku):
 	"""Retrieve an item"""
 	if sku is None:
 		logger.info("This request doesn't have a sku attached to it")
 		return 'Try again with a "sku" parameter'
 	
-	if 'access_token' not in session or session.get('access_token_expiry') < datetime.datetime.utcnow():
+	try:
+		auth_token = glitchlab_shopify.ebay_auth_token()
+	except glitchlab_shopify.AuthenticationError as e:
 		# The client side will need to handle logging back in
-		return jsonify({'error': 'ebay_auth_invalid'}), 403
+		return jsonify({'error': 'ebay_auth_invalid', 'message': e.message}), 403
+	
+	# Serve it from the local eBay mirror if that's up to date
+	p = ebay_mirror.get_mirror().product(sku)
+	if p is not None:
+		logger.debug("Serving eBay SKU {} from the mirror".format(sku))
+		return jsonify(p)
 	
+	# If we've seen this SKU before, go straight to the right API instead of probing getInventoryItem first
+	index = sku_index.get_sku_index()
+	known_type = index.lookup(sku)
 	try:
-		# Get the product details from the InventoryItem API
-		inventory_item = glitchlab_shopify.get_ebay_product( session['access_token'], request.args.get('sku') )
+		if known_type == sku_index.UNKNOWN:
+			logger.debug("eBay recently had no item or inventoryItemGroup for SKU {}, not asking again".format(sku))
+			return jsonify({'error': 'ebay_item_not_found', 'message': 'No eBay item or inventoryItemGroup with SKU {}'.format(sku)}), 404
 		
-		# Get any associated Offers and merge them into the response
-		offers = glitchlab_shopify.get_ebay_offers( request.args.get('sku')  )
-		inventory_item['offers'] = offers
-		
-		# If we got this far, this is a single-variant InventoryItem, not an InventoryItemGroup
-		inventory_item['_gl_ebay_type'] = 'inventoryitem'
+		if known_type == sku_index.INVENTORY_ITEM_GROUP:
+			try:
+				return await get_ebay_inventoryitemgroup_response(ebay, auth_token, sku)
+			except glitchlab_shopify.ItemNotFoundError:
+				logger.debug("SKU {} used to be an inventoryItemGroup, but isn't any more".format(sku))
+				index.forget(sku)
 		
-		return jsonify(inventory_item)
+		return await get_ebay_inventoryitem_response(ebay, auth_token, sku)
 	except glitchlab_shopify.AuthenticationError as e:
 		return jsonify({'error': 'ebay_auth_invalid', 'message': e.message}), 403
-		
-	except glitchlab_shopify.ItemNotFoundError as e:
+	
+async def get_ebay_inventoryitem_response(ebay, auth_token, sku):
+	"""The /api/ebay/product reply for `sku`, probing for an InventoryItem first and then an InventoryItemGroup."""
+	# The item and its offers don't depend on each other, so ask for both at once. If it turns out not to be an
+	# 	item, the offers call is thrown away.
+	item_result, offers_result = await asyncio.gather(
+		glitchlab_async.get_ebay_product( ebay, auth_token, sku ),
+		glitchlab_async.get_ebay_offers( ebay, auth_token, sku ),
+		return_exceptions=True )
+	
+	if isinstance(item_result, glitchlab_shopify.ItemNotFoundError):
 		"""
 		Check if this is an InventoryItemGroup - eBay will return item not found if you search for 
 			an inventoryItemGroup SKU using getInventoryItem().
 		"""
 		try:
-			logger.debug("eBay returned 404 for SKU {} using getInventoryItem(), checking if it is an inventoryItemGroup...".format(request.args.get('sku')))
-			inventory_item_group = glitchlab_shopify.get_ebay_inventoryitemgroup( session['access_token'], request.args.get('sku') )
-			
-			# If we got a good response and there are variant SKUs in the InventoryItemGroup, fetch the details for those as well...
-			if 'variantSKUs' in inventory_item_group:
-				inventory_item_group['variants'] = {}
-				for vsku in inventory_item_group['variantSKUs']:
-					v = glitchlab_shopify.get_ebay_product( session['access_token'], vsku )
-					if 'sku' in v:
-						inventory_item_group['variants'][v['sku']] = v
-					else:
-						logger.warning("eBay sent us a variant that doesn't seem to have a SKU attribute... expected SKU {}, not adding it to the inventoryItemGroup.".format(vsku))
-			
-			# Signal that this is an inventoryItemGroup
-			inventory_item_group['_gl_ebay_type'] = 'inventoryitemgroup'
-			
-			# Include the SKU for helpfulness
-			inventory_item_group['sku'] = sku
-			
-			return jsonify(inventory_item_group)
+			logger.debug("eBay returned 404 for SKU {} using getInventoryItem(), checking if it is an inventoryItemGroup...".format(sku))
+			return await get_ebay_inventoryitemgroup_response(ebay, auth_token, sku)
 				
 		except glitchlab_shopify.ItemNotFoundError as e:
+			sku_index.get_sku_index().learn( sku, sku_index.UNKNOWN )
 			return jsonify({'error': 'ebay_item_not_found', 'message': e.message}), 404
+	
+	for result in (item_result, offers_result):
+		if isinstance(result, Exception):
+			raise result
+	
+	# Merge the associated Offers into the response
+	inventory_item = dict(item_result)
+	inventory_item['offers'] = offers_result
+	
+	# If we got this far, this is a single-variant InventoryItem, not an InventoryItemGroup
+	inventory_item['_gl_ebay_type'] = 'inventoryitem'
+	
+	return jsonify(inventory_item)
+
+async def get_ebay_inventoryitemgroup_response(ebay, auth_token, sku):
+	"""The /api/ebay/product reply for the InventoryItemGroup `sku`, with all its variants. Raises ItemNotFoundError."""
+	inventory_item_group = dict( await glitchlab_async.get_ebay_inventoryitemgroup( ebay, auth_token, sku ) )
+	
+	# If we got a good response and there are variant SKUs in the InventoryItemGroup, fetch the details for those as well...
+	if 'variantSKUs' in inventory_item_group:
+		inventory_item_group['variants'] = {}
+		variants = await glitchlab_async.get_ebay_products( ebay, auth_token, inventory_item_group['variantSKUs'] )
+		for vsku in inventory_item_group['variantSKUs']:
+			v = variants.get(vsku)
+			if v is not None and 'sku' in v:
+				inventory_item_group['variants'][v['sku']] = v
+			else:
+				logger.warning("eBay didn't send us variant SKU {}, not adding it to the inventoryItemGroup.".format(vsku))
+	
+	# Signal that this is an inventoryItemGroup
+	inventory_item_group['_gl_ebay_type'] = 'inventoryitemgroup'
+	
+	# Include the SKU for helpfulness
+	inventory_item_group['sku'] = sku
+	
+	return jsonify(inventory_item_group)
 
 # Serve static files using send_from_directory()	
 @app.route('/<path:file>')
@@ -535,7 +988,8 @@ def index():
 def get_access_token(auth_code):
 	"""
 	Given an authorization code provided by eBay (`auth_code`), ping eBay and exchange it
-		for a user access token. Set the session params accordingly.
+		for a user access token. The tokens go in the token manager (see ebay_tokens.py); the session only
+		keeps the ID of the account they're stored under.
 	"""
 	
 	# Build request body
@@ -544,48 +998,17 @@ def get_access_token(auth_code):
 		'code': auth_code,
 		'redirect_uri': app.config['EBAY_APP_RUNAME']
 	}
-	response = requests.post(
-		app.config['EBAY_OAUTH_TOKEN_ENDPOINT'],
-		data=body,
-		auth=(app.config['EBAY_OAUTH_CLIENT_ID'],app.config['EBAY_OAUTH_CLIENT_SECRET'])
-	)
-	authDict = response.json()
-	
-	if 'access_token' not in authDict:
-		logger.error('No access token in eBay response when we tried to get one. Probably bad creds somewhere. eBay says: {}'.format(json.dumps(response.json())))
-		raise glitchlab_shopify.AuthenticationError('No access token in response from eBay. Probably some kind of fucking stupid auth problem.')
+	try:
+		authDict = ebay_tokens.request_token(body)
+	except ebay_tokens.TokenError as e:
+		raise glitchlab_shopify.AuthenticationError(e.message)
 		
-	# Set session params
-	session['access_token'] = authDict['access_token']
-	session['access_token_expiry'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=authDict['expires_in'])
-	session['refresh_token'] = authDict['refresh_token']	
+	# Store the tokens, and remember whose they are
+	session['ebay_account'] = ebay_tokens.get_manager().save( authDict, account=session.get('ebay_account') )
+	for k in ('access_token', 'access_token_expiry', 'refresh_token'):
+		session.pop(k, None)
 		
 	return authDict
-
-def refresh_access_token(refresh_token):
-	"""Go to eBay and get a new access token from the refresh token we already have"""
-	# Build request body
-	body = {
-		'grant_type': 'refresh_token',
-		'refresh_token': refresh_token,
-		'scope': app.config['EBAY_SCOPES']
-	}
-	response = requests.post(
-		app.config['EBAY_OAUTH_TOKEN_ENDPOINT'],
-		data=body,
-		auth=(app.config['EBAY_OAUTH_CLIENT_ID'],app.config['EBAY_OAUTH_CLIENT_SECRET'])
-	)
-	authDict = response.json()
-	
-	if 'access_token' not in authDict:
-		logger.error('No access token in eBay response when we tried to get one. Probably bad creds somewhere. eBay says: {}'.format(json.dumps(response.json())))
-		raise glitchlab_shopify.AuthenticationError('No access token in response from eBay. Probably some kind of fucking stupid auth problem.')
-	
-	# Set session params
-	session['access_token'] = authDict['access_token']
-	session['access_token_expiry'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=authDict['expires_in'])
-	
-	return authDict
 	
 """Exceptions"""
 # class InvalidRequest(Exception):
@@ -0,0 +1,52 @@
+import os
+import logging
+import threading
+import pystache
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.templates')
+logger.setLevel(logging.DEBUG)
+
+class TemplateRegistry(object):
+	"""
+	Parsed mustache templates, kept in memory.
+
+	Each template file is read and parsed the first time it's used, then reused until the file's mtime changes,
+	so editing a template on disk still takes effect without a restart. Rendering from the parsed form skips both
+	the file read and the parse.
+	"""
+
+	def __init__(self):
+		self._templates = {}		# path => (mtime, parsed template)
+		self._lock = threading.Lock()
+		self._renderer = pystache.Renderer()
+		self.loads = 0
+
+	def get(self, path):
+		"""Return the parsed template at `path`, re-reading it only if the file changed since we last parsed it."""
+		mtime = os.path.getmtime(path)
+		with self._lock:
+			cached = self._templates.get(path)
+			if cached is not None and cached[0] == mtime:
+				return cached[1]
+
+		with open(path) as f:
+			parsed = pystache.parse( f.read() )
+		logger.debug('Parsed template {}'.format(path))
+		with self._lock:
+			self._templates[path] = (mtime, parsed)
+			self.loads += 1
+		return parsed
+
+	def render(self, path, context):
+		"""Render the template at `path` with the dict `context`."""
+		return self._renderer.render( self.get(path), context )
+
+	def render_many(self, path, contexts):
+		"""Render the template at `path` once for each dict in `contexts`. Checks the file only once for the whole batch."""
+		parsed = self.get(path)
+		return [self._renderer.render(parsed, c) for c in contexts]
+
+"""Shared by the whole process"""
+registry = TemplateRegistry()
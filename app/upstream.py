@@ -0,0 +1,165 @@
+import os
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app as app
+
+from ratelimit import ShopifyRateLimit, EbayRateLimit
+
+
+"""Logging setup"""
+logger = logging.getLogger('io.glitchlab.upstream')
+logger.setLevel(logging.DEBUG)
+
+class BearerAuth(requests.auth.AuthBase):
+	"""Attach an OAuth bearer token (eBay user access token) to a request."""
+
+	def __init__(self, token):
+		self.token = token
+
+	def __call__(self, r):
+		r.headers['Authorization'] = 'Bearer {}'.format(self.token)
+		return r
+
+class UpstreamClient(object):
+	"""
+	A keep-alive HTTP client for one upstream service (Shopify or eBay).
+
+	Wraps a single `requests.Session`, so TCP+TLS connections to the upstream's hosts are opened once and then
+	reused by every call in this process. `pool_size` is the most connections kept open per host, and should be
+	at least the number of requests this process can have in flight at once (gunicorn threads, fan-out workers).
+
+	`headers` and `auth` become the defaults for every request made through the client; anything passed to
+	`request()` overrides them for that call.
+
+	If a `limiter` is given (see ratelimit.py), every request waits for room under the upstream's rate limit
+	first, and a throttled request is retried up to `max_retries` times.
+	"""
+
+	def __init__(self, name, pool_size=10, headers=None, auth=None, limiter=None, max_retries=3):
+		self.name = name
+		self.pool_size = pool_size
+		self.session = requests.Session()
+		self.adapter = HTTPAdapter( pool_connections=4, pool_maxsize=pool_size )
+		self.session.mount('https://', self.adapter)
+		self.session.mount('http://', self.adapter)
+		if headers is not None:
+			self.session.headers.update(headers)
+		self.session.auth = auth
+		self.limiter = limiter
+		self.max_retries = max_retries
+		self.requests_sent = 0
+		self.throttled = 0
+		self._lock = threading.Lock()
+
+	def request(self, method, url, auth_token=None, cost=None, **kwargs):
+		"""
+		Send a request through the pooled session. Takes the same arguments as `requests.request()`.
+
+		If `auth_token` is given, it's sent as an OAuth bearer token (`Authorization: Bearer ...`). `cost` is how
+		much of the rate limit the request will use, if that isn't 1 (e.g. a GraphQL query's estimated cost).
+		"""
+		if auth_token is not None:
+			kwargs['auth'] = BearerAuth(auth_token)
+
+		attempt = 0
+		while True:
+			if self.limiter is not None:
+				self.limiter.before(method, url, cost=cost)
+			with self._lock:
+				self.requests_sent += 1
+			response = self.session.request(method, url, **kwargs)
+			if self.limiter is None or not self.limiter.after(response):
+				return response
+
+			with self._lock:
+				self.throttled += 1
+			attempt += 1
+			if attempt > self.max_retries:
+				logger.warning('{} still throttling {} {} after {} retries, giving up'.format(self.name, method, url, self.max_retries))
+				return response
+			logger.info('{} throttled {} {}, retrying ({}/{})'.format(self.name, method, url, attempt, self.max_retries))
+
+	def get(self, url, **kwargs):
+		return self.request('GET', url, **kwargs)
+
+	def put(self, url, **kwargs):
+		return self.request('PUT', url, **kwargs)
+
+	def post(self, url, **kwargs):
+		return self.request('POST', url, **kwargs)
+
+	def delete(self, url, **kwargs):
+		return self.request('DELETE', url, **kwargs)
+
+	def stats(self):
+		"""
+		Return a dict of request and connection counts for this client.
+
+		`connections_opened` counts new TCP connections, so it should stay close to the number of requests that
+		were in flight at the same time - if it tracks `requests_sent` instead, connections aren't being reused.
+		"""
+		hosts = {}
+		pools = self.adapter.poolmanager.pools
+		for key in pools.keys():
+			pool = pools.get(key)
+			if pool is None:
+				continue
+			hosts[pool.host] = {
+				'connections_opened': pool.num_connections,
+				'requests': pool.num_requests,
+				'idle_connections': pool.pool.qsize() if pool.pool is not None else 0
+				}
+		return {
+			'name': self.name,
+			'pool_size': self.pool_size,
+			'requests_sent': self.requests_sent,
+			'throttled': self.throttled,
+			'connections_opened': sum(h['connections_opened'] for h in hosts.values()),
+			'hosts': hosts,
+			'rate_limits': self.limiter.stats() if self.limiter is not None else None
+			}
+
+"""One client per upstream, per process. Created on first use so that each gunicorn worker gets its own sockets."""
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _get_client(name, factory):
+	with _clients_lock:
+		if name not in _clients:
+			_clients[name] = factory()
+			logger.debug('Created {} upstream client with pool size {}'.format(name, _clients[name].pool_size))
+		return _clients[name]
+
+def ratelimit_path():
+	"""The rate limiter state is shared by every worker through this file."""
+	return os.path.join(app.config['DATA_DIR'], 'ratelimit.sqlite3')
+
+def shopify_client():
+	"""The pooled client for the Shopify Admin API. Authenticates with the private app key/password by default."""
+	return _get_client('shopify', lambda: UpstreamClient(
+		'shopify',
+		pool_size=app.config.get('UPSTREAM_POOL_SIZE', 10),
+		headers={'Accept': 'application/json'},
+		auth=(app.config['SHOPIFY_API_KEY'], app.config['SHOPIFY_API_PW']),
+		limiter=ShopifyRateLimit( ratelimit_path(), headroom=app.config.get('SHOPIFY_RATE_LIMIT_HEADROOM', 2) )
+		))
+
+def ebay_client():
+	"""The pooled client for the eBay APIs. Pass `auth_token=` to a request to send the user's bearer token."""
+	return _get_client('ebay', lambda: UpstreamClient(
+		'ebay',
+		pool_size=app.config.get('UPSTREAM_POOL_SIZE', 10),
+		headers={'Accept': 'application/json', 'Content-Language': 'en-US'},
+		limiter=EbayRateLimit(
+			ratelimit_path(),
+			per_second=app.config.get('EBAY_RATE_LIMIT_PER_SEC', 5),
+			burst=app.config.get('EBAY_RATE_LIMIT_BURST', 10)	)
+		))
+
+def all_stats():
+	"""Stats for every upstream client created so far in this process."""
+	with _clients_lock:
+		clients = list(_clients.values())
+	return {c.name: c.stats() for c in clients}
@@ -0,0 +1,84 @@
+"""
+Shopify->eBay mapping throughput, in products per second.
+
+"Hand-written" is how the catalog sync mapped a product before the mapping spec: a dict built by hand, with the
+item template rendered through `render_product_template()` one product at a time. "Compiled" is
+`mapping.compile_mapping(DEFAULT_MAPPING).transform()` on batches of products. It maps more fields (condition,
+aspects and quantity as well), so "item + group" - what the catalog sync asks for - is doing more work per
+product than the hand-written version, and "everything" adds the per-variant items and offers.
+
+Run from the repo root:
+
+	python bench/bench_mapping.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import glitchlab_shopify
+import mapping
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'static')
+CONDITIONS = ['New', 'Pre-Owned', 'For Parts']
+
+
+def make_product(pid, variants=1, description_kb=4):
+	"""A Shopify product dict like `get_shopify_product()['product']`."""
+	return {
+		'id': pid,
+		'title': 'Widget {}'.format(pid),
+		'body_html': '<p>' + ('Lorem ipsum dolor sit amet. ' * (description_kb * 1024 // 28)) + '</p>',
+		'options': [{'name': 'Condition', 'position': 1, 'values': CONDITIONS[:variants]}],
+		'metafields': {'Manufacturer': 'Glitchlab', 'MPN': 'MPN-{}'.format(pid), 'ebay_sku': 'SKU-{}'.format(pid)},
+		'variants': {
+			pid * 10 + i: {
+				'id': pid * 10 + i,
+				'option1': CONDITIONS[i % len(CONDITIONS)],
+				'price': '{}.99'.format(10 + i),
+				'inventory_quantity': i,
+				'sku': 'SKU-{}-{}'.format(pid, i),
+				'metafields': {}
+				}
+			for i in range(variants) }
+		}
+
+def hand_written(product):
+	"""What batch_sync.ebay_attributes() used to do."""
+	metafields = product.get('metafields', {})
+	p = {
+		'title': product.get('title'),
+		'description': glitchlab_shopify.render_product_template(
+			os.path.join(TEMPLATE_DIR, 'item-template.html'), product ),
+		'brand': metafields.get('Manufacturer'),
+		'mpn': metafields.get('MPN')
+		}
+	return {'product': {k: v for k, v in p.items() if v is not None}}
+
+def rate(fn, products, batch):
+	"""Products per second for fn(list of products), fed `batch` products at a time."""
+	fn(products[:batch])		# warm up: parse the template
+	t = time.perf_counter()
+	for i in range(0, len(products), batch):
+		fn(products[i:i + batch])
+	return len(products) / (time.perf_counter() - t)
+
+def main():
+	compiled = mapping.compile_mapping(mapping.DEFAULT_MAPPING)
+	sync_kinds = lambda products: compiled.transform(products, kinds=('item', 'group'), template_dir=TEMPLATE_DIR)
+	everything = lambda products: compiled.transform(products, template_dir=TEMPLATE_DIR)
+	by_hand = lambda products: [hand_written(p) for p in products]
+
+	print('{:<52} {:>14}'.format('mapping', 'products/s'))
+	for variants in (1, 3):
+		products = [make_product(pid, variants=variants) for pid in range(2000)]
+		for name, fn, batch in [
+				('hand-written, one at a time', by_hand, 1),
+				('compiled item + group, one at a time', sync_kinds, 1),
+				('compiled item + group, batches of 100', sync_kinds, 100),
+				('compiled everything, batches of 100', everything, 100)	]:
+			label = '{} ({} variant{})'.format(name, variants, '' if variants == 1 else 's')
+			print('{:<52} {:>14.0f}'.format(label, rate(fn, products, batch)))
+
+if __name__ == '__main__':
+	main()
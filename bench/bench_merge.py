@@ -0,0 +1,150 @@
+"""
+Memory and time per eBay save, before and after the copy-free merge.
+
+"Before" is the old save path: deep copies of the request body, the cached eBay objects and the group
+attributes, then the old in-place recursive merge. "After" is what the endpoint does now: `merge()` straight
+from the cached objects, sharing every subtree that didn't change.
+
+Run from the repo root:
+
+	python bench/bench_merge.py
+"""
+import os
+import sys
+import copy
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from glitchlab_shopify import merge
+
+
+def legacy_merge(a, b, path=None, update=True):
+	"""The merge() we had before: recursive, changes a in place."""
+	if path is None: path = []
+	for key in b:
+		if key in a:
+			if isinstance(a[key], dict) and isinstance(b[key], dict):
+				legacy_merge(a[key], b[key], path + [str(key)])
+			elif a[key] == b[key]:
+				pass # same leaf value
+			elif isinstance(a[key], list) and isinstance(b[key], list):
+				for idx, val in enumerate(b[key]):
+					a[key][idx] = legacy_merge(a[key][idx], b[key][idx], path + [str(key), str(idx)], update=update)
+			elif update:
+				a[key] = b[key]
+			else:
+				raise RuntimeError('Dictionary merge conflict at %s' % '.'.join(path + [str(key)]))
+		else:
+			a[key] = b[key]
+	return a
+
+def make_item(sku, description_kb=30, images=24, aspects=30):
+	"""An eBay inventory item about the size of a real listing: long HTML description, lots of images and aspects."""
+	return {
+		'sku': sku,
+		'locale': 'en_US',
+		'condition': 'USED_EXCELLENT',
+		'conditionDescription': 'Tested and working. ' * 20,
+		'availability': {'shipToLocationAvailability': {'quantity': 3}},
+		'packageWeightAndSize': {'weight': {'value': 2.5, 'unit': 'POUND'}},
+		'product': {
+			'title': 'Widget {}'.format(sku),
+			'description': '<p>' + ('Lorem ipsum dolor sit amet. ' * (description_kb * 1024 // 28)) + '</p>',
+			'imageUrls': ['https://i.ebayimg.com/images/g/{}/s-l1600-{}.jpg'.format(sku, i) for i in range(images)],
+			'aspects': {'Aspect {}'.format(i): ['Value {}'.format(i)] for i in range(aspects)},
+			'mpn': 'MPN-{}'.format(sku),
+			'brand': 'Glitchlab'
+			}
+		}
+
+def make_offer(offer_id, sku, description_kb=30):
+	return {
+		'offerId': offer_id,
+		'sku': sku,
+		'marketplaceId': 'EBAY_US',
+		'format': 'FIXED_PRICE',
+		'listingDescription': '<p>' + ('Lorem ipsum dolor sit amet. ' * (description_kb * 1024 // 28)) + '</p>',
+		'pricingSummary': {'price': {'value': '99.00', 'currency': 'USD'}},
+		'listingPolicies': {'fulfillmentPolicyId': '1', 'paymentPolicyId': '2', 'returnPolicyId': '3'}
+		}
+
+def edited(obj, **product):
+	"""What the UI posts back: the object it loaded, with a field or two changed."""
+	new = copy.deepcopy(obj)
+	new['product'].update(product)
+	return new
+
+def item_save_before(cached_item, cached_offers, body):
+	newoffers = copy.deepcopy(body)
+	del body['offers']
+	iNew = legacy_merge( copy.deepcopy(cached_item), body )
+	offers = [legacy_merge( copy.deepcopy(cached_offers[o['offerId']]), o ) for o in newoffers['offers']]
+	return iNew, offers
+
+def item_save_after(cached_item, cached_offers, body):
+	offers = body.pop('offers', [])
+	iNew = merge( cached_item, body )
+	return iNew, [merge( cached_offers[o['offerId']], o ) for o in offers]
+
+def group_save_before(cached_items, cached_group, body):
+	variants = {sku: legacy_merge( copy.deepcopy(cached_items[sku]), item ) for sku, item in body['variants'].items()}
+	attributes = copy.deepcopy(body)
+	del attributes['variants']
+	return variants, legacy_merge( copy.deepcopy(cached_group), attributes )
+
+def group_save_after(cached_items, cached_group, body):
+	variants = {sku: merge( cached_items[sku], item ) for sku, item in body['variants'].items()}
+	attributes = {k: v for k, v in body.items() if k != 'variants'}
+	return variants, merge( cached_group, attributes )
+
+def measure(fn, make_args, runs=20):
+	"""Return (peak KiB allocated during one call, mean ms per call)."""
+	args = make_args()
+	tracemalloc.start()
+	fn(*args)
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	elapsed = 0.0
+	for i in range(runs):
+		args = make_args()
+		t = time.perf_counter()
+		fn(*args)
+		elapsed += time.perf_counter() - t
+	return peak / 1024.0, elapsed / runs * 1000
+
+def main():
+	item = make_item('A')
+	offers = {'O{}'.format(i): make_offer('O{}'.format(i), 'A') for i in range(3)}
+	def item_args():
+		body = edited(item, title='New title')
+		body['offers'] = [dict(o, pricingSummary={'price': {'value': '89.00', 'currency': 'USD'}}) for o in offers.values()]
+		return item, offers, body
+
+	skus = ['V{}'.format(i) for i in range(40)]
+	items = {sku: make_item(sku, description_kb=10) for sku in skus}
+	group = {
+		'inventoryItemGroupKey': 'G',
+		'title': 'Widget group',
+		'description': '<p>' + ('Lorem ipsum dolor sit amet. ' * (30 * 1024 // 28)) + '</p>',
+		'imageUrls': ['https://i.ebayimg.com/images/g/G/s-l1600-{}.jpg'.format(i) for i in range(24)],
+		'variantSKUs': skus,
+		'aspects': {'Brand': ['Glitchlab']}
+		}
+	def group_args():
+		body = dict(copy.deepcopy(group), title='New group title')
+		body['variants'] = {sku: edited(items[sku], title='New {}'.format(sku)) for sku in skus}
+		return items, group, body
+
+	print('{:<34} {:>14} {:>12}'.format('save', 'peak KiB', 'ms/save'))
+	for name, fn, args in [
+			('item + 3 offers, before', item_save_before, item_args),
+			('item + 3 offers, after', item_save_after, item_args),
+			('40-variant group, before', group_save_before, group_args),
+			('40-variant group, after', group_save_after, group_args)	]:
+		kib, ms = measure(fn, args)
+		print('{:<34} {:>14.1f} {:>12.2f}'.format(name, kib, ms))
+
+if __name__ == '__main__':
+	main()
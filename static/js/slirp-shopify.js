@@ -161,9 +161,7 @@ function check_ebay_auth(){
 			if (data.ebay_auth_success === true){
 				set_ebay_login_status(login_status.ok);
 			} else {
-				if(data.error == 'ebay_auth_refreshed'){
-					check_ebay_auth();
-				} else if('ebay_consent_url' in data) {
+				if('ebay_consent_url' in data) {
 					$('a#ebay-auth-status-fail').attr('href', data.ebay_consent_url)
 					set_ebay_login_status(login_status.fail);
 				} else {
@@ -357,18 +355,97 @@ function autoresize_descriptions(){
 		);
 }
 
-/* Set or update a metafield for the Shopify product */
-function set_metafield(product_id, key, value, callback){
-	body = JSON.stringify({product_id: product_id, key: key, value: value})
+/* Metafield writes waiting to be sent, keyed by product/variant/key so a field edited twice only goes once */
+var pending_metafields = {};
+var pending_metafield_callbacks = [];		// [{product_id, callback}]
+var metafield_flush_timer = null;
+var metafield_flush_in_flight = false;		// only one batch at a time, so a product's writes can't land out of order
+const METAFIELD_FLUSH_DELAY = 300;		// ms to wait for more edits before sending them all in one request
+
+/* Set or update a metafield for the Shopify product (or one of its variants, if variant_id is given).
+ * Writes are held for METAFIELD_FLUSH_DELAY ms and sent together to /api/shopify/product-metafields, so editing
+ * a bunch of fields costs one request. `callback(data, error)` runs once the batch it went out in has been answered;
+ * `error` is null if the product's writes went through, or says why they didn't.
+ */
+function set_metafield(product_id, key, value, callback, variant_id){
+	var entry = {product_id: product_id, key: key, value: value};
+	if( variant_id !== undefined && variant_id !== null ){
+		entry.variant_id = variant_id;
+	}
+	var id = [product_id, entry.variant_id, key].join('/');
+	delete pending_metafields[id];		// re-adding it moves it to the end, so the server sees edits in order
+	pending_metafields[id] = entry;
+	if( callback ){
+		pending_metafield_callbacks.push({product_id: product_id, callback: callback});
+	}
+
+	clearTimeout(metafield_flush_timer);
+	metafield_flush_timer = setTimeout(flush_metafields, METAFIELD_FLUSH_DELAY);
+}
+
+/* Send every pending metafield write now, in one request. If a batch is still being written, the pending writes
+ * wait for it and go out as soon as it's answered.
+ */
+function flush_metafields(){
+	clearTimeout(metafield_flush_timer);
+	metafield_flush_timer = null;
+	if( metafield_flush_in_flight ){
+		return;
+	}
+	var entries = Object.values(pending_metafields);
+	var callbacks = pending_metafield_callbacks;
+	pending_metafields = {};
+	pending_metafield_callbacks = [];
+	if( entries.length == 0 ){
+		return;
+	}
+	metafield_flush_in_flight = true;
 	$.ajax({
 		method: "POST",
-		url: '/api/shopify/product-metafield',
+		url: '/api/shopify/product-metafields',
 		contentType: "application/json",
-		data: body,
-		success: callback 
+		data: JSON.stringify(entries),
+		success: function(data){
+			// 207 counts as success too, with an error for each product Shopify turned down
+			var errors = data.errors || {};
+			callbacks.forEach(function(c){
+				var error = errors[c.product_id] || null;
+				if( error ){
+					console.log('Writing metafields for product ' + c.product_id + ' failed: ' + error);
+				}
+				c.callback(data, error);
+			});
+		},
+		error: function(xhr){
+			console.log('Writing ' + entries.length + ' metafield(s) failed: ' + xhr.responseText);
+			var data = xhr.responseJSON || {};
+			callbacks.forEach(function(c){
+				// a 403 can come after some products were already written
+				if( (data.products || {})[c.product_id] ){
+					c.callback(data, null);
+					return;
+				}
+				c.callback(data, (data.errors || {})[c.product_id] || data.error || 'Request failed');
+			});
+		},
+		complete: function(){
+			metafield_flush_in_flight = false;
+			if( Object.keys(pending_metafields).length > 0 ){
+				flush_metafields();
+			}
+		}
 	});
 }
 
+/* Don't lose writes still waiting for their batch when the page goes away */
+window.addEventListener('pagehide', function(){
+	var entries = Object.values(pending_metafields);
+	if( entries.length > 0 ){
+		pending_metafields = {};
+		navigator.sendBeacon('/api/shopify/product-metafields', new Blob([JSON.stringify(entries)], {type: 'application/json'}));
+	}
+});
+
 /* Link the eBay product and the Shopify product (by writing the eBay SKU to a Shopify product metafield).
  * Won't do anything if there is no Shopify product ID or no eBay SKU entered in their <input>s.
  */
@@ -380,7 +457,8 @@ function write_ebay_sku_metafield(){
 		return;
 	}
 	set_ebay_sku_link_button_state(link_button_state.link_in_progress);
-	set_metafield(shopify_product_id, 'ebay_sku', ebay_sku, function(data){ 
+	set_metafield(shopify_product_id, 'ebay_sku', ebay_sku, function(data, error){ 
+		// Reload either way: on failure, the reload puts the link button back to how Shopify actually has it
 		loadShopifyProduct($('input#shopify-id').val());
 		loadEbayProduct($('input#ebay-sku').val());
 	});
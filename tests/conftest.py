@@ -0,0 +1,9 @@
+"""
+Tests for the modules in app/. Run from the repo root:
+
+	python -m pytest -q
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
@@ -0,0 +1,61 @@
+import pytest
+
+import batch_sync
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+	return batch_sync.Checkpoint( str(tmp_path / 'batch-sync.sqlite3') )
+
+
+def test_resumed_run_only_redoes_pending_and_failed_products(checkpoint):
+	run_id = checkpoint.start([(1, 'A'), (2, 'B'), (3, 'C'), (4, 'D'), (5, 'E')])
+	checkpoint.record(run_id, 1, batch_sync.STATUS_DONE)
+	checkpoint.record(run_id, 2, batch_sync.STATUS_FAILED, 'eBay said no')
+	checkpoint.record(run_id, 3, batch_sync.STATUS_MISSING)
+	checkpoint.record(run_id, 4, batch_sync.STATUS_UNCHANGED)
+	assert checkpoint.unfinished() == run_id
+	assert checkpoint.todo(run_id) == [(2, 'B'), (5, 'E')]
+	assert not checkpoint.finish(run_id)
+
+def test_product_that_keeps_failing_is_left_failed(checkpoint):
+	run_id = checkpoint.start([(1, 'A')])
+	for attempt in range(batch_sync.MAX_ATTEMPTS):
+		assert checkpoint.todo(run_id) == [(1, 'A')]
+		checkpoint.record(run_id, 1, batch_sync.STATUS_FAILED, 'still broken')
+	assert checkpoint.todo(run_id) == []
+	assert checkpoint.finish(run_id)
+	assert checkpoint.unfinished() is None
+	summary = checkpoint.summary(run_id)
+	assert summary[batch_sync.STATUS_FAILED] == 1
+	assert summary['errors'] == [{'product_id': 1, 'sku': 'A', 'error': 'still broken'}]
+
+def test_run_resumes_the_unfinished_run(checkpoint, monkeypatch):
+	monkeypatch.setattr(batch_sync.glitchlab_shopify, 'ebay_auth_token', lambda: 'token')
+	monkeypatch.setattr(batch_sync, 'linked_products', lambda: [(1, 'A'), (2, 'B'), (3, 'C')])
+	synced = []
+	failures = [2]		# product 2 fails once
+	def sync_product(product_id, sku, incremental=False):
+		synced.append(product_id)
+		if product_id in failures:
+			failures.remove(product_id)
+			raise RuntimeError('eBay hiccup')
+		return batch_sync.STATUS_DONE
+	monkeypatch.setattr(batch_sync, 'sync_product', sync_product)
+
+	first = batch_sync.run(workers=2, checkpoint_file=checkpoint.path)
+	assert sorted(synced) == [1, 2, 3]
+	assert first['finished_at'] is None
+	assert first[batch_sync.STATUS_FAILED] == 1
+
+	del synced[:]
+	second = batch_sync.run(workers=2, checkpoint_file=checkpoint.path)
+	assert synced == [2]
+	assert second['run_id'] == first['run_id']
+	assert second['finished_at'] is not None
+	assert second[batch_sync.STATUS_DONE] == 3
+
+	del synced[:]
+	third = batch_sync.run(workers=2, checkpoint_file=checkpoint.path)
+	assert sorted(synced) == [1, 2, 3]
+	assert third['run_id'] != first['run_id']
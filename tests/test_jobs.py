@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def queue(tmp_path):
+	return jobs.JobQueue( str(tmp_path / 'jobs.sqlite3'), lease=0.2 )
+
+
+def test_claim_takes_the_oldest_queued_job(queue):
+	first = queue.enqueue('kind', {'n': 1}, skus=['A'])
+	queue.enqueue('kind', {'n': 2})
+	row = queue.claim()
+	assert row['id'] == first
+	job = queue.get(first)
+	assert job['status'] == jobs.STATUS_RUNNING
+	assert job['attempts'] == 1
+	assert job['skus'] == {'A': {'status': jobs.STATUS_QUEUED, 'error': None}}
+
+def test_running_job_is_not_claimed_again_while_its_lease_holds(queue):
+	job_id = queue.enqueue('kind', {})
+	assert queue.claim()['id'] == job_id
+	assert queue.claim() is None
+
+def test_job_is_claimed_again_once_its_lease_runs_out(queue):
+	job_id = queue.enqueue('kind', {})
+	queue.claim()
+	time.sleep(0.3)
+	row = queue.claim()
+	assert row['id'] == job_id
+	assert queue.get(job_id)['attempts'] == 2
+
+def test_renew_and_progress_keep_the_lease(queue):
+	job_id = queue.enqueue('kind', {})
+	queue.claim()
+	for _ in range(3):
+		time.sleep(0.1)
+		queue.renew(job_id)
+	assert queue.claim() is None
+	time.sleep(0.1)
+	queue.progress(job_id, 'A', jobs.STATUS_DONE)
+	time.sleep(0.1)
+	assert queue.claim() is None
+	assert queue.get(job_id)['skus']['A']['status'] == jobs.STATUS_DONE
+
+def test_renew_does_not_revive_a_finished_job(queue):
+	job_id = queue.enqueue('kind', {})
+	queue.claim()
+	queue.finish(job_id, jobs.STATUS_DONE, {'ok': True})
+	queue.renew(job_id)
+	job = queue.get(job_id)
+	assert job['status'] == jobs.STATUS_DONE
+	assert job['result'] == {'ok': True}
+	assert queue.claim() is None
+
+def test_job_is_given_up_on_after_max_attempts(queue):
+	job_id = queue.enqueue('kind', {})
+	for attempt in range(jobs.MAX_ATTEMPTS):
+		assert queue.claim()['id'] == job_id
+		time.sleep(0.3)		# its worker died
+	assert queue.claim() is None
+	job = queue.get(job_id)
+	assert job['status'] == jobs.STATUS_FAILED
+	assert job['attempts'] == jobs.MAX_ATTEMPTS
+	assert 'Gave up' in job['error']
+
+def test_heartbeat_keeps_a_slow_job(queue):
+	claimed_meanwhile = []
+	def slow(payload, progress):
+		time.sleep(0.5)
+		claimed_meanwhile.append( queue.claim() )
+		return 'done'
+	jobs.register('test-slow', slow)
+	job_id = queue.enqueue('test-slow', {})
+	queue.run_one( queue.claim() )
+	assert claimed_meanwhile == [None]
+	job = queue.get(job_id)
+	assert job['status'] == jobs.STATUS_DONE
+	assert job['result'] == 'done'
+
+def test_failing_handler_fails_its_job(queue):
+	def fail(payload, progress):
+		progress('A', jobs.STATUS_FAILED, 'nope')
+		raise jobs.JobFailed('it broke', result={'partial': True})
+	jobs.register('test-fail', fail)
+	job_id = queue.enqueue('test-fail', {}, skus=['A'])
+	queue.run_one( queue.claim() )
+	job = queue.get(job_id)
+	assert job['status'] == jobs.STATUS_FAILED
+	assert job['error'] == 'it broke'
+	assert job['result'] == {'partial': True}
+	assert job['skus']['A'] == {'status': jobs.STATUS_FAILED, 'error': 'nope'}
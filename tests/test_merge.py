@@ -0,0 +1,67 @@
+from glitchlab_shopify import merge, merge_changes, MISSING
+
+
+def test_list_of_dicts_keeps_elements_past_the_end_of_b():
+	a = {'l': [{'x': 1}, {'y': 2}, {'z': 3}]}
+	assert merge(a, {'l': [{'x': 9}]}) == {'l': [{'x': 9}, {'y': 2}, {'z': 3}]}
+	assert a == {'l': [{'x': 1}, {'y': 2}, {'z': 3}]}
+
+def test_list_of_dicts_adds_elements_past_the_end_of_a():
+	merged, changes = merge_changes({'l': [{'x': 1}]}, {'l': [{'x': 1}, {'y': 2}]})
+	assert merged == {'l': [{'x': 1}, {'y': 2}]}
+	assert changes == [(('l', 1), MISSING, {'y': 2})]
+
+def test_shorter_list_of_dicts_that_matches_is_no_change():
+	a = {'l': [{'x': 1}, {'y': 2}]}
+	merged, changes = merge_changes(a, {'l': [{'x': 1}]})
+	assert merged is a
+	assert changes == []
+
+def test_list_of_scalars_is_replaced():
+	assert merge({'l': ['a', 'b', 'c']}, {'l': ['d']}) == {'l': ['d']}
+	assert merge({'l': [1, 2]}, {'l': [1, 2, 3]}) == {'l': [1, 2, 3]}
+
+def test_none_replaces_a_dict():
+	merged, changes = merge_changes({'d': {'x': 1}, 'k': 1}, {'d': None})
+	assert merged == {'d': None, 'k': 1}
+	assert changes == [(('d',), {'x': 1}, None)]
+
+def test_dict_replaces_none():
+	assert merge({'d': None}, {'d': {'x': 1}}) == {'d': {'x': 1}}
+
+def test_unchanged_returns_the_same_object():
+	a = {'product': {'title': 't', 'aspects': {'Brand': ['Acme']}}, 'l': [{'x': 1}]}
+	assert merge(a, {'product': {'title': 't'}, 'l': [{'x': 1}]}) is a
+	assert merge(a, {}) is a
+
+def test_merge_shares_unchanged_subtrees():
+	a = {'product': {'title': 't', 'aspects': {'Brand': ['Acme']}}, 'availability': {'q': 1}}
+	merged = merge(a, {'product': {'title': 'u'}})
+	assert merged['product']['title'] == 'u'
+	assert merged['product']['aspects'] is a['product']['aspects']
+	assert merged['availability'] is a['availability']
+	assert a['product']['title'] == 't'
+
+def test_update_false_raises_on_conflict():
+	try:
+		merge({'a': {'b': 1}}, {'a': {'b': 2}}, update=False)
+	except RuntimeError as e:
+		assert 'a.b' in str(e)
+	else:
+		assert False, 'no merge conflict raised'
+
+def test_merge_changes_lists_every_changed_leaf():
+	a = {'product': {'title': 't', 'mpn': 'X'}, 'l': [{'x': 1}, {'y': 2}]}
+	b = {'product': {'title': 'u', 'brand': 'Acme', 'mpn': 'X'}, 'l': [{'x': 1}, {'y': 3}]}
+	merged, changes = merge_changes(a, b)
+	assert merged == {'product': {'title': 'u', 'mpn': 'X', 'brand': 'Acme'}, 'l': [{'x': 1}, {'y': 3}]}
+	assert sorted(changes, key=lambda c: c[0]) == [
+		(('l', 1, 'y'), 2, 3),
+		(('product', 'brand'), MISSING, 'Acme'),
+		(('product', 'title'), 't', 'u'),
+		]
+
+def test_merge_changes_ignores_top_level_keys():
+	merged, changes = merge_changes({'a': 1, '_gl_x': 1}, {'a': 1, '_gl_x': 2}, ignore=('_gl_x',))
+	assert merged == {'a': 1, '_gl_x': 2}
+	assert changes == []
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+import ebay_tokens
+import price_quantity
+
+
+@pytest.fixture
+def queue(tmp_path):
+	return price_quantity.PriceQuantityQueue( str(tmp_path / 'pq.sqlite3'), window=0, lease=0.2 )
+
+def pending(queue, sku):
+	row = queue.conn.execute('SELECT * FROM pending WHERE sku = ?', (sku,)).fetchone()
+	return dict(row) if row is not None else None
+
+
+def test_newest_change_wins_and_unchanged_fields_are_kept(queue):
+	queue.put('A', price='1.00', currency='USD')
+	queue.put('A', quantity=3)
+	queue.put('A', quantity=5)
+	row = pending(queue, 'A')
+	assert (row['price'], row['currency'], row['quantity']) == ('1.00', 'USD', 5)
+
+def test_changes_wait_for_their_window(tmp_path):
+	queue = price_quantity.PriceQuantityQueue( str(tmp_path / 'pq.sqlite3'), window=0.2 )
+	queue.put('A', quantity=1)
+	assert queue.claim() == []
+	time.sleep(0.3)
+	assert [row['sku'] for row in queue.claim()] == ['A']
+
+def test_claimed_rows_are_not_claimed_twice_until_the_lease_runs_out(queue):
+	queue.put('A', quantity=1)
+	assert [row['sku'] for row in queue.claim()] == ['A']
+	assert queue.claim() == []
+	time.sleep(0.3)		# the flusher died
+	assert [row['sku'] for row in queue.claim()] == ['A']
+
+def test_done_takes_the_row_off_the_queue(queue):
+	queue.put('A', quantity=1)
+	queue.done( queue.claim()[0] )
+	assert pending(queue, 'A') is None
+
+def test_done_keeps_a_change_that_came_in_while_sending(queue):
+	queue.put('A', quantity=1)
+	row = queue.claim()[0]
+	time.sleep(0.01)
+	queue.put('A', quantity=2)
+	queue.done(row)
+	left = pending(queue, 'A')
+	assert left['quantity'] == 2
+	assert left['claimed_until'] is None
+	assert [r['quantity'] for r in queue.claim()] == [2]
+
+def test_retry_gives_up_after_max_attempts(queue):
+	queue.put('A', quantity=1)
+	for attempt in range(price_quantity.MAX_ATTEMPTS - 1):
+		queue.retry( queue.claim()[0], 'eBay is down' )
+		assert pending(queue, 'A')['attempts'] == attempt + 1
+	queue.retry( queue.claim()[0], 'eBay is down' )
+	assert pending(queue, 'A') is None
+	assert queue.failed == 1
+
+def test_retry_of_a_changed_row_starts_counting_again(queue):
+	queue.put('A', quantity=1)
+	queue.retry( queue.claim()[0], 'eBay is down' )
+	row = queue.claim()[0]
+	time.sleep(0.01)
+	queue.put('A', quantity=2)
+	queue.retry(row, 'eBay is down')
+	left = pending(queue, 'A')
+	assert (left['quantity'], left['attempts']) == (2, 0)
+
+def test_flush_sends_each_change_as_the_account_that_queued_it(queue, monkeypatch):
+	calls = []
+	def bulk(updates):
+		calls.append( (ebay_tokens.current_account(), sorted(u['sku'] for u in updates)) )
+		return {u['sku']: {'ok': True, 'status': 200, 'errors': []} for u in updates}
+	monkeypatch.setattr(price_quantity.glitchlab_shopify, 'update_ebay_price_quantity_bulk', bulk)
+	monkeypatch.setattr(price_quantity, 'price_quantity_request', lambda row: {'sku': row['sku']})
+	queue.put('A', quantity=1, account='alice')
+	queue.put('B', quantity=1)
+	queue.put('C', quantity=1, account='alice')
+	assert queue.flush() == 3
+	assert sorted(calls, key=lambda c: c[0] or '') == [(None, ['B']), ('alice', ['A', 'C'])]
+	assert queue.claim() == []
+	assert queue.flushed == 3